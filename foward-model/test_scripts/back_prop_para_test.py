@@ -26,37 +26,24 @@ from matplotlib import animation as animation
 import sys
 # import random for MC sampling
 import random
+# render for the order sums of the scattering field
+from mietools import render
+# coefficients for the cached Mie coefficients
+from mietools import coefficients
+# propagation for the angular spectrum propagator
+from mietools import propagation
+# basis library for the renders of the same plane
+from mietools import library
 
 #%%
 def propagate_field(E, fov, k, z):
+    # propagate the field E by z with the angular spectrum method
+    # the propagator of the plane keeps kz between the calls, and takes
+    # a stack of fields (..., rows, columns) at once
+    propagator = propagation.get_propagator(E.shape[-2:], fov, k)
+    E_prop = propagator.propagate(E, z)
     
-    # calculate the fourier frequencies
-    fx = np.fft.fftfreq(E.shape[0], fov/E.shape[0]) * k
-    fy = np.fft.fftfreq(E.shape[1], fov/E.shape[1]) * k
-    
-    # calculate kz
-    kx, ky = np.meshgrid(fx, fy)
-    kxky = kx ** 2 + ky ** 2
-    mask = kxky > k**2
-    kxky[mask] = 0
-    kz = np.sqrt(k**2 - kxky)
-    kz[mask] = 0
-    
-#    plt.figure()
-#    plt.imshow(kz)
-#    plt.colorbar()
-    
-    # calculate phase term
-    phase = np.exp(1j * kz * z)
-    
-    # apply phase shift in Fourier Domain
-    E_FFT = np.fft.fft2(E)
-    E_prop_FFT = E_FFT * phase
-    
-    # inverse Fourier Transform
-    E_prop = np.fft.ifft2(E_prop_FFT)
-    
-    return E_prop, phase
+    return E_prop, propagator.phase(z)
 
 class planewave():
     #implement all features of a plane wave
@@ -88,32 +75,11 @@ class planewave():
         Ef = self.E.reshape((3, 1, 1)) * ex
         return Ef
 
-def coeff_b(l, k, n, a):
-    jka = sp.special.spherical_jn(l, k * a)
-    jka_p = sp.special.spherical_jn(l, k * a, derivative=True)
-    jkna = sp.special.spherical_jn(l, k * n * a)
-    jkna_p = sp.special.spherical_jn(l, k * n * a, derivative=True)
-
-    yka = sp.special.spherical_yn(l, k * a)
-    yka_p = sp.special.spherical_yn(l, k * a, derivative=True)
-
-    hka = jka + yka * 1j
-    hka_p = jka_p + yka_p * 1j
-
-    bi = jka * jkna_p * n
-    ci = jkna * jka_p
-    di = jkna * hka_p
-    ei = hka * jkna_p * n
-
-    return (bi - ci) / (di - ei)
-
-def cal_field(res, fov, a, n, lambDa, z_slice):
-
-    # the maximal order
-    l_max = math.ceil(2*np.pi * a / lambDa + 4 * (2 * np.pi * a / lambDa) ** (1/3) + 2)
-    l = np.arange(0, l_max+1, 1)
+def eval_plane(res, fov, z_slice):
+    # the evaluate plane shared by cal_field and cal_fields
+    # return the resolution, the axes, the coordinates of the plane and
+    # the r vectors relative to the sphere
     
-    # construct the evaluate plane
     # simulation resolution
     # in order to do fft and ifft, expand the image use padding
     simRes = res*(2*padding + 1)
@@ -143,6 +109,26 @@ def cal_field(res, fov, a, n, lambDa, z_slice):
     # compute the rvector relative to the sphere
     rVecs_ps = rVecs - ps
     
+    return simRes, gx, gy, x, y, z, rVecs_ps
+
+def cal_field(res, fov, a, n, lambDa, z_slice, max_memory = None, tile_size = None, workers = 1, radial_lookup = True,
+               symmetry = None):
+    # max_memory: memory budget in bytes, the plane is evaluated in tiles of
+    #             rows that fit in it, render.MAX_MEMORY if None
+    # tile_size: number of rows of a tile, overrides max_memory
+    # workers: number of tiles evaluated at the same time on a thread pool
+    # radial_lookup: evaluate the scattering field once for every unique
+    #                pair of kr and cos_theta and look the other pixels up
+    # symmetry: mirror symmetry used to evaluate the plane, 1, 2, 4 or 8 (see
+    #           render.mirror_pixels), None to detect it
+
+    # the maximal order
+    l_max = math.ceil(2*np.pi * a / lambDa + 4 * (2 * np.pi * a / lambDa) ** (1/3) + 2)
+    l = np.arange(0, l_max+1, 1)
+    
+    # construct the evaluate plane
+    simRes, gx, gy, x, y, z, rVecs_ps = eval_plane(res, fov, z_slice)
+    
     # calculate the distance matrix
     rMag = np.sqrt(np.sum(rVecs_ps ** 2, 2))
     kMag = 2 * np.pi / lambDa
@@ -150,30 +136,40 @@ def cal_field(res, fov, a, n, lambDa, z_slice):
     
     rNorm = rVecs_ps / rMag[...,None]
     
-    # preconpute scatter matrix = hlkr * plcos_theta
+    # arguments of hlkr and plcos_theta, both are generated order by order
+    # inside the sum so the (simRes, simRes, l_max+1) scatter matrix is not built
     
     kr = kMag * rMag
     cos_theta = np.dot(rNorm, k_dir)
     
-    # calculate hlkr and plcos
-    scatter_matrix = np.zeros((simRes, simRes, l_max+1), dtype = np.complex128)
-    
     alpha = (2 * l + 1) * (1j ** l) 
-    jkr = sp.special.spherical_jn(l, kr[..., None])
-    ykr = sp.special.spherical_yn(l, kr[..., None])
-    hlkr = jkr + ykr * 1j
-    plcos = sp.special.eval_legendre(l, cos_theta[..., None])
-    scatter_matrix = hlkr * plcos * alpha
     
     # pre compute Ef, incident field at z-max
     E_obj = planewave(k, E)
     Ep = E_obj.evaluate(x, y, z)
     Ef = Ep[0,...]
     
-    # calculate B vector
-    B = coeff_b(l, kMag, n, a)
+    # calculate B vector, cached so the planes of the same sphere share it
+    B, A = coefficients.mie_coefficients(n, a, lambDa, l_max)
+    
+    # for on-axis incidence the scattering field is symmetric around the axis
+    # of the sphere, so only one part of a symmetric plane is evaluated
+    symmetric = k_dir[0] == 0 and k_dir[1] == 0
+    symmetry = render.plane_symmetry(gx - ps[0], gy - ps[1], symmetry, symmetric)
+    index, inverse = render.mirror_pixels(simRes, simRes, symmetry)
+    # the scattering field only depends on kr and cos_theta, so with the
+    # lookup it is evaluated once for every unique pair of them
+    if radial_lookup:
+        u_index, u_inverse = render.unique_pixels(np.ravel(kr)[index], np.ravel(cos_theta)[index])
+        index, inverse = index[u_index], u_inverse[inverse]
+    kr_u = np.ravel(kr)[index]
+    cos_theta_u = np.ravel(cos_theta)[index]
     
-    Es = np.sum(scatter_matrix * B, axis = 2)
+    # the order sum keeps about eight complex arrays of the tile size alive
+    tiles = render.tile_rows(index.size, 8 * 16, max_memory,
+                             None if tile_size is None else tile_size * simRes, workers)
+    Es = render.map_tiles(lambda rows: render.hankel_sum(kr_u[rows], B * alpha, cos_theta = cos_theta_u[rows]),
+                          tiles, workers)[inverse]
     Et = Es + Ef
     
     mask = rMag < a
@@ -182,6 +178,93 @@ def cal_field(res, fov, a, n, lambDa, z_slice):
     
     return Et, mask
 
+def cal_fields(res, fov, a, n, lambDa, z_slice, B = None, max_memory = None, tile_size = None, workers = 1,
+               radial_lookup = True, symmetry = None, basis_dir = None):
+    # fields of M spheres at the same position, evaluated on the same plane
+    # a, n: radii and refractive indices, scalars or M values each
+    # B: coefficients of shape (l_max+1, M) used instead of the Mie coefficients
+    # basis_dir: directory of a basis library (see mietools.library), the basis
+    #          of the plane is loaded from it, or computed and stored there
+    #          the first time the plane is rendered
+    # the other parameters are the same as in cal_field
+    # the scattering basis hlkr * plcos_theta * (2l + 1) i^l does not depend
+    # on the sphere, so all the fields come from one product of the basis
+    # with the stack of B vectors
+    # return the total fields and the masks of the spheres, shape (M, simRes, simRes)
+    
+    a, n = np.broadcast_arrays(np.atleast_1d(a), np.atleast_1d(n))
+    
+    # the maximal order, shared by all the spheres
+    if B is None:
+        a_max = np.max(a)
+        l_max = math.ceil(2*np.pi * a_max / lambDa + 4 * (2 * np.pi * a_max / lambDa) ** (1/3) + 2)
+    else:
+        B = np.reshape(B, (np.shape(B)[0], -1))
+        l_max = B.shape[0] - 1
+    l = np.arange(0, l_max+1, 1)
+    
+    # construct the evaluate plane
+    simRes, gx, gy, x, y, z, rVecs_ps = eval_plane(res, fov, z_slice)
+    
+    # calculate the distance matrix
+    rMag = np.sqrt(np.sum(rVecs_ps ** 2, 2))
+    kMag = 2 * np.pi / lambDa
+    k = np.asarray(k_dir) * kMag
+    
+    rNorm = rVecs_ps / rMag[...,None]
+    
+    kr = kMag * rMag
+    cos_theta = np.dot(rNorm, k_dir)
+    
+    # pre compute Ef, incident field at z-max
+    E_obj = planewave(k, E)
+    Ep = E_obj.evaluate(x, y, z)
+    Ef = Ep[0,...]
+    
+    # calculate the stack of B vectors in one call, one column per sphere,
+    # each truncated at the order of its own radius
+    if B is None:
+        B = coefficients.coefficient_grid(n, a, lambDa, l_max)[0].T
+    
+    # the same pixel lookups as in cal_field
+    symmetric = k_dir[0] == 0 and k_dir[1] == 0
+    symmetry = render.plane_symmetry(gx - ps[0], gy - ps[1], symmetry, symmetric)
+    
+    def pixels():
+        index, inverse = render.mirror_pixels(simRes, simRes, symmetry)
+        if radial_lookup:
+            u_index, u_inverse = render.unique_pixels(np.ravel(kr)[index], np.ravel(cos_theta)[index])
+            index, inverse = index[u_index], u_inverse[inverse]
+        return np.ravel(kr)[index], np.ravel(cos_theta)[index], inverse
+    
+    if basis_dir is None:
+        kr_u, cos_theta_u, inverse = pixels()
+        
+        # a tile keeps the basis, the spherical bessel functions it is built
+        # from and the fields of all the spheres
+        tiles = render.tile_rows(kr_u.size, 16 * (4 * (l_max + 1) + B.shape[1]), max_memory,
+                                 None if tile_size is None else tile_size * simRes, workers)
+        Es = render.map_tiles(lambda rows: render.scattering_basis(kr_u[rows], cos_theta_u[rows], l_max) @ B,
+                              tiles, workers)[inverse]
+    else:
+        # the basis of the unique pixels and their lookup, both memory mapped
+        def compute():
+            kr_u, cos_theta_u, inverse = pixels()
+            return {'basis': render.scattering_basis(kr_u, cos_theta_u, l_max), 'inverse': inverse}
+        
+        name = library.basis_name('scattered', res = res, fov = fov, padding = padding,
+                                  plane = (z_slice, list(ps), list(k_dir)), lambDa = lambDa,
+                                  numOrd = l_max, symmetry = symmetry, radial_lookup = radial_lookup)
+        arrays = library.open_basis(basis_dir, name, compute)
+        Es = (arrays['basis'] @ B)[arrays['inverse']]
+    Et = np.moveaxis(Es, -1, 0) + Ef
+    
+    mask = rMag < a[:, None, None]
+    
+    Et[mask] = 0
+    
+    return Et, mask
+
 def get_error(res, fov, a, n, lambDa, z0_slice, z_distance):
     
     E0, mask = cal_field(res, fov, a, n, lambDa, z0_slice)
@@ -198,6 +281,26 @@ def get_error(res, fov, a, n, lambDa, z0_slice, z_distance):
     Error_abs = np.average(np.abs(E_error))
     
     return Error_real, Error_imag, Error_abs
+
+def get_errors(res, fov, a, n, lambDa, z0_slice, z_distance, basis_dir = None):
+    # get_error for a list of refractive indices n of spheres of radius a,
+    # the fields of all of them are rendered together by cal_fields
+    # basis_dir: directory of a basis library, see cal_fields
+    
+    E0, mask = cal_fields(res, fov, a, n, lambDa, z0_slice, basis_dir = basis_dir)
+    Ez, temp = cal_fields(res, fov, a, n, lambDa, z0_slice + z_distance, basis_dir = basis_dir)
+    
+    # propagate the fields of all the spheres to the same plane as E0 at once
+    E_prop, phase = propagate_field(Ez, fov, 2 * np.pi / lambDa, z_distance)
+    E_prop[mask] = 0
+    
+    # calculate the average pixel error of every sphere after propagation
+    E_error = E_prop - E0
+    Error_real = np.average(np.real(E_error), axis = (1, 2))
+    Error_imag = np.average(np.imag(E_error), axis = (1, 2))
+    Error_abs = np.average(np.abs(E_error), axis = (1, 2))
+    
+    return Error_real, Error_imag, Error_abs
     
 #%%
 # specify parameters for the forward model
@@ -273,17 +376,10 @@ plt.legend()
 #%%
 # initialize test results
 # test along propagation distance
-error_nr_r = np.zeros(num_test)
-error_nr_i = np.zeros(num_test)
-error_nr_a = np.zeros(num_test)
-
 distance_test = 1.5
 
-for nr_idex, nr in enumerate(nr_list):
-    
-    [error_nr_r[nr_idex],
-     error_nr_i[nr_idex],
-     error_nr_a[nr_idex]] = get_error(res, fov, a, nr, lambDa, z0_slice, distance_test)
+# all the refractive indices share the plane, render them together
+error_nr_r, error_nr_i, error_nr_a = get_errors(res, fov, a, nr_list, lambDa, z0_slice, distance_test)
 
 #%%
 # plot the error of distance
@@ -299,18 +395,10 @@ plt.legend()
 #%%
 # initialize test results
 # test along propagation distance
-error_ni_r = np.zeros(num_test)
-error_ni_i = np.zeros(num_test)
-error_ni_a = np.zeros(num_test)
-
 distance_test = 1.5
 nr_test = 1.05
 
-for ni_idex, ni in enumerate(ni_list):
-    
-    [error_ni_r[ni_idex],
-     error_ni_i[ni_idex],
-     error_ni_a[ni_idex]] = get_error(res, fov, a, nr_test + ni * 1j, lambDa, z0_slice, distance_test)
+error_ni_r, error_ni_i, error_ni_a = get_errors(res, fov, a, nr_test + ni_list * 1j, lambDa, z0_slice, distance_test)
 
 #%%
 # plot the error of distance
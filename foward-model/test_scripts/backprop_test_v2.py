@@ -30,23 +30,13 @@ def cal_kz(fov, simRes):
     
 #    x = np.linspace(-simRes/(fov * 2 * 2 * np.pi), simRes/(fov * 2 * 2 * np.pi), simRes)
     x = kfreq
-    xx, yy = np.meshgrid(x, x)
-    
-    #allocate the frequency components in x and y axis
-    k_xy = np.zeros((simRes, simRes, 2))
-    k_xy[..., 0], k_xy[..., 1] = xx, yy
     
     #compute the distance of x, y components in Fourier domain
-    k_para_square = k_xy[...,0]**2 + k_xy[...,1]**2
-    
-    #initialize a z-axis frequency components
-    k_z = np.zeros(xx.shape)
+    k_para_square = x[None, :]**2 + x[:, None]**2
     
-    #compute kz at each pixel
-    for i in range(len(k_para_square)):
-        for j in range(len(k_para_square)):
-            if k_para_square[i, j] < 1:
-                k_z[i, j] = np.sqrt(1 - k_para_square[i, j])
+    #compute kz at each pixel, 0 where the sum is not smaller than 1
+    propagating = k_para_square < 1
+    k_z = np.sqrt(np.where(propagating, 1 - k_para_square, 0))
     
     #return it
     return k_z, kfreq
@@ -8,32 +8,13 @@ Editor:
 """
 
 import numpy as np
+# propagation for the angular spectrum propagator
+from mietools import propagation
 
 def propagate_field(E, fov, k, z):
-    
-    # calculate the fourier frequencies
-    fx = np.fft.fftfreq(E.shape[0], fov/E.shape[0]) * 2 * np.pi
-    fy = np.fft.fftfreq(E.shape[1], fov/E.shape[1]) * 2 * np.pi
-    
-    # calculate kz
-    kx, ky = np.meshgrid(fx, fy)
-    kxky = kx ** 2 + ky ** 2
-    mask = kxky > k**2
-    kxky[mask] = 0
-    kz = np.sqrt(k**2 - kxky)
-    kz[mask] = 0
-    
-    # calculate phase term
-    phase = np.exp(1j * kz * z)
-    
-    # apply phase shift in Fourier Domain
-    E_FFT = np.fft.fft2(E)
-    E_prop_FFT = E_FFT * phase
-    
-    # inverse Fourier Transform
-    E_prop = np.fft.ifft2(E_prop_FFT)
-    
-    return E_prop
+    # propagate the field E by z with the angular spectrum method
+    # the propagator of the plane keeps kz between the calls
+    return propagation.get_propagator(E.shape[-2:], fov, k).propagate(E, z)
 
 E_prop = propagate_field(Et_distance, fov, 1, -0.5)
 
@@ -15,6 +15,10 @@ import scipy as sp
 import scipy.special
 import math
 import matplotlib.pyplot as plt
+# render for the order sums of the scattering field
+from mietools import render
+# farfield for the angular kernel of the asymptotic far field
+from mietools import farfield
 
 #%%
 # Calculate the sphere scattering coefficients
@@ -38,7 +42,16 @@ def coeff_b(l, k, n, a):
     # return ai * (bi - ci) / (di - ei)
     return (bi - ci) / (di - ei)
 
-def cal_near_field(res, fov, a, n, lambDa, z_slice):
+def cal_near_field(res, fov, a, n, lambDa, z_slice, max_memory = None, tile_size = None, workers = 1, radial_lookup = True,
+                   symmetry = None):
+    # max_memory: memory budget in bytes, the plane is evaluated in tiles of
+    #             rows that fit in it, render.MAX_MEMORY if None
+    # tile_size: number of rows of a tile, overrides max_memory
+    # workers: number of tiles evaluated at the same time on a thread pool
+    # radial_lookup: evaluate the scattering field once for every unique
+    #                pair of kr and cos_theta and look the other pixels up
+    # symmetry: mirror symmetry used to evaluate the plane, 1, 2, 4 or 8 (see
+    #           render.mirror_pixels), None to detect it
 
     # the maximal order
     l_max = math.ceil(2*np.pi * a / lambDa + 4 * (2 * np.pi * a / lambDa) ** (1/3) + 2)
@@ -73,20 +86,13 @@ def cal_near_field(res, fov, a, n, lambDa, z_slice):
     
     rNorm = rVecs_ps / rMag[...,None]
     
-    # preconpute scatter matrix = hlkr * plcos_theta
+    # arguments of hlkr and plcos_theta, both are generated order by order
+    # inside the sum so the (simRes, simRes, l_max+1) scatter matrix is not built
     
     kr = kMag * rMag
     cos_theta = np.dot(rNorm, k_dir)
     
-    # calculate hlkr and plcos
-    scatter_matrix = np.zeros((simRes, simRes, l_max+1), dtype = np.complex128)
-    
     alpha = (2 * l + 1) * (1j ** l) 
-    jkr = sp.special.spherical_jn(l, kr[..., None])
-    ykr = sp.special.spherical_yn(l, kr[..., None])
-    hlkr = jkr + ykr * 1j
-    plcos = sp.special.eval_legendre(l, cos_theta[..., None])
-    scatter_matrix = hlkr * plcos * alpha
     
     # pre compute Ef, incident field at z-max
 #    E_obj = planewave(k, E)
@@ -96,7 +102,24 @@ def cal_near_field(res, fov, a, n, lambDa, z_slice):
     # calculate B vector
     B = coeff_b(l, kMag, n, a)
     
-    Es = np.sum(scatter_matrix * B, axis = 2)
+    # for on-axis incidence the scattering field is symmetric around the axis
+    # of the sphere, so only one part of a symmetric plane is evaluated
+    symmetric = k_dir[0] == 0 and k_dir[1] == 0
+    symmetry = render.plane_symmetry(gx - ps[0], gy - ps[1], symmetry, symmetric)
+    index, inverse = render.mirror_pixels(simRes, simRes, symmetry)
+    # the scattering field only depends on kr and cos_theta, so with the
+    # lookup it is evaluated once for every unique pair of them
+    if radial_lookup:
+        u_index, u_inverse = render.unique_pixels(np.ravel(kr)[index], np.ravel(cos_theta)[index])
+        index, inverse = index[u_index], u_inverse[inverse]
+    kr_u = np.ravel(kr)[index]
+    cos_theta_u = np.ravel(cos_theta)[index]
+    
+    # the order sum keeps about eight complex arrays of the tile size alive
+    tiles = render.tile_rows(index.size, 8 * 16, max_memory,
+                             None if tile_size is None else tile_size * simRes, workers)
+    Es = render.map_tiles(lambda rows: render.hankel_sum(kr_u[rows], B * alpha, cos_theta = cos_theta_u[rows]),
+                          tiles, workers)[inverse]
     Et = Es #+ Ef
     
     mask = rMag < a
@@ -141,47 +164,19 @@ def cal_Es_far_field(a, n, k, k_dir, simRes, simFov, working_dis, scale_factor):
     # calculate k dot r
     kr = kMag * rMag
     
-    # calculate the asymptotic form of hankel funtions
-    hlkr_asym = np.zeros((kr.shape[0], kr.shape[1], l.shape[0]), dtype = np.complex128)
-    for i in l:
-        # <<Recovery of absorption spectra from Fourier transform infrared...>>
-        hlkr_asym[..., i] = np.exp(1j*(kr-i*math.pi/2))/(1j * kr)
-        
-        # Robert G Brown, Duke University
-        # kr -> infinity
-        #hlkr_asym[..., i] = np.exp(1j*(kr-(i+1)*math.pi/2))/kr
-        
-    # calculate the legendre polynomial
-    # get the frequency components
-    fx = np.fft.fftfreq(simRes, simFov/simRes)
-    fy = fx
+    # in the asymptotic form of the hankel functions
+    #   h_l(kr) -> (-i)^l exp(ikr) / (ikr)
+    # the radial factor does not depend on the order, so the sum over the
+    # orders is the radial factor times a kernel of cos theta alone
+    radial = np.exp(1j * kr) / (1j * kr)
     
-    # create a meshgrid in the Fourier Domain
-    [kx, ky] = np.meshgrid(fx, fy)
-    # calculate the sum of kx ky components so we can calculate 
-    # cos_theta in the Fourier Domain later
-    kxky = kx ** 2 + ky ** 2
-    # create a mask where the sum of kx^2 + ky^2 is 
-    # bigger than 1 (where kz is not defined)
-    mask = kxky > 1
-    # mask out the sum
-    kxky[mask] = 0
-    # calculate cos theta in Fourier domain
-    cos_theta = np.sqrt(1 - kxky)
-    cos_theta[mask] = 0
-    # calculate the Legendre Polynomial term
-    pl_cos_theta = sp.special.eval_legendre(l, cos_theta[..., None])
-    # mask out the light that is propagating outside of the objective
-    pl_cos_theta[mask] = 0
+    # calculate the angular kernel in the Fourier Domain, it is evaluated once
+    # for every distinct cos theta of the grid and is 0 where kx^2 + ky^2 is
+    # bigger than 1 (light propagating outside of the objective)
+    kernel, mask = farfield.fourier_kernel(farfield.far_field_coefficients(B), simRes, simFov)
     
-    # calculate the prefix alpha term
-    alpha = (2*l + 1) * 1j ** l
-    # calculate the matrix besides B vector
-    scatter_matrix = hlkr_asym * pl_cos_theta * alpha
-    # calculate every order of the integration
-    Sum = scatter_matrix * B
-    # integrate through all the orders to get the farfield in the Fourier Domain
-    E_scatter_fft = np.sum(Sum, axis = -1) * scale_factor
+    # the farfield in the Fourier Domain
+    E_scatter_fft = radial * kernel * scale_factor
     
     # shift the Forier transform of the scatttering field for visualization
     E_scatter_fftshift = np.fft.fftshift(E_scatter_fft)
@@ -18,6 +18,8 @@ import scipy.special
 import math
 import matplotlib.pyplot as plt
 from hankel import HankelTransform
+# farfield for the angular kernel of the asymptotic far field
+from mietools import farfield
 
 #%%
 # Calculate the sphere scattering coefficients
@@ -113,42 +115,19 @@ def cal_Et_far_field(a, n, k, k_dir, res, fov, working_dis, scale_factor):
     # calculate k dot r
     kr = kMag * rMag
     
-    # calculate the asymptotic form of hankel funtions
-    hlkr_asym = np.zeros((kr.shape[0], kr.shape[1], l.shape[0]), dtype = np.complex128)
-    for i in l:
-        hlkr_asym[..., i] = np.exp(1j*(kr-i*math.pi/2))/(1j * kr)
-    
-    # calculate the legendre polynomial
-    # get the frequency components
-    fx = np.fft.fftfreq(simRes, simFov/simRes)
-    fy = fx
-    
-    # create a meshgrid in the Fourier Domain
-    [kx, ky] = np.meshgrid(fx, fy)
-    # calculate the sum of kx ky components so we can calculate 
-    # cos_theta in the Fourier Domain later
-    kxky = kx ** 2 + ky ** 2
-    # create a mask where the sum of kx^2 + ky^2 is 
-    # bigger than 1 (where kz is not defined)
-    mask = kxky > 1
-    # mask out the sum
-    kxky[mask] = 0
-    # calculate cos theta in Fourier domain
-    cos_theta = np.sqrt(1 - kxky)
-    cos_theta[mask] = 0
-    # calculate the Legendre Polynomial term
-    pl_cos_theta = sp.special.eval_legendre(l, cos_theta[..., None])
-    # mask out the light that is propagating outside of the objective
-    pl_cos_theta[mask] = 0
-    
-    # calculate the prefix alpha term
-    alpha = (2*l + 1) * 1j ** l
-    # calculate the matrix besides B vector
-    scatter_matrix = hlkr_asym * pl_cos_theta * alpha
-    # calculate every order of the integration
-    Sum = scatter_matrix * B
-    # integrate through all the orders to get the farfield in the Fourier Domain
-    E_scatter_fft = np.sum(Sum, axis = -1) * scale_factor
+    # in the asymptotic form of the hankel functions
+    #   h_l(kr) -> (-i)^l exp(ikr) / (ikr)
+    # the radial factor does not depend on the order, so the sum over the
+    # orders is the radial factor times a kernel of cos theta alone
+    radial = np.exp(1j * kr) / (1j * kr)
+    
+    # calculate the angular kernel in the Fourier Domain, it is evaluated once
+    # for every distinct cos theta of the grid and is 0 where kx^2 + ky^2 is
+    # bigger than 1 (light propagating outside of the objective)
+    kernel, mask = farfield.fourier_kernel(farfield.far_field_coefficients(B), simRes, simFov)
+    
+    # the farfield in the Fourier Domain
+    E_scatter_fft = radial * kernel * scale_factor
     
     # shift the Forier transform of the scatttering field for visualization
     E_scatter_fftshift = np.fft.fftshift(E_scatter_fft)
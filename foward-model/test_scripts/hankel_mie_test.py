@@ -14,6 +14,8 @@ import numpy as np
 import matplotlib.pyplot as plt
 import scipy as sp
 import scipy.special
+# hankel for the discrete hankel transforms
+from mietools import hankel
 
 #%%
 #E_fft = np.fft.ifftshift(np.fft.fft2(np.fft.fftshift(Et_close)))
@@ -49,33 +51,16 @@ def idhf(simFov, simRes, x, y):
     X = int(simFov/2)
     n_s = int(simRes/2)
     
-    # order of the bessel function
-    order = 0
-    # root of the bessel function
-    jv_root = sp.special.jn_zeros(order, n_s)
-    jv_M = jv_root[-1]
-    jv_m = jv_root[:-1]
-    jv_mX = jv_m/(X* 2*np.pi)
+    # roots of the bessel function divided by X, and the output samples
+    jv_m_X, r = hankel.dht_grid(X, n_s)
+    jv_mX = jv_m_X/(2*np.pi)
     
 #    F_term = np.interp(jv_mX, x, y)
     F_term = y[:-1]
-    # inverse DHT
-    F = np.zeros(n_s, dtype=np.complex128)
-    for k in range(n_s):
-        prefix = 2/(X**2)
-        
-        summation = 0
-        for m in range(n_s-1):
-            
-            Jjj = jv_root[m]*jv_root[k]/jv_M
-            numerator = sp.special.jv(order, Jjj)
-            denominator = sp.special.jv(order+1, jv_root[m])**2
-            
-            summation += F_term[m] * numerator / denominator
-        
-        F[k] = prefix * summation
-
-    return F, F_term, jv_root*X/jv_M, jv_mX
+    # inverse DHT, a product with the kernel matrix
+    F = hankel.idht(F_term, X)
+
+    return F, F_term, r, jv_mX
 
 #%%
 
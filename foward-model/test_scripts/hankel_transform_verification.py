@@ -12,6 +12,8 @@ import scipy as sp
 import scipy.special
 import numpy as np
 import matplotlib.pyplot as plt
+# hankel for the discrete hankel transforms
+from mietools import hankel
 
 # define a discrete function
 def discrete(x, alpha=1):
@@ -49,36 +51,14 @@ def idhf(simFov, simRes, func):
     X = int(simFov/2)
     n_s = int(simRes/2)
     
-    # order of the bessel function
-    order = 0
-    # root of the bessel function
-    jv_root = sp.special.jn_zeros(order, n_s)
-    jv_M = jv_root[-1]
-    jv_mX = jv_root[:-1]/X
-
-    # inverse DHT
-    F = np.zeros(n_s, dtype=np.complex128)
+    # sample the function at the roots of the bessel function
+    x_f, r = hankel.dht_grid(X, n_s)
+    F_fit = np.asarray(func(x_f))
     
-    for k in range(n_s):
-        F_fit = []
-        prefix = 2/(X**2)       
-        summation = 0
-        for m in range(n_s-1):
-            
-            x_f = jv_root[m]/X
-            F_term = func(x_f)
-            
-            Jjj = jv_root[m]*jv_root[k]/jv_M
-            numerator = sp.special.jv(order, Jjj)
-            denominator = sp.special.jv(order+1, jv_root[m])**2
-            
-            summation += F_term * numerator / denominator
-            F_fit.append(F_term)
-            
-        F[k] = prefix * summation
-        
-
-    return F, F_fit, jv_root*X/jv_M, jv_mX
+    # inverse DHT, a product with the kernel matrix
+    F = hankel.idht(F_fit, X)
+
+    return F, F_fit, r, x_f
 
 #%%
 fov = 16
@@ -112,4 +92,50 @@ plt.subplot(122)
 plt.title('Exponential Root Samples')
 plt.plot(F_fit_x, F_fit1, label='With Roots')
 plt.plot(x_f, exp(x_f), label='Ground Truth')
-plt.legend()
\ No newline at end of file
+plt.legend()
+
+#%%
+# benchmark the 1-D transforms against the 2-D FFT route of far2near
+# the far field of a gaussian near field exp(-r^2 / (2 sigma^2)) / (2 pi sigma^2)
+# is exp(-2 pi^2 sigma^2 f^2), where f is the spatial frequency
+sigma = 1
+def far(f):
+    return np.exp(-2 * np.pi**2 * sigma**2 * f**2)
+def near(r):
+    return np.exp(-r**2 / (2 * sigma**2)) / (2 * np.pi * sigma**2)
+
+# 2-D FFT: the far field on the full frequency grid
+start = time.time()
+f = np.fft.fftfreq(simRes, simFov/simRes)
+E_far_2d = far(np.sqrt(f[:, None]**2 + f[None, :]**2))
+E_near_2d = np.fft.fftshift(np.fft.ifft2(E_far_2d)) * (simRes / simFov)**2
+near_line_2d = E_near_2d[int(simRes/2), int(simRes/2):]
+time_2d = time.time() - start
+x_2d = np.arange(near_line_2d.size) * simFov / simRes
+
+# quasi-discrete hankel transform, the far field at the roots
+# with u = 2 pi f the hankel transform of the near field is far(u / 2 pi) / 2 pi
+start = time.time()
+u, x_dht = hankel.dht_grid(simFov/2, int(simRes/2))
+near_line_dht = hankel.idht(far(u / (2 * np.pi)) / (2 * np.pi), simFov/2)
+time_dht = time.time() - start
+
+# the kernel and the roots are cached, so a second transform of the same
+# size, or of a whole stack of profiles at once, is only a matrix product
+start = time.time()
+near_stack_dht = hankel.idht(far(u[:, None] / (2 * np.pi)) / (2 * np.pi) * np.ones(16), simFov/2)
+time_stack = time.time() - start
+print('QDHT with the cached kernel, 16 profiles: ' + str(time_stack) + ' s')
+
+# FFTLog, the far field on a logarithmic grid
+start = time.time()
+u_log = np.logspace(-6, 3, int(simRes/2))
+x_log, near_line_log = hankel.fftlog(far(u_log / (2 * np.pi)) / (2 * np.pi), u_log)
+time_log = time.time() - start
+
+for name, t, x_line, line in (('2-D FFT', time_2d, x_2d, near_line_2d),
+                              ('QDHT', time_dht, x_dht, near_line_dht),
+                              ('FFTLog', time_log, x_log, near_line_log)):
+    inside = x_line < simFov/2
+    error = np.max(np.abs(line[inside] - near(x_line[inside])))
+    print(name + ': ' + str(t) + ' s, largest error ' + str(error))
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+This script compares the convergence of the sampling schemes of the
+focused beam k vectors
+
+The scattering field of a sphere illuminated by a condenser is computed with
+every scheme in mietools.sampling.cone_quadrature at increasing numbers of
+plane waves, and compared with the analytic integration over the condenser
+cone (mietools.render.condenser_sum), which has no sampling error.
+
+The weights are then passed to the renderer of mie_scattering_v4-3.py as
+k_w, and its total field is compared with its analytic method, so the
+normalization of the weights inside mieScattering is tested as well.
+
+Editor:
+    STIM Laboratory
+"""
+
+import os
+import numpy as np
+import scipy as sp
+import scipy.special
+import math
+import matplotlib.pyplot as plt
+from mietools import render
+from mietools import sampling
+
+#%%
+# Calculate the sphere scattering coefficients
+def coeff_b(l, k, n, a):
+    jka = sp.special.spherical_jn(l, k * a)
+    jka_p = sp.special.spherical_jn(l, k * a, derivative=True)
+    jkna = sp.special.spherical_jn(l, k * n * a)
+    jkna_p = sp.special.spherical_jn(l, k * n * a, derivative=True)
+
+    yka = sp.special.spherical_yn(l, k * a)
+    yka_p = sp.special.spherical_yn(l, k * a, derivative=True)
+
+    hka = jka + yka * 1j
+    hka_p = jka_p + yka_p * 1j
+
+    bi = jka * jkna_p * n
+    ci = jkna * jka_p
+    di = jkna * hka_p
+    ei = hka * jkna_p * n
+
+    return (bi - ci) / (di - ei)
+
+#%%
+# set parameters
+fov = 30                    # field of view
+res = 64                    # resolution
+a = 5                       # radius of the sphere
+lambDa = 8                  # wavelength
+n = 1.3 + 0.01j             # refractive index
+NA_in = 0.0                 # inner numerical aperture of the condenser
+NA_out = 0.9                # outer numerical aperture of the condenser
+pp = 20                     # position of the visualization plane along z
+ps = [0, 0, 0]              # position of the sphere
+k_dir = [0, 0, -1]          # propagation direction of the center plane wave
+
+# number of plane waves to test
+num_samples = [16, 32, 64, 128, 256, 512, 1024, 2048]
+
+#%%
+# the evaluation plane and the terms independent of the plane waves
+kMag = 2 * np.pi / lambDa
+l_max = math.ceil(kMag * a + 4 * (kMag * a) ** (1/3) + 2)
+l = np.arange(0, l_max+1, 1)
+
+gx = np.linspace(-fov/2, fov/2, res)
+[x, y] = np.meshgrid(gx, gx)
+rVecs = np.stack((x, y, np.zeros(x.shape) + pp), axis=-1) - ps
+rMag = np.sqrt(np.sum(rVecs ** 2, 2))
+rNorm = rVecs / rMag[..., None]
+
+kr = kMag * rMag
+hlkr = sp.special.spherical_jn(l, kr[..., None]) + 1j * sp.special.spherical_yn(l, kr[..., None])
+B = (2 * l + 1) * (1j ** l) * coeff_b(l, kMag, n, a)
+
+# ground truth from the analytic integration
+alpha1, alpha2 = sampling.cone_angles(NA_in, NA_out)
+c = np.asarray(ps, dtype=np.float64)
+S_ref = render.condenser_sum(rNorm, k_dir, c, kMag, l_max, alpha1, alpha2)
+Es_ref = np.sum(hlkr * S_ref * B, axis=2)
+
+#%%
+# relative error of every scheme at every number of plane waves
+errors = {}
+sizes = {}
+for scheme in sampling.SCHEMES:
+    errors[scheme] = []
+    sizes[scheme] = []
+    for numSample in num_samples:
+        k_j, w_j = sampling.cone_quadrature(k_dir, NA_in, NA_out, numSample, scheme, seed=0)
+        phase = w_j * np.exp(1j * kMag * np.dot(c, k_j))
+        S = render.angular_sum(rNorm, k_j, phase, l_max)
+        Es = np.sum(hlkr * S * B, axis=2)
+        errors[scheme].append(np.linalg.norm(Es - Es_ref) / np.linalg.norm(Es_ref))
+        sizes[scheme].append(k_j.shape[1])
+
+for scheme in sampling.SCHEMES:
+    print(scheme + ': ' + ', '.join('%d: %.2e' % (s, e) for s, e in zip(sizes[scheme], errors[scheme])))
+
+#%%
+plt.figure()
+for scheme in sampling.SCHEMES:
+    plt.loglog(sizes[scheme], errors[scheme], marker='.', label=scheme)
+plt.loglog(num_samples, errors['random'][0] * np.sqrt(num_samples[0] / np.asarray(num_samples)),
+           linestyle='--', color='gray', label='O(1/sqrt(N))')
+plt.xlabel('Number of Plane Waves')
+plt.ylabel('Relative Error of Es')
+plt.title('NA_in = ' + str(NA_in) + ', NA_out = ' + str(NA_out) + ', a = ' + str(a))
+plt.legend()
+
+#%%
+# the same comparison through the renderer of mie_scattering_v4-3.py
+# the script can not be imported, so its definitions are run without the
+# scene that follows them
+scriptPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mie_scattering_v4-3.py')
+with open(scriptPath) as f:
+    source = f.read()
+exec(source[:source.index('\nk = [')])
+
+option = 'Horizontal'
+Et_ref, Emask_ref, Ef_ref, _ = getTotalField(k_dir, None, n, res, a, ps, pp, 0, NA_in, NA_out, option,
+                                             method = 'analytic')
+Es_norm = np.linalg.norm(Et_ref - Ef_ref)
+
+render_errors = {}
+render_sizes = {}
+for scheme in ('random', 'gauss'):
+    render_errors[scheme] = []
+    render_sizes[scheme] = []
+    for numSample in num_samples:
+        # the renderer integrates the cone inside the sphere, sample the same one
+        k_j, w_j = sampling.cone_quadrature(k_dir, NA_in, NA_out, numSample, scheme, seed=0, n=np.real(n))
+        Et, Emask, Ef, _ = getTotalField(k_dir, k_j, n, res, a, ps, pp, k_j.shape[1], NA_in, NA_out, option,
+                                         k_w = w_j)
+        render_errors[scheme].append(np.linalg.norm(Et - Et_ref) / Es_norm)
+        render_sizes[scheme].append(k_j.shape[1])
+    print('getTotalField, ' + scheme + ': ' +
+          ', '.join('%d: %.2e' % (s, e) for s, e in zip(render_sizes[scheme], render_errors[scheme])))
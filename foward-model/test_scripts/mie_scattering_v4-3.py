@@ -18,8 +18,6 @@ Editor:
 import numpy as np
 # matplotlib for ploting the images
 from matplotlib import pyplot as plt
-# pyquaternion for ratating the vectors
-from pyquaternion import Quaternion
 # scipy for input/output files
 import scipy as sp
 import scipy.special
@@ -29,18 +27,34 @@ import math
 from matplotlib import animation as animation
 # time for timing profiles
 import time
-# random for Monte Carlo Sampling
-import random
+# json for saving the state of the random numbers
+import json
+# sampling for the Monte Carlo sampled k vectors
+from mietools import sampling
+# render for the batched plane wave accumulation
+from mietools import render
+# special for the spherical bessel and hankel functions of all orders
+from mietools import special
+# coefficients for the cached Mie coefficients of the sphere
+from mietools import coefficients
+# focus for the focused field shared by the spheres of a scene
+from mietools import focus
+# geometry for the evaluation plane shared by the spheres of a scene
+from mietools import geometry
+# propagation for the digital refocusing of the total field
+from mietools import propagation
 
 
 class mieScattering:
     
     # parameters used to calculate the fields
-    def __init__(self, k, k_j, n, res, a, ps, pp, numSample, NA_in, NA_out, option = 'Horizontal'):
+    def __init__(self, k, k_j, n, res, a, ps, pp, numSample, NA_in, NA_out, option = 'Horizontal', batchSize = None, k_w = None,
+                 maxMemory = None, tileSize = None, numWorkers = 1, radialLookup = True, orderTol = render.ORDER_TOL,
+                 focusCache = None, plane = None):
         # n is the refractive index of the sphere. The n of the surrounding material is 1.0
         self.n = n
-        # a is the radius of the sphere, for calculation precision perposes, 
-        # a should not be larger than twice the wavelength
+        # a is the radius of the sphere, the cached Mie coefficients stay accurate
+        # for large spheres as well (see mietools.coefficients)
         self.a = a
         # number of Monte Carlo sampling, 1000 is fine, simulation time cost grows linearly with this variable
         self.numSample = numSample
@@ -63,6 +77,15 @@ class mieScattering:
         self.alpha2 = math.asin(self.NA_out)
         # scale factor used later for integrating all sampled vectors
         self.subA = 2 * np.pi * self.E0 * ((1 - np.cos(self.alpha2)) - (1 - np.cos(self.alpha1)))
+        # cone of the plane waves summed for the scattered and internal fields,
+        # it starts from the center planewave and its outer angle is taken
+        # inside the material of the sphere, the same cone the k vectors are
+        # sampled in (see sampled_kvectors_spherical_coordinates)
+        self.coneAlpha1, self.coneAlpha2 = sampling.cone_angles(0, self.NA_out, np.real(self.n))
+        # the sampled plane waves are weighted by subA / numSample, so their
+        # sum is subA times the average over the cone, the integral over the
+        # cone is scaled by subA over its solid angle to match it
+        self.coneScale = self.subA / (2 * np.pi * (np.cos(self.coneAlpha1) - np.cos(self.coneAlpha2)))
         # convert coordinates to cartesian if necessary
         # x, y, z = self.sph2cart(self.theta, self.phi, 1)
         
@@ -76,120 +99,74 @@ class mieScattering:
         self.kVec = self.k * self.magk
         # resolution of the image, number of pixels in one dimension, say 150
         self.res = res
-        # simulation resolution
-        # in order to do fft and ifft, expand the image use padding
-        self.simRes = self.res*(2*self.padding + 1)
-        # initialize a plane to evaluate the field
-        # halfgrid is the size of a half grid
-        self.halfgrid = np.ceil(self.fov/2)*(2*self.padding +1)
-        # range of x, y
-        gx = np.linspace(-self.halfgrid, +self.halfgrid-1, self.simRes)
-        gy = gx
         # option is the way the field is rendered
         # 'Horizontal' means the light is from inside of the screen to the outside
         # 'Vertical' means the light is from bottom of the screen to the top
         self.option = option
-        
-        if self.option == 'Horizontal':
-            # if it is a horizontal plane
-            [self.x, self.y] = np.meshgrid(gx, gy)
-            
-            # make it a plane at z = 0 on the Z axis
-            self.z = np.zeros((self.simRes, self.simRes,)) + pp
-            
-        elif self.option == 'Vertical':
-            # if it is a vertical plane
-            [self.y, self.z] = np.meshgrid(gx, gy)
-            
-            # make it a plane at x = 0 on the X axis 
-            self.x = np.zeros((self.simRes, self.simRes,))
-        
-        # initialize r vectors in the space
-        self.rVecs = np.zeros((self.simRes, self.simRes, 3))
-        # make x, y, z components
-        self.rVecs[:,:,0] = self.x
-        self.rVecs[:,:,1] = self.y
-        self.rVecs[:,:,2] = self.z
+        # the plane to evaluate the field, shared by all the spheres rendered
+        # on it together with its coordinates and filters (see mietools.geometry)
+        if plane is None:
+            plane = geometry.get_plane(res, self.fov, self.padding, pp, option)
+        self.plane = plane
+        # simulation resolution
+        # in order to do fft and ifft, expand the image use padding
+        self.simRes = plane.simRes
+        # halfgrid is the size of a half grid
+        self.halfgrid = plane.halfgrid
+        # keep the axes of the plane for finding its mirror symmetry
+        self.gx = plane.gx
+        self.gy = plane.gy
+        # number of sampled plane waves evaluated together in one batch
+        # if None, it is chosen to keep the working arrays under render.MAX_MEMORY
+        self.batchSize = batchSize
+        # memory budget of the field evaluation in bytes, the plane is
+        # evaluated in tiles of rows that fit in it, render.MAX_MEMORY if None
+        self.maxMemory = maxMemory
+        # number of rows of a tile, overrides maxMemory if given
+        self.tileSize = tileSize
+        # number of tiles evaluated at the same time on a thread pool
+        self.numWorkers = numWorkers
+        # evaluate fields that only depend on (kr, cos_theta) once for every
+        # unique pair of values, and look the other pixels up
+        self.radialLookup = radialLookup
+        # tolerance of the number of orders of the spherical bessel sums,
+        # picked per pixel from kr (see render.truncated_bessel_sum), None
+        # sums all the orders everywhere
+        self.orderTol = orderTol
+        # focus.FocusedFieldCache shared by the spheres of a scene, the focused
+        # field of a horizontal plane is interpolated from its radial profile
+        # there, None evaluates it at every pixel
+        self.focusCache = focusCache
+        
+        # the coordinates broadcast to the plane, they are 1-D axes
+        self.x, self.y, self.z = plane.coordinates
+        # r vectors in the space
+        self.rVecs = plane.rVecs
         # compute the rvector relative to the sphere
-        self.rVecs_ps = self.rVecs - self.ps
+        self.rVecs_ps = plane.relative(self.ps)
         # calculate the distance matrix
-        self.rMag = np.sqrt(np.sum(self.rVecs_ps ** 2, 2))
+        self.rMag = plane.distance(self.ps)
         # calculate a bandpass filter
-        self.bpf = self.BPF(self.halfgrid, self.simRes, self.NA_in, self.NA_out)
+        self.bpf = plane.bandpass(self.NA_in, self.NA_out, self.lambDa)
         # k vectors sampled from monte carlo sampling
         self.k_j = k_j
+        # quadrature weights of the k vectors, from sampling.cone_quadrature
+        # rescaled to sum up to subA, if None, every k vector is weighted by
+        # subA / numSample
+        self.k_w = k_w
 
 
-    def sampled_kvectors_spherical_coordinates(self, NA_in, NA_out, NumSample, kd):
+    def sampled_kvectors_spherical_coordinates(self, NA_in, NA_out, NumSample, kd, seed = None):
     #sample multiple planewaves at different angle to do simulation as a focused beam
-        # return a list of planewave direction vectors Kd
-        # and the corresponding scale factor if using uniform sampling
+        # return a list of planewave direction vectors Kd, shape (3, NumSample)
         # NA: numberical aperture of the lens which planewaves are focused from
         # NumSample: number of samples(planewaves)
         # kd: center planewave of the focused beam
+        # seed: seed or numpy.random.Generator for the Monte Carlo sampling
         
-        #allocatgge space for the field and initialize it to zero
-        start3 = time.time()
-        CenterKd = self.k                                       #defualt planewave coming in perpendicular to the surface
-        kd = kd / np.linalg.norm(kd)                                #normalize the new planewave
-        r = np.sqrt(CenterKd[0] ** 2 + CenterKd[1] ** 2 + CenterKd[2] ** 2)             #radiance of the hemisphere where the k vectors are sampled from
-        
-        if(kd[0] == CenterKd[0] and kd[1] == CenterKd[1] and kd[2] == CenterKd[2]):     #if new planewave is at the same direction as the default plane wave
-            rotateAxis = CenterKd                                   #set rotation axis as defualt k vector
-            RoAngle = 0                                             #set rotation axis as 0 degrees
-        else:                                                       #if new plane wave is at different direction as the defualt planewave, rotation is needed
-            rotateAxis = np.cross(CenterKd, kd)                     #find a axis which is perpendicular to both vectors to be rotation axis
-            RoAngle = math.asin(kd[2] / r)                          #calculate the rotation angle
-        beamRotate = Quaternion(axis=rotateAxis, angle=RoAngle)     #create a quaternion for rotation
-        
-        Kd = np.zeros((3, NumSample))                               #initialize the planewave list
-#        scaleFactor = np.zeros(NumSample)                          #initialize a list of scalefactors which are used to scale down the amplitude of planewaves later on along latitude domain
-        
-        #convert the axis from Cartesian to Spherical
-        pha = math.acos(CenterKd[2] / r)                            #calculate polar angle pha from Z coordinate
-        
-        phaM = math.asin(NA_out / np.real(self.n))                  #calculate sample range of pha from numerical aperture
-        
-        inZ = np.cos(pha)                                           #lower boundary of sampling along Z axis
-        outZ = np.cos(phaM)                                         #upper boundary of sampling along Z axis
-        
-        rangeZ = np.abs(inZ) - np.abs(outZ)                         #sampling range along Z axis
-        
-        
-#        phaStep = phaM / NumSample                                  #set longitudinal sample resolution as maximal pha divided by number of samples
-#        thetaStep = thetaM / NumSample                              #set latitudinal sample resolution as maximal theta divided by number of samples
-        
-        ###following is uniform sampling
-#        for i in range(NumSample):                                  #sample along longitudinal (pha) domain
-#            for j in range(NumSample):                              #sample along latitudinal (theta) domain
-#                KdR = r                                             #sample hemisphere radiance will be all the same as r
-#                KdTheta = theta + thetaStep * j                     #sample theta at each step in the sample range
-#                KdPha = pha + phaStep * i                           #sample theta at each step in the sample range
-#                Kd[0,j,i] = KdR * np.cos(KdTheta) * np.sin(KdPha)   #convert coordinates from spherical to Cartesian
-#                Kd[1,j,i] = KdR * np.sin(KdTheta) * np.sin(KdPha)
-#                Kd[2,j,i] = KdR * np.cos(KdPha)
-#                Kd[:,j,i] = beamRotate.rotate(Kd[:,j,i])            #rotate k vectors by the quaternion generated
-#                scaleFactor[j,i] = np.sin(KdPha)                    #calculate the scalefactors by the current polar angle pha
-#        
-        
-        ###here comes Monte Carlo Sampling
-        for i in range(NumSample):                                  
-            KdR = r                                                 #the r coordinate of the vector under spherical system
-            KdTheta = random.random() * 2 * np.pi                   #get a random value for theta coordinate under spherical system
-            KdZ = random.random() * rangeZ + inZ                    #get a random value for Z coordinate under cartesian system
-            KdPha = math.acos(KdZ)                                  #convert it back to spherical system
-            Kd[0,i] = KdR * np.cos(KdTheta) * np.sin(KdPha)         #convert coordinates from spherical to Cartesian
-            Kd[1,i] = KdR * np.sin(KdTheta) * np.sin(KdPha)         #the reason why we sample Z at cartesian is that we want the vectors to distribute randomly on that direction
-            Kd[2,i] = KdR * np.cos(KdPha)                           #if we sample it on phi domain, they will be denser towards center
-            Kd[:,i] = beamRotate.rotate(Kd[:,i])                    #rotate k vectors by the quaternion generated
-        
-#        Kd = np.reshape(Kd, ((3, NumSample ** 2)))
-#        scaleFactor = np.reshape(scaleFactor, ((NumSample ** 2)))   #reshape list of k vectors and scalefactors to an one dimentional list
-        
-        end3 = time.time()
-        print("sample planewaves: " + str(end3 - start3) + " s\n")
-        
-        return Kd
+        # the cone starts from the center planewave, and its outer angle
+        # is taken inside the material of the sphere
+        return sampling.sample_kvectors(kd, 0, NA_out, NumSample, seed, np.real(self.n))
     
     
     def Legendre(self, order, x):
@@ -252,76 +229,24 @@ class mieScattering:
         return x, y, z
     
     
-    def sphbesselj(self, order, x, mode):
-    #calculate the spherical bessel function of the 1st kind with order specified
-        #order: the order to be calculated
-        #x: the variable to be calculated
-        #mode: 1 stands for prime, -1 stands for derivative, 0 stands for nothing
-            if np.isscalar(x):
-                return np.sqrt(np.pi / (2*x)) * sp.special.jv(order + 0.5 + mode, x)
-            
-            elif np.asarray(x).ndim == 1:
-                ans = np.zeros((len(x), len(order) + 1), dtype = np.complex128)
-                for i in range(len(order)):
-                    ans[:,i] = np.sqrt(np.pi / (2*x)) * sp.special.jv(i + 0.5 + mode, x)
-                return ans
-            
-            else:
-                ans = np.zeros((x.shape + (len(order),)), dtype = np.complex128)
-                for i in range(len(order)):
-                    ans[...,i] = np.sqrt(np.pi / (2*x)) * sp.special.jv(i + 0.5 + mode, x)
-                return ans
-            
-            
-            
-    def sphhankel(self, order, x, mode):
-    #general form of calculating spherical hankel functions of the first kind at x
-        
-        if np.isscalar(x):
-            return np.sqrt(np.pi / (2*x)) * (sp.special.jv(order + 0.5 + mode, x) + 1j * sp.special.yv(order + 0.5 + mode, x))
-    #
-            
-        elif np.asarray(x).ndim == 1:
-            ans = np.zeros((len(x), len(order)), dtype = np.complex128)
-            for i in range(len(order)):
-                ans[:,i] = np.sqrt(np.pi / (2*x)) * (sp.special.jv(i + 0.5 + mode, x) + 1j * sp.special.yv(i + 0.5 + mode, x))
-            return ans
-        else:
-            ans = np.zeros((x.shape + (len(order),)), dtype = np.complex128)
-            for i in range(len(order)):
-                ans[...,i] = np.sqrt(np.pi / (2*x)) * (sp.special.jv(i + 0.5 + mode, x) + 1j * sp.special.yv(i + 0.5 + mode, x))
-            return ans
-        
-    
-    #derivative of the spherical bessel function of the first kind
-    def derivSphBes(self, order, x):
-        js_n = np.zeros(order.shape, dtype = np.complex128)
-        js_n_m_1 = np.zeros(order.shape, dtype = np.complex128)
-        js_n_p_1 = np.zeros(order.shape, dtype = np.complex128)
-        
-        js_n = self.sphbesselj(order, x, 0)
-        js_n_m_1 = self.sphbesselj(order, x, -1)
-        js_n_p_1 = self.sphbesselj(order, x, 1)
-        
-        j_p = 1/2 * (js_n_m_1 - (js_n + x * js_n_p_1) / x)
-        return j_p
-    
-    #derivative of the spherical hankel function of the first kind
-    def derivSphHan(self, order, x):
-        sh_n = np.zeros(order.shape, dtype = np.complex128)
-        sh_n_m_1 = np.zeros(order.shape, dtype = np.complex128)
-        sh_n_p_1 = np.zeros(order.shape, dtype = np.complex128)
+    def planeSymmetry(self, symmetry, symmetric):
+    #mirror symmetry of the plane around the axis of the sphere along k
+        #symmetry: None to detect it, or 1, 2, 4 or 8 (see render.mirror_pixels)
+        #symmetric: whether the field is symmetric around that axis
+        #return the symmetry used to evaluate the plane
+        
+        #the field is only symmetric around the axis for on-axis incidence
+        symmetric = symmetric and self.k[0] == 0 and self.k[1] == 0
+        if self.option == 'Horizontal':
+            #mirrors in x and y, and the transpose
+            return render.plane_symmetry(self.gx - self.ps[0], self.gy - self.ps[1], symmetry, symmetric)
+        #the vertical plane contains k, only the mirror in y is left
+        return render.plane_symmetry(self.gx - self.ps[1], self.gy - self.ps[2], symmetry, symmetric, max_symmetry = 2)
     
-        sh_n = self.sphhankel(order, x, 0)
-        sh_n_m_1 = self.sphhankel(order, x, -1)
-        sh_n_p_1 = self.sphhankel(order, x, 1)
-        
-        h_p = 1/2 * (sh_n_m_1 - (sh_n + x * sh_n_p_1) / x)
-        return h_p
     
-        
-    def calFocusedField(self, simRes, magk, rMag):
+    def calFocusedField(self, simRes, magk, rMag, symmetry = None):
     #calculate a focused beam from the paramesters specified
+        #symmetry: mirror symmetry used to evaluate the plane, None to detect it
         #the order of functions for calculating focused field
         start2 = time.time()
         orderEf = 100
@@ -340,31 +265,39 @@ class mieScattering:
         rMag = np.sqrt(np.sum(self.rVecs_ps**2, 2))
         rNorm = self.rVecs_ps / rMag[...,None]
         cosTheta = np.dot(rNorm, kNorm)
-
-        #compute spherical bessel function at kr
-        jlkr= self.sphbesselj(ordVec, magk*rMag, 0)
-        
-        #compute legendre polynomial of all r vector
-        plCosTheta = self.Legendre(orderEf, cosTheta)
-        
-        #product of them
-        jlkrPlCosTheta = jlkr * plCosTheta
-        
-        il = il.reshape((1, 1, orderEf+1))
-        iljlkrplcost = jlkrPlCosTheta * il
-        
-        order = 0
-        
-        iljlkrplcost[:,:,order] *= (plCosAlpha1[order+1]-plCosAlpha2[order+1]-plCosAlpha1[0]+plCosAlpha2[0])
-        
-        order = 1
-        
-        iljlkrplcost[:,:,order] *= (plCosAlpha1[order+1]-plCosAlpha2[order+1]-plCosAlpha1[0]+plCosAlpha2[0])
-            
-        iljlkrplcost[:,:,2:] = iljlkrplcost[:,:,2:] * np.squeeze(plCosAlpha1[3:]-plCosAlpha2[3:]-plCosAlpha1[1:orderEf]+plCosAlpha2[1:orderEf])[None, None,...]
         
-        #sum up all orders
-        Ef = 2*np.pi*self.E0*np.sum(iljlkrplcost, axis = 2)
+        #integral of each order over the condenser, P_(l+1) - P_(l-1)
+        #between the two angles, where P_(-1) = P_0 for order 0
+        plCosAlpha = np.ravel(plCosAlpha1 - plCosAlpha2)
+        condenser = plCosAlpha[ordVec+1] - plCosAlpha[np.maximum(ordVec-1, 0)]
+        
+        #sum up the orders each pixel needs, the spherical bessel functions of
+        #kr and the legendre polynomials are generated inside the sum order by order
+        def focused(r, cos_theta):
+            return 2*np.pi*self.E0*render.truncated_bessel_sum(magk*r, il * condenser, cos_theta = cos_theta,
+                                                               tol = self.orderTol)
+        
+        if self.focusCache is not None and self.option == 'Horizontal' and self.k[0] == 0 and self.k[1] == 0:
+            #the plane is perpendicular to the axis of the condenser, so the
+            #field is a radial profile around the sphere at the depth of the
+            #plane, shared by every sphere at that depth
+            depth = self.rVecs_ps[0, 0, 2]
+            rho = np.sqrt(self.rVecs_ps[..., 0]**2 + self.rVecs_ps[..., 1]**2)
+            def profile(rho, z):
+                r = np.sqrt(rho**2 + z**2)
+                return focused(r, kNorm[2] * z / r)
+            key = (self.NA_in, self.NA_out, self.lambDa, tuple(self.k), self.E0, orderEf, self.orderTol)
+            Ef = self.focusCache.field(key, rho, depth, magk, profile)
+        else:
+            #the focused field is symmetric around the axis of the sphere, so
+            #only one part of a symmetric plane is evaluated
+            index, inverse = render.mirror_pixels(simRes, simRes, self.planeSymmetry(symmetry, True))
+            #it only depends on rMag and cosTheta, so with the lookup it is
+            #evaluated once for every unique pair of them
+            if self.radialLookup:
+                u_index, u_inverse = render.unique_pixels(np.ravel(rMag)[index], np.ravel(cosTheta)[index])
+                index, inverse = index[u_index], u_inverse[inverse]
+            Ef = focused(np.ravel(rMag)[index], np.ravel(cosTheta)[index])[inverse]
         
         end2 = time.time()
         print("get focused field: " + str(end2 - start2) + " s\n")
@@ -401,7 +334,7 @@ class mieScattering:
                 cosTheta[i, j] = np.dot(kNorm, rNorm[i, j, :])
         
         #compute spherical bessel function at kr
-        jlkr= self.sphbesselj(ordVec, magk*rMag, 0)
+        jlkr = special.sph_jn(orderEf, magk*rMag)
         
         #compute legendre polynomial of all r vector
         plCosTheta = self.Legendre(orderEf, cosTheta)
@@ -429,9 +362,31 @@ class mieScattering:
         
         return Ef
     
-    def scatterednInnerField(self, lambDa, magk, n, rMag):
+    def scatterednInnerField(self, lambDa, magk, n, rMag, method = 'montecarlo', tol = 1e-2, seed = None, state = None,
+                             symmetry = None):
         start2 = time.time()
         #calculate and return a focused field and the corresponding scattering field and internal field
+        #method: 'montecarlo' sums the sampled plane waves in self.k_j, weighted by self.k_w
+        #        rescaled to subA
+        #        'analytic' integrates the cone of the sampled plane waves exactly,
+        #        no sampling needed. It is the cone of every method, from the
+        #        center planewave to asin(NA_out / real(n)), see self.coneAlpha2
+        #        'adaptive' samples new plane waves in batches until the relative error
+        #        estimate is below tol, using at most self.numSample plane waves.
+        #        The plane waves used and the error reached are kept in
+        #        self.k_j, self.numSample and self.mcError. Its error is estimated
+        #        over the whole plane, so it is not split into tiles of rows
+        #seed: seed or numpy.random.Generator for the 'adaptive' sampling
+        #state: running sums of an earlier 'adaptive' render of the same plane
+        #       (self.mcState, or render.load_state of a saved one), the render
+        #       continues from it instead of starting over. A state that keeps
+        #       its random sequence continues that sequence, so no seed can be
+        #       given with it
+        #symmetry: mirror symmetry used to evaluate the plane, 1, 2, 4 or 8
+        #          (see render.mirror_pixels). None uses the symmetry of the
+        #          plane for the 'analytic' method with the sphere on the
+        #          optical axis. A symmetry given for 'montecarlo' mirrors the
+        #          sampled field. 'adaptive' always evaluates the whole plane
         #maximal number of orders used to calculate Es and Ei
         numOrd = math.ceil(2*np.pi * self.a / lambDa + 4 * (2 * np.pi * self.a / lambDa) ** (1/3) + 2)
         #create an order vector
@@ -440,102 +395,141 @@ class mieScattering:
         twolplus1 = 2 * ordVec + 1
         il = 1j ** ordVec
         twolplus1_il = twolplus1 * il
-        #compute the arguments for spherical bessel functions, hankel functions and thier derivatives
-        ka = magk * self.a
-        kna = magk * n * self.a
-        #number of samples
-        
-        
-        #evaluate the spherical bessel functions of the first kind at ka
-        jl_ka = self.sphbesselj(ordVec, ka, 0)
-        
-        #evaluate the derivative of the spherical bessel functions of the first kind at kna
-        jl_kna_p = self.derivSphBes(ordVec, kna)
-        
-        #evaluate the spherical bessel functions of the first kind at kna
-        
-        jl_kna = self.sphbesselj(ordVec, kna, 0)
-        
-        #evaluate the derivative of the spherical bessel functions of the first kind of ka
-        jl_ka_p = self.derivSphBes(ordVec, ka)
+        #look the coefficients of the sphere up in the coefficient cache, they
+        #are only evaluated the first time this sphere is rendered
+        B, A = coefficients.mie_coefficients(n, self.a, lambDa, numOrd)
         
-        #compute the numerator for B coefficients
-        numB = jl_ka * jl_kna_p * n - jl_kna * jl_ka_p
-        
-        #evaluate the hankel functions of the first kind at ka
-        hl_ka = self.sphhankel(ordVec, ka, 0)
-        
-        #evaluate the derivative of the hankel functions of the first kind at ka
-        hl_ka_p = self.derivSphHan(ordVec, ka)
-        
-        #compute the denominator for coefficient A and B
-        denAB = jl_kna * hl_ka_p - hl_ka * jl_kna_p * n
-        
-        #compute B
-        B = np.asarray(twolplus1_il * (numB / denAB), dtype = np.complex128)
-        B = np.reshape(B, (1, 1, numOrd + 1))
-        
-        #compute the numerator of the scattering coefficient A
-        numA = jl_ka * hl_ka_p - jl_ka_p * hl_ka
-        
-        #compute A
-        A = np.asarray(twolplus1_il * (numA / denAB), dtype = np.complex128)
-        A = np.reshape(A, (1, 1, numOrd + 1))
+        #the coefficients of the scattering field and the internal field
+        B = twolplus1_il * B
+        A = twolplus1_il * A
         
         #normalize r vector 
         rNorm = self.rVecs_ps / rMag[..., None]
         #computer k*r term
         kr = magk * rMag
         
-        #compute the spherical hankel function of the first kind for kr
-        hl_kr = self.sphhankel(ordVec, kr, 0)
-        
         #computer k*n*r term
         knr = kr * n
         
-        #compute the spherical bessel function of the first kind for knr
-        jl_knr = self.sphbesselj(ordVec, knr, 0)
-        
         #compute the distance from the center of the sphere to the focal point/ origin
         #used for calculating phase shift later
         c = self.ps - self.pf
         
-        #initialize Ei and Es field
-        Ei = np.zeros((self.simRes, self.simRes), dtype = np.complex128)
-        Es = np.zeros((self.simRes, self.simRes), dtype = np.complex128)
-        
         #a list of sampled k vectors
 #        k_j = self.sampled_kvectors_spherical_coordinates(self.NA_in, self.NA_out, self.numSample, self.lightdirection)
         
+        #memory budget, half of it for the tiles of the plane and half for
+        #the plane wave batches of render.angular_sum inside the tiles
+        memory = render.MAX_MEMORY if self.maxMemory is None else self.maxMemory
+        
         start4 = time.time()
-        for k_index in range(self.numSample):
-            # for all the sampled vectors
-            # compute the angle between k and r vectors
-            cos_theta = np.zeros((rMag.shape))
-            cos_theta = np.dot(rNorm, self.k_j[:,k_index])
-            # compute the mathmatical terms
-            pl_costheta = self.Legendre(numOrd, cos_theta)
-            hlkr_plcostheta = hl_kr * pl_costheta
-            jlknr_plcostheta = jl_knr * pl_costheta
-            # compute the phase shift
-            phase = np.exp(1j * magk * np.dot(self.k_j[:, k_index], c))
-            # add to the final field
-            Es += phase * np.sum(hlkr_plcostheta * B, axis = 2)
-            Ei += phase * np.sum(jlknr_plcostheta * A, axis = 2)
+        if method == 'montecarlo':
+            # compute the phase shift of every sampled plane wave
+            phase = np.exp(1j * magk * np.dot(c, self.k_j))
+            # weight of every plane wave
+            if self.k_w is None:
+                phase *= (self.subA / self.numSample)
+            else:
+                # the quadrature weights sum up to the solid angle of their
+                # cone, rescale them to subA like the monte carlo weights
+                k_w = np.asarray(self.k_w)
+                phase *= k_w * (self.subA / np.sum(k_w))
+            # sum the legendre polynomials of all the sampled plane waves in batches
+            angular = lambda r: render.angular_sum(r, self.k_j, phase, numOrd, self.batchSize,
+                                                   memory / 2 / max(1, self.numWorkers))
+        elif method == 'analytic':
+            # integrate the legendre polynomials over the condenser cone
+            angular = lambda r: self.coneScale * render.condenser_sum(r, self.k, c, magk, numOrd,
+                                                                      self.coneAlpha1, self.coneAlpha2)
+        elif method != 'adaptive':
+            raise ValueError("unknown method '" + str(method) + "', use 'montecarlo', 'analytic' or 'adaptive'")
+        
+        if method == 'adaptive':
+            # only one of the fields is kept at each pixel, so the error is
+            # estimated on the scattering field outside and the internal field inside
+            inside = rMag < self.a
+            terms = np.empty(rMag.shape + (numOrd + 1,), dtype = np.complex128)
+            terms[~inside] = special.sph_hn(numOrd, kr[~inside]) * B
+            if np.any(inside):
+                terms[inside] = special.sph_jn(numOrd, knr[inside]) * A
+            if state is not None and 'rng' in state:
+                # a new seed would draw the k vectors already in the saved
+                # sums again, which correlates the continued estimate with them
+                if seed is not None:
+                    raise ValueError("a state with a random sequence is continued from that sequence, do not give a seed")
+                # continue the random sequence of the saved render
+                rng = np.random.default_rng()
+                rng.bit_generator.state = json.loads(state['rng'])
+            else:
+                rng = np.random.default_rng(seed)
+            sampler = lambda num: self.sampled_kvectors_spherical_coordinates(self.NA_in, self.NA_out, num, self.k, rng)
+            Es, self.mcError, self.mcState = render.adaptive_sum(rNorm, terms, numOrd, sampler, c, magk, self.subA, tol,
+                                                                 batch_size = self.batchSize, max_samples = self.numSample,
+                                                                 max_memory = memory, state = state)
+            # keep the random sequence with the running sums, so saving
+            # self.mcState with render.save_state is enough to resume
+            self.mcState['rng'] = json.dumps(rng.bit_generator.state)
+            self.k_j = self.mcState['k_j']
+            self.numSample = self.mcState['count']
+            self.k_w = None
+            Ei = Es.copy()
+        else:
+            # for a sphere on the optical axis the analytic fields are
+            # symmetric around it, evaluate one part of a symmetric plane
+            symmetric = method == 'analytic' and render.on_axis(c, self.k)
+            index, inverse = render.mirror_pixels(self.simRes, self.simRes, self.planeSymmetry(symmetry, symmetric))
+            if symmetric and self.radialLookup:
+                # both fields only depend on kr and cos_theta then, evaluate
+                # them once for every unique pair
+                cosTheta = np.dot(rNorm, self.k / np.linalg.norm(self.k))
+                u_index, u_inverse = render.unique_pixels(np.ravel(kr)[index], np.ravel(cosTheta)[index])
+                index, inverse = index[u_index], u_inverse[inverse]
+            # the pixels evaluated, as flat lists
+            rNorm_u = np.reshape(rNorm, (-1, 3))[index]
+            kr_u = np.ravel(kr)[index]
+            knr_u = np.ravel(knr)[index]
+            # every pixel keeps only one of the fields, so each field is only
+            # evaluated on the pixels that stand for a pixel outside or inside
+            # the sphere, a plane that misses the sphere skips the internal field
+            inside = np.ravel(rMag < self.a)
+            outer_u = np.zeros(index.size, dtype = bool)
+            outer_u[np.ravel(inverse)[~inside]] = True
+            inner_u = np.zeros(index.size, dtype = bool)
+            inner_u[np.ravel(inverse)[inside]] = True
+            def field_rows(rows):
+                pl_costheta = angular(rNorm_u[rows])
+                E = np.zeros((pl_costheta.shape[0], 2), dtype = np.complex128)
+                # add to the final field
+                # the radial functions are generated inside the order sums, so only
+                # the summed legendre polynomials keep an order axis
+                outer, inner = outer_u[rows], inner_u[rows]
+                if np.all(outer):
+                    E[:, 0] = render.hankel_sum(kr_u[rows], B, angular = pl_costheta)
+                elif np.any(outer):
+                    E[outer, 0] = render.hankel_sum(kr_u[rows][outer], B, angular = pl_costheta[outer])
+                if np.any(inner):
+                    E[inner, 1] = render.truncated_bessel_sum(knr_u[rows][inner], A, angular = pl_costheta[inner],
+                                                              tol = self.orderTol)
+                return E
+            # evaluate the pixels in tiles of about tileSize rows of the plane,
+            # about four complex arrays of numOrd + 1 values per pixel are
+            # alive in a tile
+            tiles = render.tile_rows(index.size, 4 * 16 * (numOrd + 1), memory / 2,
+                                     None if self.tileSize is None else self.tileSize * self.simRes,
+                                     self.numWorkers)
+            E = render.map_tiles(field_rows, tiles, self.numWorkers)[inverse]
+            Es, Ei = E[..., 0], E[..., 1]
         
         end4 = time.time()
-        print("for loop inside rendering field: " + str(end4 - start4) + " s\n")
+        print("sum of plane waves: " + str(end4 - start4) + " s\n")
             
-        # scale the value down
-        Es *= (self.subA / self.numSample)
-        Ei *= (self.subA / self.numSample)
         # apply mask
         Emask = np.ones(((self.simRes, self.simRes)))
         Emask[rMag<self.a] = 0
         Es[rMag<self.a] = 0
         Ei[rMag>=self.a] = 0
         # calculate the focused field
-        Ef = self.calFocusedField(self.simRes, self.magk, rMag)
+        Ef = self.calFocusedField(self.simRes, self.magk, rMag, symmetry)
         # initaliza total E field
         Etot = np.zeros((self.simRes, self.simRes), dtype = np.complex128)
         # add different parts into the total field
@@ -547,46 +541,6 @@ class mieScattering:
         print("render field: " + str(end2 - start2) + " s\n")
         return Etot, Emask, Ef
     
-    def BPF(self, halfgrid, simRes, NA_in, NA_out):
-    #create a bandpass filter
-        #change coordinates into frequency domain    
-        df = 1/(halfgrid*2)
-        
-        iv, iu = np.meshgrid(np.arange(0, simRes, 1), np.arange(0, simRes, 1))
-        
-        u = np.zeros(iu.shape)
-        v = np.zeros(iv.shape)
-        
-        #initialize the filter as All Pass
-        BPF = np.ones(iv.shape)
-        
-        idex1, idex2 = np.where(iu <= simRes/2)
-        u[idex1, idex2] = iu[idex1, idex2]
-        
-        idex1, idex2 = np.where(iu > simRes/2)
-        u[idex1, idex2] = iu[idex1, idex2] - simRes +1
-        
-        u *= df
-        
-        idex1, idex2 = np.where(iv <= simRes/2)
-        v[idex1, idex2] = iv[idex1, idex2]
-        
-        idex1, idex2 = np.where(iv > simRes/2)
-        v[idex1, idex2] = iv[idex1, idex2] - simRes +1
-        
-        v *= df
-        
-        magf = np.sqrt(u ** 2 + v ** 2)
-        
-        #block lower frequency
-        idex1, idex2 = np.where(magf < NA_in / self.lambDa)
-        BPF[idex1, idex2] = 0
-        #block higher frequency
-        idex1, idex2 = np.where(magf > NA_out / self.lambDa)
-        BPF[idex1, idex2] = 0
-        
-        return BPF
-    
     def imgAtDetec(self, Etot, Ef):
         #2D fft to the total field
         Et_d = np.fft.fft2(Etot)
@@ -616,17 +570,24 @@ class mieScattering:
     
         return Et_bpf, Ef_bpf
         
-def getTotalField(k, k_j, n, res, a, ps, pp, numSample, NA_in, NA_out, option):
+def getTotalField(k, k_j, n, res, a, ps, pp, numSample, NA_in, NA_out, option, method = 'montecarlo', k_w = None, tol = 1e-2,
+                  maxMemory = None, tileSize = None, numWorkers = 1, radialLookup = True, orderTol = render.ORDER_TOL,
+                  focusCache = None, plane = None):
     #root function to get the final field by call other children functions
     
     #initialize a mie scattering object
-    MSI = mieScattering(k, k_j, n, res, a, ps, pp, numSample, NA_in, NA_out, option)  
+    MSI = mieScattering(k, k_j, n, res, a, ps, pp, numSample, NA_in, NA_out, option, k_w = k_w,
+                        maxMemory = maxMemory, tileSize = tileSize, numWorkers = numWorkers,
+                        radialLookup = radialLookup, orderTol = orderTol, focusCache = focusCache,
+                        plane = plane)  
     #get the field at the focal plane
-    Etot, Emask, Ef = MSI.scatterednInnerField(MSI.lambDa, MSI.magk, MSI.n, MSI.rMag)
+    Etot, Emask, Ef = MSI.scatterednInnerField(MSI.lambDa, MSI.magk, MSI.n, MSI.rMag, method, tol)
     #apply a bandpass filter to simulate the field on the detector
 #    D_Et, D_Ef = MSI.imgAtDetec(Etot, Ef)
 
-    return Etot, Emask, Ef
+    #the renderer is returned with the fields, it keeps the plane and the
+    #wavelength they were rendered with
+    return Etot, Emask, Ef, MSI
     
 
 k = [0, 0, -1]
@@ -642,24 +603,30 @@ n0 = 1.3 + 0.000258604 * 1j
 pp = 20
 #n0 = 1
 
-kObj = mieScattering(k, [], n0, res, 5, [0,0,0], 0, numSample, NA_in, NA_out, option)
-k_j = kObj.sampled_kvectors_spherical_coordinates(kObj.NA_in, kObj.NA_out, kObj.numSample, kObj.k)
+#the cone starts from the center planewave, its outer angle is taken inside the sphere
+k_j = sampling.sample_kvectors(k, 0, NA_out, numSample, None, np.real(n0))
+#the focused field of all the spheres comes from the same radial profiles
+focusCache = focus.FocusedFieldCache()
 #get the field for the center sphere (big)
 a0 = 12
 ps0 = [0, 0, 0]
-Et_0, Emask0, Ef0 = getTotalField(k, k_j, n0, res, a0, ps0, pp, numSample, NA_in, NA_out, option)
+Et_0, Emask0, Ef0, MSI0 = getTotalField(k, k_j, n0, res, a0, ps0, pp, numSample, NA_in, NA_out, option,
+                                        focusCache = focusCache)
 #get the field for the 1st sphere (small)
 a1 = 5
 ps1 = [-20, 0, 10]
-Et_1, Emask1, Ef1 = getTotalField(k, k_j, n0, res, a1, ps1, pp, numSample, NA_in, NA_out, option)
+Et_1, Emask1, Ef1, MSI1 = getTotalField(k, k_j, n0, res, a1, ps1, pp, numSample, NA_in, NA_out, option,
+                                        focusCache = focusCache)
 #get the field for the 2nd sphere (small)
 a2 = 4
 ps2 = [20, -20, 0]
-Et_2, Emask2, Ef2 = getTotalField(k, k_j, n0, res, a2, ps2, pp, numSample, NA_in, NA_out, option)
+Et_2, Emask2, Ef2, MSI2 = getTotalField(k, k_j, n0, res, a2, ps2, pp, numSample, NA_in, NA_out, option,
+                                        focusCache = focusCache)
 #get the field for the 3rd sphere (small)
 a3 = 3
 ps3 = [20, 20, -10]
-Et_3, Emask3, Ef3 = getTotalField(k, k_j, n0, res, a3, ps3, pp, numSample, NA_in, NA_out, option)
+Et_3, Emask3, Ef3, MSI3 = getTotalField(k, k_j, n0, res, a3, ps3, pp, numSample, NA_in, NA_out, option,
+                                        focusCache = focusCache)
 
 Et = Et_0 + Et_1 + Et_2 + Et_3
 #Et *= Emask1 * Emask2
@@ -700,4 +667,34 @@ plt.title('All Spheres')
 plt.axis('off')
 plt.colorbar()
 
-plt.suptitle('Image Plane at z = '+str(pp))
\ No newline at end of file
+plt.suptitle('Image Plane at z = '+str(pp))
+
+#%%
+# digital refocusing: propagate the total field to a stack of planes around
+# pp, the planes are streamed a batch at a time, so a long stack (e.g. 500
+# planes of 1024 x 1024) never has to be held in memory
+# stackPath: write the intensities to this memory mapped .npy volume if given
+stackPath = None
+# the renderer of the center sphere gives the plane and the wavelength the
+# fields were rendered with
+plane = MSI0.plane
+propagator = propagation.get_propagator(Et.shape, plane.simRes * (plane.gx[1] - plane.gx[0]), MSI0.magk)
+# depths to refocus to, the light travels along -z, so the plane at depth
+# zTarget is the field at pp propagated by pp - zTarget
+zTarget = np.linspace(-2 * pp, pp, numFrames)
+zRefocus = pp - zTarget
+
+if stackPath is None:
+    # keep only the sharpness (variance of the intensity) of every plane
+    sharpness = np.zeros(numFrames)
+    for zs, planes in propagator.stream(Et, zRefocus, output = 'intensity'):
+        sharpness[zs] = np.var(planes, axis = (1, 2))
+else:
+    stack = propagator.write_stack(stackPath, Et, zRefocus, output = 'intensity', dtype = np.float32)
+    sharpness = np.var(stack, axis = (1, 2))
+
+plt.figure()
+plt.plot(zTarget, sharpness)
+plt.xlabel('z of the refocused plane')
+plt.ylabel('variance of the intensity')
+plt.title('Digital Refocusing')
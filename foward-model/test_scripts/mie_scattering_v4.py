@@ -16,8 +16,6 @@ Editor:
 import numpy as np
 # matplotlib for ploting the images
 from matplotlib import pyplot as plt
-# pyquaternion for ratating the vectors
-from pyquaternion import Quaternion
 # scipy for input/output files
 import scipy as sp
 # math for calculations
@@ -26,14 +24,18 @@ import math
 from matplotlib import animation as animation
 # time for timing profiles
 import time
-# random for Monte Carlo Sampling
-import random
+# sampling for the Monte Carlo sampled k vectors
+from mietools import sampling
+# render for the batched plane wave accumulation
+from mietools import render
+# special for the spherical bessel and hankel functions of all orders
+from mietools import special
 
 
 class mieScattering:
     
     # parameters used to calculate the fields
-    def __init__(self, k, n, res, a, numSample, NA_in, NA_out, fov, option = 'Horizontal'):
+    def __init__(self, k, n, res, a, numSample, NA_in, NA_out, fov, option = 'Horizontal', batchSize = None):
         # n is the refractive index of the sphere. The n of the surrounding material is 1.0
         self.n = n
         # a is the radius of the sphere, for calculation precision perposes, 
@@ -86,6 +88,9 @@ class mieScattering:
         # 'Horizontal' means the light is from inside of the screen to the outside
         # 'Vertical' means the light is from bottom of the screen to the top
         self.option = option
+        # number of sampled plane waves evaluated together in one batch
+        # if None, it is chosen to keep the working arrays under render.MAX_MEMORY
+        self.batchSize = batchSize
         
         if self.option == 'Horizontal':
             # if it is a horizontal plane
@@ -115,76 +120,17 @@ class mieScattering:
         self.bpf = self.BPF(self.halfgrid, self.simRes, self.NA_in, self.NA_out)
 
 
-    def sampled_kvectors_spherical_coordinates(self, NA_in, NA_out, NumSample, kd):
+    def sampled_kvectors_spherical_coordinates(self, NA_in, NA_out, NumSample, kd, seed = None):
     #sample multiple planewaves at different angle to do simulation as a focused beam
-        # return a list of planewave direction vectors Kd
-        # and the corresponding scale factor if using uniform sampling
+        # return a list of planewave direction vectors Kd, shape (3, NumSample)
         # NA: numberical aperture of the lens which planewaves are focused from
         # NumSample: number of samples(planewaves)
         # kd: center planewave of the focused beam
+        # seed: seed or numpy.random.Generator for the Monte Carlo sampling
         
-        #allocatgge space for the field and initialize it to zero
-        start3 = time.time()
-        CenterKd = self.k                                       #defualt planewave coming in perpendicular to the surface
-        kd = kd / np.linalg.norm(kd)                                #normalize the new planewave
-        r = np.sqrt(CenterKd[0] ** 2 + CenterKd[1] ** 2 + CenterKd[2] ** 2)             #radiance of the hemisphere where the k vectors are sampled from
-        
-        if(kd[0] == CenterKd[0] and kd[1] == CenterKd[1] and kd[2] == CenterKd[2]):     #if new planewave is at the same direction as the default plane wave
-            rotateAxis = CenterKd                                   #set rotation axis as defualt k vector
-            RoAngle = 0                                             #set rotation axis as 0 degrees
-        else:                                                       #if new plane wave is at different direction as the defualt planewave, rotation is needed
-            rotateAxis = np.cross(CenterKd, kd)                     #find a axis which is perpendicular to both vectors to be rotation axis
-            RoAngle = math.asin(kd[2] / r)                          #calculate the rotation angle
-        beamRotate = Quaternion(axis=rotateAxis, angle=RoAngle)     #create a quaternion for rotation
-        
-        Kd = np.zeros((3, NumSample))                               #initialize the planewave list
-#        scaleFactor = np.zeros(NumSample)                          #initialize a list of scalefactors which are used to scale down the amplitude of planewaves later on along latitude domain
-        
-        #convert the axis from Cartesian to Spherical
-        pha = math.acos(CenterKd[2] / r)                            #calculate polar angle pha from Z coordinate
-        
-        phaM = math.asin(NA_out / np.real(self.n))                  #calculate sample range of pha from numerical aperture
-        
-        inZ = np.cos(pha)                                           #lower boundary of sampling along Z axis
-        outZ = np.cos(phaM)                                         #upper boundary of sampling along Z axis
-        
-        rangeZ = np.abs(inZ) - np.abs(outZ)                         #sampling range along Z axis
-        
-        
-#        phaStep = phaM / NumSample                                  #set longitudinal sample resolution as maximal pha divided by number of samples
-#        thetaStep = thetaM / NumSample                              #set latitudinal sample resolution as maximal theta divided by number of samples
-        
-        ###following is uniform sampling
-#        for i in range(NumSample):                                  #sample along longitudinal (pha) domain
-#            for j in range(NumSample):                              #sample along latitudinal (theta) domain
-#                KdR = r                                             #sample hemisphere radiance will be all the same as r
-#                KdTheta = theta + thetaStep * j                     #sample theta at each step in the sample range
-#                KdPha = pha + phaStep * i                           #sample theta at each step in the sample range
-#                Kd[0,j,i] = KdR * np.cos(KdTheta) * np.sin(KdPha)   #convert coordinates from spherical to Cartesian
-#                Kd[1,j,i] = KdR * np.sin(KdTheta) * np.sin(KdPha)
-#                Kd[2,j,i] = KdR * np.cos(KdPha)
-#                Kd[:,j,i] = beamRotate.rotate(Kd[:,j,i])            #rotate k vectors by the quaternion generated
-#                scaleFactor[j,i] = np.sin(KdPha)                    #calculate the scalefactors by the current polar angle pha
-#        
-        
-        ###here comes Monte Carlo Sampling
-        for i in range(NumSample):                                  
-            KdR = r                                                 #the r coordinate of the vector under spherical system
-            KdTheta = random.random() * 2 * np.pi                   #get a random value for theta coordinate under spherical system
-            KdZ = random.random() * rangeZ + inZ                    #get a random value for Z coordinate under cartesian system
-            KdPha = math.acos(KdZ)                                  #convert it back to spherical system
-            Kd[0,i] = KdR * np.cos(KdTheta) * np.sin(KdPha)         #convert coordinates from spherical to Cartesian
-            Kd[1,i] = KdR * np.sin(KdTheta) * np.sin(KdPha)         #the reason why we sample Z at cartesian is that we want the vectors to distribute randomly on that direction
-            Kd[2,i] = KdR * np.cos(KdPha)                           #if we sample it on phi domain, they will be denser towards center
-            Kd[:,i] = beamRotate.rotate(Kd[:,i])                    #rotate k vectors by the quaternion generated
-        
-#        Kd = np.reshape(Kd, ((3, NumSample ** 2)))
-#        scaleFactor = np.reshape(scaleFactor, ((NumSample ** 2)))   #reshape list of k vectors and scalefactors to an one dimentional list
-        
-        end3 = time.time()
-        print("sample planewaves: " + str(end3 - start3) + " s\n")
-        
-        return Kd
+        # the cone starts from the center planewave, and its outer angle
+        # is taken inside the material of the sphere
+        return sampling.sample_kvectors(kd, 0, NA_out, NumSample, seed, np.real(self.n))
     
     
     def Legendre(self, order, x):
@@ -247,74 +193,6 @@ class mieScattering:
         return x, y, z
     
     
-    def sphbesselj(self, order, x, mode):
-    #calculate the spherical bessel function of the 1st kind with order specified
-        #order: the order to be calculated
-        #x: the variable to be calculated
-        #mode: 1 stands for prime, -1 stands for derivative, 0 stands for nothing
-            if np.isscalar(x):
-                return np.sqrt(np.pi / (2*x)) * sp.special.jv(order + 0.5 + mode, x)
-            
-            elif np.asarray(x).ndim == 1:
-                ans = np.zeros((len(x), len(order) + 1), dtype = np.complex128)
-                for i in range(len(order)):
-                    ans[:,i] = np.sqrt(np.pi / (2*x)) * sp.special.jv(i + 0.5 + mode, x)
-                return ans
-            
-            else:
-                ans = np.zeros((x.shape + (len(order),)), dtype = np.complex128)
-                for i in range(len(order)):
-                    ans[...,i] = np.sqrt(np.pi / (2*x)) * sp.special.jv(i + 0.5 + mode, x)
-                return ans
-            
-            
-            
-    def sphhankel(self, order, x, mode):
-    #general form of calculating spherical hankel functions of the first kind at x
-        
-        if np.isscalar(x):
-            return np.sqrt(np.pi / (2*x)) * (sp.special.jv(order + 0.5 + mode, x) + 1j * sp.special.yv(order + 0.5 + mode, x))
-    #
-            
-        elif np.asarray(x).ndim == 1:
-            ans = np.zeros((len(x), len(order) + 1), dtype = np.complex128)
-            for i in range(len(order)):
-                ans[:,i] = np.sqrt(np.pi / (2*x)) * (sp.special.jv(i + 0.5 + mode, x) + 1j * sp.special.yv(i + 0.5 + mode, x))
-            return ans
-        else:
-            ans = np.zeros((x.shape + (len(order),)), dtype = np.complex128)
-            for i in range(len(order)):
-                ans[...,i] = np.sqrt(np.pi / (2*x)) * (sp.special.jv(i + 0.5 + mode, x) + 1j * sp.special.yv(i + 0.5 + mode, x))
-            return ans
-        
-    
-    #derivative of the spherical bessel function of the first kind
-    def derivSphBes(self, order, x):
-        js_n = np.zeros(order.shape, dtype = np.complex128)
-        js_n_m_1 = np.zeros(order.shape, dtype = np.complex128)
-        js_n_p_1 = np.zeros(order.shape, dtype = np.complex128)
-        
-        js_n = self.sphbesselj(order, x, 0)
-        js_n_m_1 = self.sphbesselj(order, x, -1)
-        js_n_p_1 = self.sphbesselj(order, x, 1)
-        
-        j_p = 1/2 * (js_n_m_1 - (js_n + x * js_n_p_1) / x)
-        return j_p
-    
-    #derivative of the spherical hankel function of the first kind
-    def derivSphHan(self, order, x):
-        sh_n = np.zeros(order.shape, dtype = np.complex128)
-        sh_n_m_1 = np.zeros(order.shape, dtype = np.complex128)
-        sh_n_p_1 = np.zeros(order.shape, dtype = np.complex128)
-    
-        sh_n = self.sphhankel(order, x, 0)
-        sh_n_m_1 = self.sphhankel(order, x, -1)
-        sh_n_p_1 = self.sphhankel(order, x, 1)
-        
-        h_p = 1/2 * (sh_n_m_1 - (sh_n + x * sh_n_p_1) / x)
-        return h_p
-    
-        
     def calFocusedField(self, simRes, magk, rMag):
     #calculate a focused beam from the paramesters specified
         #the order of functions for calculating focused field
@@ -335,31 +213,15 @@ class mieScattering:
         rMag = np.sqrt(np.sum(self.rVecs_ps**2, 2))
         rNorm = self.rVecs_ps / rMag[...,None]
         cosTheta = np.dot(rNorm, kNorm)
-
-        #compute spherical bessel function at kr
-        jlkr= self.sphbesselj(ordVec, magk*rMag, 0)
         
-        #compute legendre polynomial of all r vector
-        plCosTheta = self.Legendre(orderEf, cosTheta)
+        #integral of each order over the condenser, P_(l+1) - P_(l-1)
+        #between the two angles, where P_(-1) = P_0 for order 0
+        plCosAlpha = np.ravel(plCosAlpha1 - plCosAlpha2)
+        condenser = plCosAlpha[ordVec+1] - plCosAlpha[np.maximum(ordVec-1, 0)]
         
-        #product of them
-        jlkrPlCosTheta = jlkr * plCosTheta
-        
-        il = il.reshape((1, 1, orderEf+1))
-        iljlkrplcost = jlkrPlCosTheta * il
-        
-        order = 0
-        
-        iljlkrplcost[:,:,order] *= (plCosAlpha1[order+1]-plCosAlpha2[order+1]-plCosAlpha1[0]+plCosAlpha2[0])
-        
-        order = 1
-        
-        iljlkrplcost[:,:,order] *= (plCosAlpha1[order+1]-plCosAlpha2[order+1]-plCosAlpha1[0]+plCosAlpha2[0])
-            
-        iljlkrplcost[:,:,2:] = iljlkrplcost[:,:,2:] * np.squeeze(plCosAlpha1[3:]-plCosAlpha2[3:]-plCosAlpha1[1:orderEf]+plCosAlpha2[1:orderEf])[None, None,...]
-        
-        #sum up all orders
-        Ef = 2*np.pi*self.E0*np.sum(iljlkrplcost, axis = 2)
+        #sum up all orders, the spherical bessel functions of kr and the
+        #legendre polynomials are generated inside the sum order by order
+        Ef = 2*np.pi*self.E0*render.bessel_sum(magk*rMag, il * condenser, cos_theta = cosTheta)
         
         end2 = time.time()
         print("get focused field: " + str(end2 - start2) + " s\n")
@@ -396,7 +258,7 @@ class mieScattering:
                 cosTheta[i, j] = np.dot(kNorm, rNorm[i, j, :])
         
         #compute spherical bessel function at kr
-        jlkr= self.sphbesselj(ordVec, magk*rMag, 0)
+        jlkr = special.sph_jn(orderEf, magk*rMag)
         
         #compute legendre polynomial of all r vector
         plCosTheta = self.Legendre(orderEf, cosTheta)
@@ -441,85 +303,58 @@ class mieScattering:
         #number of samples
         
         
-        #evaluate the spherical bessel functions of the first kind at ka
-        jl_ka = self.sphbesselj(ordVec, ka, 0)
-        
-        #evaluate the derivative of the spherical bessel functions of the first kind at kna
-        jl_kna_p = self.derivSphBes(ordVec, kna)
-        
-        #evaluate the spherical bessel functions of the first kind at kna
+        #evaluate the spherical bessel functions of the first kind and their derivatives at ka
+        jl_ka, jl_ka_p = special.sph_jn(numOrd, ka, True)
         
-        jl_kna = self.sphbesselj(ordVec, kna, 0)
-        
-        #evaluate the derivative of the spherical bessel functions of the first kind of ka
-        jl_ka_p = self.derivSphBes(ordVec, ka)
+        #evaluate the spherical bessel functions of the first kind and their derivatives at kna
+        jl_kna, jl_kna_p = special.sph_jn(numOrd, kna, True)
         
         #compute the numerator for B coefficients
         numB = jl_ka * jl_kna_p * n - jl_kna * jl_ka_p
         
-        #evaluate the hankel functions of the first kind at ka
-        hl_ka = self.sphhankel(ordVec, ka, 0)
-        
-        #evaluate the derivative of the hankel functions of the first kind at ka
-        hl_ka_p = self.derivSphHan(ordVec, ka)
+        #evaluate the hankel functions of the first kind and their derivatives at ka
+        hl_ka, hl_ka_p = special.sph_hn(numOrd, ka, True)
         
         #compute the denominator for coefficient A and B
         denAB = jl_kna * hl_ka_p - hl_ka * jl_kna_p * n
         
         #compute B
         B = np.asarray(twolplus1_il * (numB / denAB), dtype = np.complex128)
-        B = np.reshape(B, (1, 1, numOrd + 1))
         
         #compute the numerator of the scattering coefficient A
         numA = jl_ka * hl_ka_p - jl_ka_p * hl_ka
         
         #compute A
         A = np.asarray(twolplus1_il * (numA / denAB), dtype = np.complex128)
-        A = np.reshape(A, (1, 1, numOrd + 1))
         
         #normalize r vector 
         rNorm = self.rVecs_ps / rMag[..., None]
         #computer k*r term
         kr = magk * rMag
         
-        #compute the spherical hankel function of the first kind for kr
-        hl_kr = self.sphhankel(ordVec, kr, 0)
-        
         #computer k*n*r term
         knr = kr * n
         
-        #compute the spherical bessel function of the first kind for knr
-        jl_knr = self.sphbesselj(ordVec, knr, 0)
-        
         #compute the distance from the center of the sphere to the focal point/ origin
         #used for calculating phase shift later
         c = self.ps - self.pf
         
-        #initialize Ei and Es field
-        Ei = np.zeros((self.simRes, self.simRes), dtype = np.complex128)
-        Es = np.zeros((self.simRes, self.simRes), dtype = np.complex128)
-        
         #a list of sampled k vectors
         k_j = self.sampled_kvectors_spherical_coordinates(self.NA_in, self.NA_out, self.numSample, self.k)
         
         start4 = time.time()
-        for k_index in range(self.numSample):
-            # for all the sampled vectors
-            # compute the angle between k and r vectors
-            cos_theta = np.zeros((rMag.shape))
-            cos_theta = np.dot(rNorm, k_j[:,k_index])
-            # compute the mathmatical terms
-            pl_costheta = self.Legendre(numOrd, cos_theta)
-            hlkr_plcostheta = hl_kr * pl_costheta
-            jlknr_plcostheta = jl_knr * pl_costheta
-            # compute the phase shift
-            phase = np.exp(1j * magk * np.dot(k_j[:, k_index], c))
-            # add to the final field
-            Es += phase * np.sum(hlkr_plcostheta * B, axis = 2)
-            Ei += phase * np.sum(jlknr_plcostheta * A, axis = 2)
+        # compute the phase shift of every sampled plane wave
+        phase = np.exp(1j * magk * np.dot(c, k_j))
+        # sum the legendre polynomials of all the sampled plane waves in batches
+        pl_costheta = render.angular_sum(rNorm, k_j, phase, numOrd, self.batchSize)
+        # add to the final field
+        # the radial functions are generated inside the order sums, so only
+        # the summed legendre polynomials keep an order axis
+        Es = render.hankel_sum(kr, B, angular = pl_costheta)
+        Ei = render.bessel_sum(knr, A, angular = pl_costheta)
         
         end4 = time.time()
-        print("for loop inside rendering field: " + str(end4 - start4) + " s\n")
+        print("sum of sampled plane waves: " + str(end4 - start4) + " s\n")
             
         # scale the value down
         Es *= (self.subA / self.numSample)
@@ -25,6 +25,8 @@ from matplotlib import animation as animation
 import time
 # random for Monte Carlo Sampling
 import random
+# coefficients for the cached Mie coefficients of the sphere
+from mietools import coefficients
 
 class planewave():
     #implement all features of a plane wave
@@ -64,8 +66,8 @@ class mieScattering:
     def __init__(self, k, k_j, n, res, a, ps, pp, padding, numSample, NA_in, NA_out, option = 'Horizontal'):
         # n is the refractive index of the sphere. The n of the surrounding material is 1.0
         self.n = n
-        # a is the radius of the sphere, for calculation precision perposes, 
-        # a should not be larger than twice the wavelength
+        # a is the radius of the sphere, the cached Mie coefficients stay accurate
+        # for large spheres as well (see mietools.coefficients)
         self.a = a
         # number of Monte Carlo sampling, 1000 is fine, simulation time cost grows linearly with this variable
         self.numSample = numSample
@@ -461,49 +463,15 @@ class mieScattering:
         twolplus1 = 2 * ordVec + 1
         il = 1j ** ordVec
         twolplus1_il = twolplus1 * il
-        #compute the arguments for spherical bessel functions, hankel functions and thier derivatives
-        ka = magk * self.a
-        kna = magk * n * self.a
-        #number of samples
-        
-        
-        #evaluate the spherical bessel functions of the first kind at ka
-        jl_ka = self.sphbesselj(ordVec, ka, 0)
-        
-        #evaluate the derivative of the spherical bessel functions of the first kind at kna
-        jl_kna_p = self.derivSphBes(ordVec, kna)
-        
-        #evaluate the spherical bessel functions of the first kind at kna
-        
-        jl_kna = self.sphbesselj(ordVec, kna, 0)
-        
-        #evaluate the derivative of the spherical bessel functions of the first kind of ka
-        jl_ka_p = self.derivSphBes(ordVec, ka)
-
-        #compute the numerator for B coefficients
-        numB = jl_ka * jl_kna_p * n - jl_kna * jl_ka_p
-        
-        #evaluate the hankel functions of the first kind at ka
-        hl_ka = self.sphhankel(ordVec, ka, 0)
-        
-        #evaluate the derivative of the hankel functions of the first kind at ka
-        hl_ka_p = self.derivSphHan(ordVec, ka)
-        
-        #compute the denominator for coefficient A and B
-        denAB = jl_kna * hl_ka_p - hl_ka * jl_kna_p * n
-        
-        #compute B
-        B = np.asarray((numB / denAB), dtype = np.complex128)
-        B = np.reshape(B, (1, 1, numOrd + 1))
+        #look the coefficients of the sphere up in the coefficient cache, the
+        #ground truth of B is only evaluated the first time a sphere is rendered
+        B, A = coefficients.mie_coefficients(n, self.a, lambDa, numOrd)
+        B = np.reshape(np.array(B), (1, 1, numOrd + 1))
         
         pre_B = twolplus1_il * B
         
-        #compute the numerator of the scattering coefficient A
-        numA = jl_ka * hl_ka_p - jl_ka_p * hl_ka
-        
         #compute A
-        A = np.asarray(twolplus1_il * (numA / denAB), dtype = np.complex128)
-        A = np.reshape(A, (1, 1, numOrd + 1))
+        A = np.reshape(twolplus1_il * A, (1, 1, numOrd + 1))
         
         #normalize r vector 
         rNorm = self.rVecs_ps / rMag[..., None]
@@ -697,14 +665,9 @@ def cal_kz(fov, simRes):
     #compute the distance of x, y components in Fourier domain
     k_para_square = k_xy[...,0]**2 + k_xy[...,1]**2
     
-    #initialize a z-axis frequency components
-    k_z = np.zeros(xx.shape)
-    
-    #compute kz at each pixel
-    for i in range(len(k_para_square)):
-        for j in range(len(k_para_square)):
-            if k_para_square[i, j] < 1:
-                k_z[i, j] = np.sqrt(1 - k_para_square[i, j])
+    #compute kz at each pixel, 0 where the sum is not smaller than 1
+    propagating = k_para_square < 1
+    k_z = np.sqrt(np.where(propagating, 1 - k_para_square, 0))
     
     #return it
     return k_z
@@ -26,36 +26,21 @@ from matplotlib import animation as animation
 import sys
 # import random for MC sampling
 import random
+# render for the order sums of the scattering field
+from mietools import render
+# coefficients for the cached Mie coefficients
+from mietools import coefficients
+# propagation for the angular spectrum propagator
+from mietools import propagation
 
 def propagate_field(E, fov, k, z):
+    # propagate the field E by z with the angular spectrum method
+    # the propagator of the plane keeps kz between the calls, and takes
+    # a stack of fields (..., rows, columns) at once
+    propagator = propagation.get_propagator(E.shape[-2:], fov, k)
+    E_prop = propagator.propagate(E, z)
     
-    # calculate the fourier frequencies
-    fx = np.fft.fftfreq(E.shape[0], fov/E.shape[0]) * k
-    fy = np.fft.fftfreq(E.shape[1], fov/E.shape[1]) * k
-    
-    # calculate kz
-    kx, ky = np.meshgrid(fx, fy)
-    kxky = kx ** 2 + ky ** 2
-    mask = kxky > k**2
-    kxky[mask] = 0
-    kz = np.sqrt(k**2 - kxky)
-    kz[mask] = 0
-    
-#    plt.figure()
-#    plt.imshow(kz)
-#    plt.colorbar()
-    
-    # calculate phase term
-    phase = np.exp(1j * kz * z)
-    
-    # apply phase shift in Fourier Domain
-    E_FFT = np.fft.fft2(E)
-    E_prop_FFT = E_FFT * phase
-    
-    # inverse Fourier Transform
-    E_prop = np.fft.ifft2(E_prop_FFT)
-    
-    return E_prop, phase
+    return E_prop, propagator.phase(z)
 
 class planewave():
     #implement all features of a plane wave
@@ -87,26 +72,16 @@ class planewave():
         Ef = self.E.reshape((3, 1, 1)) * ex
         return Ef
 
-def coeff_b(l, k, n, a):
-    jka = sp.special.spherical_jn(l, k * a)
-    jka_p = sp.special.spherical_jn(l, k * a, derivative=True)
-    jkna = sp.special.spherical_jn(l, k * n * a)
-    jkna_p = sp.special.spherical_jn(l, k * n * a, derivative=True)
-
-    yka = sp.special.spherical_yn(l, k * a)
-    yka_p = sp.special.spherical_yn(l, k * a, derivative=True)
-
-    hka = jka + yka * 1j
-    hka_p = jka_p + yka_p * 1j
-
-    bi = jka * jkna_p * n
-    ci = jkna * jka_p
-    di = jkna * hka_p
-    ei = hka * jkna_p * n
-
-    return (bi - ci) / (di - ei)
-
-def cal_field(res, fov, a, n, lambDa, z_slice):
+def cal_field(res, fov, a, n, lambDa, z_slice, max_memory = None, tile_size = None, workers = 1, radial_lookup = True,
+               symmetry = None):
+    # max_memory: memory budget in bytes, the plane is evaluated in tiles of
+    #             rows that fit in it, render.MAX_MEMORY if None
+    # tile_size: number of rows of a tile, overrides max_memory
+    # workers: number of tiles evaluated at the same time on a thread pool
+    # radial_lookup: evaluate the scattering field once for every unique
+    #                pair of kr and cos_theta and look the other pixels up
+    # symmetry: mirror symmetry used to evaluate the plane, 1, 2, 4 or 8 (see
+    #           render.mirror_pixels), None to detect it
 
     # the maximal order
     l_max = math.ceil(2*np.pi * a / lambDa + 4 * (2 * np.pi * a / lambDa) ** (1/3) + 2)
@@ -142,30 +117,40 @@ def cal_field(res, fov, a, n, lambDa, z_slice):
     
     rNorm = rVecs_ps / rMag[...,None]
     
-    # preconpute scatter matrix = hlkr * plcos_theta
+    # arguments of hlkr and plcos_theta, both are generated order by order
+    # inside the sum so the (simRes, simRes, l_max+1) scatter matrix is not built
     
     kr = kMag * rMag
     cos_theta = np.dot(rNorm, k_dir)
     
-    # calculate hlkr and plcos
-    scatter_matrix = np.zeros((simRes, simRes, l_max+1), dtype = np.complex128)
-    
     alpha = (2 * l + 1) * (1j ** l) 
-    jkr = sp.special.spherical_jn(l, kr[..., None])
-    ykr = sp.special.spherical_yn(l, kr[..., None])
-    hlkr = jkr + ykr * 1j
-    plcos = sp.special.eval_legendre(l, cos_theta[..., None])
-    scatter_matrix = hlkr * plcos * alpha
     
     # pre compute Ef, incident field at z-max
     E_obj = planewave(k, E)
     Ep = E_obj.evaluate(x, y, z)
     Ef = Ep[0,...]
     
-    # calculate B vector
-    B = coeff_b(l, kMag, n, a)
+    # calculate B vector, cached so the planes of the same sphere share it
+    B, A = coefficients.mie_coefficients(n, a, lambDa, l_max)
+    
+    # for on-axis incidence the scattering field is symmetric around the axis
+    # of the sphere, so only one part of a symmetric plane is evaluated
+    symmetric = k_dir[0] == 0 and k_dir[1] == 0
+    symmetry = render.plane_symmetry(gx - ps[0], gy - ps[1], symmetry, symmetric)
+    index, inverse = render.mirror_pixels(simRes, simRes, symmetry)
+    # the scattering field only depends on kr and cos_theta, so with the
+    # lookup it is evaluated once for every unique pair of them
+    if radial_lookup:
+        u_index, u_inverse = render.unique_pixels(np.ravel(kr)[index], np.ravel(cos_theta)[index])
+        index, inverse = index[u_index], u_inverse[inverse]
+    kr_u = np.ravel(kr)[index]
+    cos_theta_u = np.ravel(cos_theta)[index]
     
-    Es = np.sum(scatter_matrix * B, axis = 2)
+    # the order sum keeps about eight complex arrays of the tile size alive
+    tiles = render.tile_rows(index.size, 8 * 16, max_memory,
+                             None if tile_size is None else tile_size * simRes, workers)
+    Es = render.map_tiles(lambda rows: render.hankel_sum(kr_u[rows], B * alpha, cos_theta = cos_theta_u[rows]),
+                          tiles, workers)[inverse]
     Et = Es + Ef
     
     mask = rMag < a
@@ -14,24 +14,7 @@ Optimize a non-linear problem to predict the value of a and n
 import numpy as np
 import scipy as sp
 from matplotlib import pyplot as plt
-
-def sphhankel(order, x, mode):
-#general form of calculating spherical hankel functions of the first kind at x
-    
-    if np.isscalar(x):
-        return np.sqrt(np.pi / (2*x)) * (sp.special.jv(order + 0.5 + mode, x) + 1j * sp.special.yv(order + 0.5 + mode, x))
-#
-        
-    elif np.asarray(x).ndim == 1:
-        ans = np.zeros((len(x), len(order)), dtype = np.complex128)
-        for i in range(len(order)):
-            ans[:,i] = np.sqrt(np.pi / (2*x)) * (sp.special.jv(i + 0.5 + mode, x) + 1j * sp.special.yv(i + 0.5 + mode, x))
-        return ans
-    else:
-        ans = np.zeros((x.shape + (len(order))), dtype = np.complex128)
-        for i in range(len(order)):
-            ans[...,i] = np.sqrt(np.pi / (2*x)) * (sp.special.jv(i + 0.5 + mode, x) + 1j * sp.special.yv(i + 0.5 + mode, x))
-        return ans
+from mietools import special
 
 def Legendre(order, x):
     #calcula order l legendre polynomial
@@ -122,7 +105,7 @@ def getBrandom():
     ordVec = np.arange(0, num_order+1, 1)
     
     #calculate the spherical hankel function of the 1st kind for all the orders
-    h_kr = sphhankel(ordVec, k_r, 0)
+    h_kr = special.sph_hn(num_order, k_r)
     
     #normalize k and r vectors for computing the angle between them
     k_norm = k / np.linalg.norm(k)
@@ -176,7 +159,7 @@ def getBpseudo():
     ordVec = np.arange(0, num_order+1, 1)
     
     #calculate the spherical hankel function of the 1st kind for all the orders
-    h_kr = sphhankel(ordVec, k_r, 0)
+    h_kr = special.sph_hn(num_order, k_r)
     
     #normalize k and r vectors for computing the angle between them
 #    k_norm = k / np.linalg.norm(k)
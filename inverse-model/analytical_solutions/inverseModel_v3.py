@@ -22,81 +22,7 @@ import numpy as np
 import scipy as sp
 import math
 from matplotlib import pyplot as plt
-
-#
-#
-#
-#spherical bessel functions and hankel functions
-#
-#
-#
-
-def sphbesselj(order, x, mode):
-    #calculate the spherical bessel function of the 1st kind with order specified
-        #order: the order to be calculated
-        #x: the variable to be calculated
-        #mode: 1 stands for prime, -1 stands for derivative, 0 stands for nothing
-            if np.isscalar(x):
-                return np.sqrt(np.pi / (2*x)) * sp.special.jv(order + 0.5 + mode, x)
-            
-            elif np.asarray(x).ndim == 1:
-                ans = np.zeros((len(x), len(order) + 1), dtype = np.complex128)
-                for i in range(len(order)):
-                    ans[:,i] = np.sqrt(np.pi / (2*x)) * sp.special.jv(i + 0.5 + mode, x)
-                return ans
-            
-            else:
-                ans = np.zeros((x.shape + (len(order),)), dtype = np.complex128)
-                for i in range(len(order)):
-                    ans[...,i] = np.sqrt(np.pi / (2*x)) * sp.special.jv(i + 0.5 + mode, x)
-                return ans
-            
-            
-            
-def sphhankel(order, x, mode):
-#general form of calculating spherical hankel functions of the first kind at x
-    
-    if np.isscalar(x):
-        return np.sqrt(np.pi / (2*x)) * (sp.special.jv(order + 0.5 + mode, x) + 1j * sp.special.yv(order + 0.5 + mode, x))
-#
-        
-    elif np.asarray(x).ndim == 1:
-        ans = np.zeros((len(x), len(order)), dtype = np.complex128)
-        for i in range(len(order)):
-            ans[:,i] = np.sqrt(np.pi / (2*x)) * (sp.special.jv(i + 0.5 + mode, x) + 1j * sp.special.yv(i + 0.5 + mode, x))
-        return ans
-    else:
-        ans = np.zeros((x.shape + (len(order),)), dtype = np.complex128)
-        for i in range(len(order)):
-            ans[...,i] = np.sqrt(np.pi / (2*x)) * (sp.special.jv(i + 0.5 + mode, x) + 1j * sp.special.yv(i + 0.5 + mode, x))
-        return ans
-    
-
-#derivative of the spherical bessel function of the first kind
-def derivSphBes(order, x):
-    js_n = np.zeros(order.shape, dtype = np.complex128)
-    js_n_m_1 = np.zeros(order.shape, dtype = np.complex128)
-    js_n_p_1 = np.zeros(order.shape, dtype = np.complex128)
-    
-    js_n = sphbesselj(order, x, 0)
-    js_n_m_1 = sphbesselj(order, x, -1)
-    js_n_p_1 = sphbesselj(order, x, 1)
-    
-    j_p = 1/2 * (js_n_m_1 - (js_n + x * js_n_p_1) / x)
-    return j_p
-
-#derivative of the spherical hankel function of the first kind
-def derivSphHan(order, x):
-    sh_n = np.zeros(order.shape, dtype = np.complex128)
-    sh_n_m_1 = np.zeros(order.shape, dtype = np.complex128)
-    sh_n_p_1 = np.zeros(order.shape, dtype = np.complex128)
-
-    sh_n = sphhankel(order, x, 0)
-    sh_n_m_1 = sphhankel(order, x, -1)
-    sh_n_p_1 = sphhankel(order, x, 1)
-    
-    h_p = 1/2 * (sh_n_m_1 - (sh_n + x * sh_n_p_1) / x)
-    return h_p
+from mietools import special
 
 def Legendre(order, x):
     #calcula order l legendre polynomial
@@ -214,10 +140,9 @@ kr_t = np.linspace(1, 5, 30)
 
 bessel2 = sp.special.yv(ordVec, 3)
 
-hankel_t = sphhankel(ordVec, kr_t, 0)
+hankel_t = special.sph_hn(numOrd, kr_t)
 
-hlkr = sphhankel(ordVec, kr, 0)
-hlkr_p = derivSphHan(ordVec, kr)
+hlkr, hlkr_p = special.sph_hn(numOrd, kr, True)
 
 hlkr_py = np.zeros(((numOrd+1, numOrd+1)), dtype = np.complex128)
 for i in ordVec:
@@ -0,0 +1,19 @@
+"""
+Shared computation routines for the Mie scattering scripts
+
+The scripts under foward-model and inverse-model import these modules
+directly, so add the root of this repository into the Python path
+before running them.
+
+Modules:
+    coefficients: Mie coefficients of a sphere with a bounded LRU cache
+    farfield: angular kernel of the asymptotic far field
+    focus: cache of the focused incident field shared by the spheres of a scene
+    geometry: evaluation planes shared by the renderers
+    hankel: hankel transforms of radially symmetric fields
+    library: precomputed basis of the scattering fields on disk
+    propagation: angular spectrum propagation of the fields of a plane
+    render: plane wave accumulation for the focused beam simulation
+    sampling: plane wave directions inside the condenser cone
+    special: spherical bessel and hankel functions of all orders
+"""
@@ -0,0 +1,255 @@
+"""
+Mie coefficients of a sphere with a bounded LRU cache
+
+The coefficients of the scattered field B_l and of the internal field A_l
+of a sphere of radius a and refractive index n illuminated at the
+wavelength lambDa are
+
+    B_l = (j_l(ka) n j_l'(kna) - j_l(kna) j_l'(ka)) / D_l
+    A_l = (j_l(ka) h_l'(ka) - j_l'(ka) h_l(ka)) / D_l
+    D_l = j_l(kna) h_l'(ka) - h_l(ka) n j_l'(kna)
+
+without the factor (2l + 1) i^l. They are evaluated in the form
+
+    B_l = (n d_l j_l(ka) - j_l'(ka)) / (h_l'(ka) - n d_l h_l(ka))
+    A_l = i / (ka)^2 / (j_l(kna) (h_l'(ka) - n d_l h_l(ka)))
+
+with the logarithmic derivative d_l = j_l'(kna) / j_l(kna) (see
+special.sph_jn_logderiv), which neither overflows for the large imaginary
+parts of kna of absorbing spheres nor underflows for orders above |kna|,
+so spheres with ka of several thousands stay accurate. A_l still contains
+j_l(kna), which does not fit in double precision once |Im(kna)| passes
+about 700, so only B_l is available for such strongly absorbing spheres
+and A_l is nan.
+
+Sweeps and fits revisit the same
+parameters, e.g. both planes of a back propagation test use the same
+sphere, so mie_coefficients looks them up in a CoefficientCache keyed by
+(n, a, lambDa, numOrd) before evaluating them. The cache can be saved to
+an .npz file and loaded again in another run. Grids of spheres, e.g. for
+dataset generation or lookup tables, are evaluated in one call by
+coefficient_grid.
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+
+from . import render
+from . import special
+
+# default number of coefficient sets kept by a cache
+CACHE_SIZE = 1024
+
+
+def truncation_order(a, lambDa):
+    """
+    Highest order needed for a sphere, ka + 4 (ka)^(1/3) + 2 rounded up
+    param:
+        a: radius of the sphere, scalar or array
+        lambDa: wavelength, scalar or array
+    return:
+        the order, int or integer array of the broadcast shape
+    """
+    ka = 2 * np.pi * np.asarray(a, dtype=np.float64) / np.asarray(lambDa, dtype=np.float64)
+    order = np.ceil(ka + 4 * ka ** (1/3) + 2).astype(np.int64)
+    return int(order) if order.ndim == 0 else order
+
+
+def coefficient_grid(n, a, lambDa, numOrd=None, truncate=True, max_memory=None):
+    """
+    Mie coefficients of every sphere of a grid of parameters in one call
+    n, a and lambDa are broadcast against each other, the coefficients of
+    all the spheres are padded to a common highest order, and each sphere
+    reports its own truncation order. The spheres are evaluated in chunks
+    that fit in a memory budget.
+    param:
+        n: refractive indices, real or complex
+        a: radii
+        lambDa: wavelengths
+        numOrd: common highest order, the largest truncation order if None
+        truncate: set the orders above the truncation order of a sphere to 0
+        max_memory: memory budget of the working arrays of a chunk in bytes,
+            render.MAX_MEMORY if None
+    return:
+        B, A: complex arrays of shape broadcast shape + (numOrd+1,)
+        orders: truncation order of every sphere, at most numOrd
+    """
+    n, a, lambDa = np.broadcast_arrays(np.asarray(n, dtype=np.complex128),
+                                       np.asarray(a, dtype=np.float64),
+                                       np.asarray(lambDa, dtype=np.float64))
+    orders = np.asarray(truncation_order(a, lambDa))
+    if numOrd is None:
+        numOrd = int(np.max(orders)) if orders.size else 0
+    shape = n.shape + (numOrd+1,)
+    B = np.empty(shape, dtype=np.complex128)
+    A = np.empty(shape, dtype=np.complex128)
+
+    ka = np.ravel(2 * np.pi / lambDa * a)
+    kna = ka * np.ravel(n)
+    n_flat = np.ravel(n)[:, None]
+    B_flat = B.reshape(-1, numOrd+1)
+    A_flat = A.reshape(-1, numOrd+1)
+    # about ten complex working arrays of the orders of a sphere
+    for rows in render.tile_rows(ka.size, 10 * 16 * (numOrd+1), max_memory):
+        jl_ka, jl_ka_p = special.sph_jn(numOrd, ka[rows], True)
+        hl_ka, hl_ka_p = special.sph_hn(numOrd, ka[rows], True)
+        # n * j_l'(kna) / j_l(kna), see the module description
+        nD = n_flat[rows] * special.sph_jn_logderiv(numOrd, kna[rows])
+
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            den = hl_ka_p - nD * hl_ka
+            B_flat[rows] = (nD * jl_ka - jl_ka_p) / den
+            # j_l h_l' - j_l' h_l = i / (ka)^2
+            jl_kna = special.sph_jn(numOrd, kna[rows])
+            A_flat[rows] = 1j / ka[rows, None] ** 2 / (jl_kna * den)
+        # far above ka, h_l(ka) overflows while both coefficients go to 0
+        far = ~np.isfinite(hl_ka_p)
+        B_flat[rows][far] = 0
+        A_flat[rows][far] = 0
+
+    orders = np.minimum(orders, numOrd)
+    if truncate:
+        cut = np.arange(numOrd+1) > orders[..., None]
+        B[cut] = 0
+        A[cut] = 0
+    return B, A, orders
+
+
+def compute_coefficients(n, a, lambDa, numOrd):
+    """
+    Mie coefficients of a sphere, evaluated without the cache
+    param:
+        n: refractive index of the sphere, real or complex
+        a: radius of the sphere
+        lambDa: wavelength
+        numOrd: the highest order
+    return:
+        B, A: complex arrays of the orders 0..numOrd
+    """
+    B, A, orders = coefficient_grid(n, a, lambDa, numOrd, truncate=False)
+    return B, A
+
+
+class CoefficientCache:
+    """
+    Least recently used cache of Mie coefficients
+    The cached arrays are read-only, since they are shared by all the
+    callers asking for the same sphere.
+    """
+
+    def __init__(self, max_size=CACHE_SIZE, path=None):
+        """
+        param:
+            max_size: largest number of coefficient sets kept
+            path: optional .npz file, loaded if it exists and written by save
+        """
+        self.max_size = max_size
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        if path is not None:
+            try:
+                self.load(path)
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def key(n, a, lambDa, numOrd):
+        """
+        Cache key of a sphere
+        """
+        return (complex(n), float(a), float(lambDa), int(numOrd))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, n, a, lambDa, numOrd):
+        """
+        Mie coefficients of a sphere, evaluated only if they are not cached
+        param:
+            n, a, lambDa, numOrd: see compute_coefficients
+        return:
+            B, A: read-only complex arrays of the orders 0..numOrd
+        """
+        key = self.key(n, a, lambDa, numOrd)
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        self.misses += 1
+        B, A = compute_coefficients(n, a, lambDa, numOrd)
+        self._insert(key, B, A)
+        return B, A
+
+    def _insert(self, key, B, A):
+        B.setflags(write=False)
+        A.setflags(write=False)
+        self._entries[key] = (B, A)
+        self._entries.move_to_end(key)
+        while len(self._entries) > max(0, self.max_size):
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Remove all the entries and reset the counters
+        """
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        """
+        return:
+            dictionary of the hits, the misses, the size and the largest size
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._entries), 'max_size': self.max_size}
+
+    def save(self, path=None):
+        """
+        Save the entries to an .npz file, from the least to the most recently used
+        param:
+            path: file name, the path of the cache if None
+        """
+        path = self.path if path is None else path
+        if path is None:
+            raise ValueError("no path to save the cache to")
+        keys = list(self._entries)
+        arrays = {'n': np.array([key[0] for key in keys], dtype=np.complex128),
+                  'a': np.array([key[1] for key in keys]),
+                  'lambDa': np.array([key[2] for key in keys]),
+                  'numOrd': np.array([key[3] for key in keys], dtype=np.int64)}
+        for i, key in enumerate(keys):
+            arrays['B_' + str(i)], arrays['A_' + str(i)] = self._entries[key]
+        np.savez(path, **arrays)
+
+    def load(self, path):
+        """
+        Add the entries saved by save, the counters are not changed
+        param:
+            path: file name
+        """
+        with np.load(path) as data:
+            for i in range(data['n'].size):
+                key = self.key(data['n'][i], data['a'][i], data['lambDa'][i], data['numOrd'][i])
+                self._insert(key, data['B_' + str(i)], data['A_' + str(i)])
+
+
+# the cache shared by the scripts
+default_cache = CoefficientCache()
+
+
+def mie_coefficients(n, a, lambDa, numOrd, cache=None):
+    """
+    Mie coefficients of a sphere through a cache
+    param:
+        n, a, lambDa, numOrd: see compute_coefficients
+        cache: CoefficientCache, default_cache if None
+    return:
+        B, A: read-only complex arrays of the orders 0..numOrd
+    """
+    if cache is None:
+        cache = default_cache
+    return cache.get(n, a, lambDa, numOrd)
@@ -0,0 +1,106 @@
+"""
+Asymptotic far field of a sphere as a 1-D angular kernel
+
+Far from the sphere the hankel functions take their asymptotic form
+
+    h_l(kr) -> (-i)^l exp(ikr) / (ikr)
+
+so the radial factor no longer depends on the order and the scattered field
+
+    Es = exp(ikr) / (ikr) * sum_l alpha_l B_l (-i)^l P_l(cos(theta)),
+    alpha_l = (2l + 1) i^l
+
+is the radial factor times a function of cos(theta) alone, the angular
+kernel. The kernel is evaluated once for every distinct cos(theta), or on
+a 1-D grid of cos(theta) and interpolated, and then mapped onto the 2-D
+grid, which takes O(N^2 + L K) instead of the O(N^2 L) of building every
+order on the full grid.
+"""
+
+import numpy as np
+import numpy.polynomial.legendre
+import scipy.interpolate
+
+
+def far_field_coefficients(B):
+    """
+    Coefficients alpha_l B_l (-i)^l of the angular kernel
+    i^l (-i)^l = 1, so they are (2l + 1) B_l
+    param:
+        B: Mie coefficients of the scattered field of the orders 0..numOrd,
+            without the factor (2l + 1) i^l
+    return:
+        complex array of the orders 0..numOrd
+    """
+    B = np.asarray(B)
+    l = np.arange(B.shape[-1])
+    return (2*l + 1) * B
+
+
+def legendre_series(coeff, x):
+    """
+    sum_l coeff_l P_l(x) at every x, with the Clenshaw recurrence
+    param:
+        coeff: coefficients of the orders 0..numOrd
+        x: points, any shape
+    return:
+        the sum, shape of x
+    """
+    x = np.asarray(x, dtype=np.float64)
+    return numpy.polynomial.legendre.legval(x, np.asarray(coeff))
+
+
+def angular_kernel(coeff, cos_theta, num_samples=None):
+    """
+    Angular kernel sum_l coeff_l P_l(cos_theta) at every pixel
+    param:
+        coeff: coefficients of the orders 0..numOrd, see far_field_coefficients
+        cos_theta: cosine of the scattering angle of the pixels, any shape
+        num_samples: if None the kernel is evaluated at every distinct value
+            of cos_theta, otherwise at num_samples points spread over the
+            range of cos_theta and interpolated with a cubic spline, which
+            needs a few samples per oscillation of P_numOrd
+    return:
+        the kernel, complex array of the shape of cos_theta
+    """
+    cos_theta = np.asarray(cos_theta, dtype=np.float64)
+    if cos_theta.size == 0:
+        return np.zeros(cos_theta.shape, dtype=np.complex128)
+    if num_samples is None:
+        values, inverse = np.unique(cos_theta, return_inverse=True)
+        return np.reshape(legendre_series(coeff, values)[inverse], cos_theta.shape)
+    lo, hi = np.min(cos_theta), np.max(cos_theta)
+    if lo == hi:
+        return np.full(cos_theta.shape, legendre_series(coeff, lo), dtype=np.complex128)
+    samples = np.linspace(lo, hi, max(int(num_samples), 4))
+    spline = scipy.interpolate.CubicSpline(samples, legendre_series(coeff, samples))
+    return spline(cos_theta)
+
+
+def fourier_kernel(coeff, simRes, simFov):
+    """
+    Angular kernel on the 2-D frequency grid of np.fft.fft2
+    The frequencies are m / simFov with integer m, so cos(theta) only
+    depends on the integer m^2 + n^2 of a pixel, and the kernel is
+    evaluated once for every such integer present in the grid.
+    param:
+        coeff: coefficients of the orders 0..numOrd, see far_field_coefficients
+        simRes: number of pixels along one side
+        simFov: size of the plane along one side
+    return:
+        kernel: complex array of shape (simRes, simRes), 0 where the
+            frequency is larger than 1 and cos(theta) is not defined
+        mask: boolean array of the pixels set to 0
+    """
+    # integer frequencies in the layout of np.fft.fftfreq
+    m = np.round(np.fft.fftfreq(simRes) * simRes).astype(np.int64)
+    key = m[None, :] ** 2 + m[:, None] ** 2
+    mask = key > simFov ** 2
+    used = np.unique(key[~mask])
+    cos_theta = np.sqrt(1 - used / simFov ** 2)
+    # the kernel of every integer up to the largest one used
+    table = np.zeros(key.max() + 1, dtype=np.complex128)
+    table[used] = legendre_series(coeff, cos_theta)
+    kernel = table[key]
+    kernel[mask] = 0
+    return kernel, mask
@@ -0,0 +1,123 @@
+"""
+Cache of the focused incident field of a condenser
+
+The focused field of a condenser whose axis is the k vector only depends
+on the distance rho to the axis and on the distance z along it from the
+focus. On a plane perpendicular to the axis z is fixed, so the field of
+the whole plane is a radial profile Ef(rho). A sphere at another lateral
+position sees the same profile translated, and a sphere at another depth
+a profile at another z.
+
+FocusedFieldCache keeps these profiles, sampled densely in rho, for every
+set of optics and depth, and evaluates a plane by interpolating its
+profile at the rho of every pixel. Only the samples of the profile are
+evaluated with the order sum, a few thousand instead of one per pixel,
+and every further sphere of a scene at the same depth reuses them.
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+import scipy.interpolate
+
+# default number of profiles kept by a cache
+CACHE_SIZE = 32
+# default interpolation error of the profiles relative to the field
+PROFILE_TOL = 1e-10
+
+
+def profile_spacing(magk, tol=PROFILE_TOL):
+    """
+    Sample spacing of a radial profile for a cubic spline error of about tol
+    The profile has no spatial frequencies above magk, so the error of a
+    cubic spline is about 5/384 * (magk * h)^4.
+    param:
+        magk: magnitude of the k vector
+        tol: interpolation error relative to the field
+    return:
+        spacing h
+    """
+    return (384 / 5 * tol) ** (1/4) / magk
+
+
+class FocusedFieldCache:
+    """
+    Least recently used cache of radial profiles of focused fields
+    """
+
+    def __init__(self, max_size=CACHE_SIZE, tol=PROFILE_TOL):
+        """
+        param:
+            max_size: largest number of profiles kept
+            tol: interpolation error of the profiles relative to the field
+        """
+        self.max_size = max_size
+        self.tol = tol
+        self.hits = 0
+        self.misses = 0
+        self._profiles = OrderedDict()
+
+    def __len__(self):
+        return len(self._profiles)
+
+    def profile(self, key, z, rho_max, magk, evaluate):
+        """
+        Radial profile of a focused field at the depth z, covering [0, rho_max]
+        A cached profile is used if it reaches rho_max, otherwise it is
+        evaluated again over the larger range.
+        param:
+            key: hashable description of the optics, e.g. (NA_in, NA_out,
+                lambDa, k), every field with the same key and z is the same
+            z: distance of the plane from the focus along the axis
+            rho_max: largest distance to the axis needed
+            magk: magnitude of the k vector, sets the sample spacing
+            evaluate: function of (rho, z) returning the field at the 1-D
+                array of distances rho
+        return:
+            cubic spline of the profile
+        """
+        key = (key, float(z))
+        if key in self._profiles and self._profiles[key].x[-1] >= rho_max:
+            self.hits += 1
+            self._profiles.move_to_end(key)
+            return self._profiles[key]
+        self.misses += 1
+        h = profile_spacing(magk, self.tol)
+        # a few samples past rho_max so the end of the spline is not used
+        rho = np.arange(int(np.ceil(rho_max / h)) + 4) * h
+        # the profile is even in rho, its derivative vanishes on the axis
+        spline = scipy.interpolate.CubicSpline(rho, evaluate(rho, z), bc_type=((1, 0.0), 'not-a-knot'))
+        self._profiles[key] = spline
+        self._profiles.move_to_end(key)
+        while len(self._profiles) > max(0, self.max_size):
+            self._profiles.popitem(last=False)
+        return spline
+
+    def field(self, key, rho, z, magk, evaluate):
+        """
+        Focused field at the distances rho to the axis on a plane at depth z
+        param:
+            key, z, magk, evaluate: see profile
+            rho: distances to the axis of the pixels, any shape
+        return:
+            the field, shape of rho
+        """
+        rho = np.asarray(rho)
+        spline = self.profile(key, z, np.max(rho, initial=0), magk, evaluate)
+        return spline(rho)
+
+    def clear(self):
+        """
+        Remove all the profiles and reset the counters
+        """
+        self._profiles.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        """
+        return:
+            dictionary of the hits, the misses, the size and the largest size
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._profiles), 'max_size': self.max_size}
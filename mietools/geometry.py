@@ -0,0 +1,186 @@
+"""
+Evaluation planes shared by the renderers
+
+A Plane describes the grid the fields are evaluated on by a few numbers:
+the resolution, the field of view, the padding, the position of the plane
+and its orientation. It is immutable and hashable, and everything derived
+from it (the axes, the r vectors, the distances to a sphere, a bandpass
+filter) is computed the first time it is asked for and kept on the plane
+as a read-only array. The coordinates are 1-D axes shaped to broadcast
+against each other, the full (simRes, simRes, 3) r vectors are only built
+when they are needed.
+
+get_plane returns the same Plane for the same parameters, so all the
+renderers of a scene, e.g. one mieScattering per sphere, share one plane
+and its arrays instead of allocating them again. It keeps only the last
+PLANES planes, so a sweep over the planes does not keep all of them.
+"""
+
+import functools
+
+import numpy as np
+
+# orientations of a plane
+OPTIONS = ('Horizontal', 'Vertical')
+# number of sphere positions whose r vectors and distances a plane keeps,
+# each costs four (simRes, simRes) arrays
+POSITIONS = 4
+# number of planes kept by get_plane, a plane keeps its r vectors and the
+# arrays of up to POSITIONS sphere positions alive
+PLANES = 8
+
+
+def _read_only(a):
+    a.setflags(write=False)
+    return a
+
+
+class Plane:
+    """
+    Square evaluation plane of simRes = res * (2 * padding + 1) pixels
+        'Horizontal': the plane z = pp, x along the columns, y along the rows
+        'Vertical': the plane x = 0, y along the columns, z along the rows
+    """
+
+    def __init__(self, res, fov, padding=1, pp=0, option='Horizontal'):
+        """
+        param:
+            res: resolution of the cropped image
+            fov: field of view
+            padding: padding of the plane on every side, in images
+            pp: position of a horizontal plane along z
+            option: 'Horizontal' or 'Vertical'
+        """
+        if option not in OPTIONS:
+            raise ValueError("unknown option " + str(option) + ", use 'Horizontal' or 'Vertical'")
+        object.__setattr__(self, '_key', (int(res), float(fov), int(padding), float(pp), option))
+        object.__setattr__(self, '_cache', {})
+
+    def __setattr__(self, name, value):
+        raise AttributeError("a Plane is immutable")
+
+    def __eq__(self, other):
+        return isinstance(other, Plane) and self._key == other._key
+
+    def __hash__(self):
+        return hash(self._key)
+
+    def __repr__(self):
+        return 'Plane(res=%d, fov=%r, padding=%d, pp=%r, option=%r)' % self._key
+
+    def _cached(self, name, compute):
+        """
+        Value of a derived quantity, computed on first use
+        """
+        if name not in self._cache:
+            self._cache[name] = compute()
+        return self._cache[name]
+
+    res = property(lambda self: self._key[0])
+    fov = property(lambda self: self._key[1])
+    padding = property(lambda self: self._key[2])
+    pp = property(lambda self: self._key[3])
+    option = property(lambda self: self._key[4])
+
+    @property
+    def simRes(self):
+        """
+        Number of pixels along one side, padding included
+        """
+        return self.res * (2 * self.padding + 1)
+
+    @property
+    def halfgrid(self):
+        """
+        Size of half of the padded plane
+        """
+        return np.ceil(self.fov / 2) * (2 * self.padding + 1)
+
+    @property
+    def gx(self):
+        """
+        Column axis, simRes values from -halfgrid to halfgrid - 1
+        """
+        return self._cached('gx', lambda: _read_only(np.linspace(-self.halfgrid, self.halfgrid - 1, self.simRes)))
+
+    @property
+    def gy(self):
+        """
+        Row axis, the same values as gx
+        """
+        return self.gx
+
+    @property
+    def coordinates(self):
+        """
+        x, y and z of the pixels, each of shape (simRes, 1), (1, simRes) or
+        (1, 1), so they broadcast to the plane
+        """
+        def compute():
+            cols = self.gx[None, :]
+            rows = self.gy[:, None]
+            if self.option == 'Horizontal':
+                return cols, rows, _read_only(np.full((1, 1), self.pp))
+            return _read_only(np.zeros((1, 1))), cols, rows
+        return self._cached('coordinates', compute)
+
+    @property
+    def rVecs(self):
+        """
+        r vectors of the pixels, shape (simRes, simRes, 3)
+        """
+        def compute():
+            r = np.empty((self.simRes, self.simRes, 3))
+            for i, c in enumerate(self.coordinates):
+                r[..., i] = c
+            return _read_only(r)
+        return self._cached('rVecs', compute)
+
+    def _position(self, name, ps, compute):
+        """
+        Quantity relative to a sphere at ps, kept for the last POSITIONS positions
+        """
+        positions = self._cached(name, dict)
+        key = tuple(float(p) for p in np.ravel(ps))
+        if key not in positions:
+            if len(positions) >= POSITIONS:
+                positions.pop(next(iter(positions)))
+            positions[key] = _read_only(compute(np.asarray(key)))
+        return positions[key]
+
+    def relative(self, ps):
+        """
+        r vectors relative to a sphere at ps, shape (simRes, simRes, 3)
+        """
+        return self._position('relative', ps, lambda ps: self.rVecs - ps)
+
+    def distance(self, ps):
+        """
+        Distances of the pixels to a sphere at ps, shape (simRes, simRes)
+        """
+        return self._position('distance', ps, lambda ps: np.sqrt(np.sum(self.relative(ps) ** 2, 2)))
+
+    def bandpass(self, NA_in, NA_out, lambDa):
+        """
+        Bandpass filter of the optics in the layout of np.fft.fft2, passing
+        the spatial frequencies between NA_in / lambDa and NA_out / lambDa
+        """
+        def compute():
+            df = 1 / (self.halfgrid * 2)
+            i = np.arange(self.simRes)
+            f = np.where(i <= self.simRes / 2, i, i - self.simRes + 1) * df
+            magf = np.sqrt(f[:, None] ** 2 + f[None, :] ** 2)
+            BPF = np.ones((self.simRes, self.simRes))
+            # block lower and higher frequencies
+            BPF[magf < NA_in / lambDa] = 0
+            BPF[magf > NA_out / lambDa] = 0
+            return _read_only(BPF)
+        return self._cached(('bandpass', float(NA_in), float(NA_out), float(lambDa)), compute)
+
+
+@functools.lru_cache(maxsize=PLANES)
+def get_plane(res, fov, padding=1, pp=0, option='Horizontal'):
+    """
+    The shared Plane of the given parameters, see Plane
+    """
+    return Plane(res, fov, padding, pp, option)
@@ -0,0 +1,257 @@
+"""
+Hankel transforms of radially symmetric fields
+
+The 2-D Fourier transform of a radially symmetric field is a Hankel
+transform of its radial profile, so the near and far fields of a sphere
+on the axis can be converted with a 1-D transform of N samples instead of
+a 2-D FFT of N^2 pixels. Two transforms are provided:
+
+    idht: the quasi-discrete (Fourier-Bessel) transform of the scripts.
+          The profile is sampled at the zeros of J_order, and the transform
+          is the product with a kernel matrix that only depends on the
+          order and the number of samples, so it is kept in a KernelCache
+          with the zeros of J_order, and a stack of profiles is transformed
+          by one matrix product.
+    fftlog: the transform of a profile sampled on a logarithmic grid,
+          written as a correlation in log r and evaluated with two FFTs in
+          O(N log N). It suits profiles that span many decades of r.
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+import scipy.special
+
+from . import library
+
+
+# default number of kernel matrices kept by a cache
+CACHE_SIZE = 16
+
+
+def compute_kernel(order, num, zeros):
+    """
+    Kernel matrix of idht, J_order(j_k j_m / j_M) / J_(order+1)(j_m)^2
+    param:
+        order: order of the transform
+        num: number of output samples, the input has num - 1 samples
+        zeros: the first num zeros j of J_order
+    return:
+        array of shape (num, num - 1)
+    """
+    j = zeros[:num]
+    j_M = j[-1]
+    return scipy.special.jv(order, np.outer(j, j[:-1]) / j_M) / scipy.special.jv(order + 1, j[:-1]) ** 2
+
+
+class KernelCache:
+    """
+    Cache of the zeros of the bessel functions and of the kernel matrices
+    The kernel of idht only depends on the order and the number of samples,
+    the field of view only scales the transform, so every transform of the
+    same size reuses one matrix. The zeros are kept in one table per order
+    that grows to the largest number asked for. The kernels are kept in a
+    least recently used cache, and optionally stored as .npy files in a
+    directory (see library.open_basis) and memory mapped in later runs.
+    The cached arrays are read-only.
+    """
+
+    def __init__(self, max_size=CACHE_SIZE, directory=None):
+        """
+        param:
+            max_size: largest number of kernels kept in memory
+            directory: optional directory of the .npy files of the kernels
+        """
+        self.max_size = max_size
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self._zeros = {}
+        self._kernels = OrderedDict()
+
+    def __len__(self):
+        return len(self._kernels)
+
+    def zeros(self, order, num):
+        """
+        The first num positive zeros of J_order
+        param:
+            order: integer order of the bessel function
+            num: number of zeros
+        return:
+            read-only array of the zeros
+        """
+        order = int(order)
+        table = self._zeros.get(order)
+        if table is None or table.size < num:
+            table = scipy.special.jn_zeros(order, num)
+            table.setflags(write=False)
+            self._zeros[order] = table
+        return table[:num]
+
+    def kernel(self, order, num):
+        """
+        Kernel matrix of idht, evaluated only if it is not cached
+        param:
+            order, num: see compute_kernel
+        return:
+            read-only array of shape (num, num - 1)
+        """
+        key = (int(order), int(num))
+        if key in self._kernels:
+            self.hits += 1
+            self._kernels.move_to_end(key)
+            return self._kernels[key]
+        self.misses += 1
+        compute = lambda: compute_kernel(order, num, self.zeros(order, num))
+        if self.directory is None:
+            K = compute()
+            K.setflags(write=False)
+        else:
+            name = library.basis_name('hankel', order=key[0], num=key[1])
+            K = library.open_basis(self.directory, name, lambda: {'kernel': compute()}, keys=('kernel',))['kernel']
+        self._kernels[key] = K
+        while len(self._kernels) > max(0, self.max_size):
+            self._kernels.popitem(last=False)
+        return K
+
+    def clear(self):
+        """
+        Remove the kernels and the zeros from memory and reset the counters
+        """
+        self._kernels.clear()
+        self._zeros.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        """
+        return:
+            dictionary of the hits, the misses, the size and the largest size
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._kernels), 'max_size': self.max_size}
+
+
+# the cache shared by the scripts
+default_cache = KernelCache()
+
+
+def bessel_zeros(order, num, cache=None):
+    """
+    The first num positive zeros of J_order
+    param:
+        order: integer order of the bessel function
+        num: number of zeros
+        cache: KernelCache, default_cache if None
+    return:
+        read-only array of the zeros
+    """
+    if cache is None:
+        cache = default_cache
+    return cache.zeros(order, num)
+
+
+def dht_kernel(order, num, cache=None):
+    """
+    Kernel matrix of idht through a cache
+    param:
+        order, num: see compute_kernel
+        cache: KernelCache, default_cache if None
+    return:
+        read-only array of shape (num, num - 1)
+    """
+    if cache is None:
+        cache = default_cache
+    return cache.kernel(order, num)
+
+
+def dht_grid(X, num, order=0, cache=None):
+    """
+    Sample points of idht
+    param:
+        X: radius of the output, the input is sampled up to j_M / X
+        num: number of output samples
+        order: order of the transform
+        cache: KernelCache of the zeros, default_cache if None
+    return:
+        u: the num - 1 input samples, j_m / X
+        r: the num output samples, j_k X / j_M
+    """
+    j = bessel_zeros(order, num, cache)
+    return j[:-1] / X, j * X / j[-1]
+
+
+def idht(f, X, order=0, cache=None):
+    """
+    Inverse quasi-discrete Hankel transform
+        F(r_k) = 2 / X^2 sum_m f(u_m) J_order(j_k j_m / j_M) / J_(order+1)(j_m)^2
+    A stack of profiles is transformed by one product K @ f of the cached
+    kernel with all of them.
+    param:
+        f: the profile at the input samples u of dht_grid, shape
+            (num - 1, ...), every further axis is transformed independently
+        X: radius of the output
+        order: order of the transform
+        cache: KernelCache, default_cache if None
+    return:
+        F: the transform at the output samples r of dht_grid, shape (num, ...)
+    """
+    f = np.asarray(f)
+    num = f.shape[0] + 1
+    K = dht_kernel(order, num, cache)
+    F = K @ np.reshape(f, (num - 1, -1))
+    return 2 / X ** 2 * np.reshape(F, (num,) + f.shape[1:])
+
+
+def _mellin_bessel(order, s):
+    """
+    Mellin transform of J_order, int_0^inf t^(s-1) J_order(t) dt
+        = 2^(s-1) Gamma((order + s) / 2) / Gamma((order - s) / 2 + 1)
+    """
+    return np.exp((s - 1) * np.log(2) + scipy.special.loggamma((order + s) / 2)
+                  - scipy.special.loggamma((order - s) / 2 + 1))
+
+
+def fftlog(f, r, order=0, q=0, kr=1):
+    """
+    Hankel transform of a profile on a logarithmic grid
+        g(k) = int_0^inf f(r) J_order(kr) r dr
+    With r = exp(rho) and k = exp(kappa) the transform is a correlation
+        k^(1+q) g(k) = int f(r) r^(1-q) (kr)^(1+q) J_order(kr) drho
+    of the biased profile with a kernel whose Fourier transform in rho is
+    the Mellin transform of J_order, so it takes one FFT of the profile,
+    a product and one FFT back. The profile is treated as periodic in
+    log r, so it should decay at both ends of the grid.
+    param:
+        f: the profile at r, shape (N, ...), every further axis is
+            transformed independently
+        r: N logarithmically spaced radii, increasing
+        order: order of the transform
+        q: bias exponent, -order - 1 < q < 1/2, 0 suits most profiles
+        kr: product r_c k_c of the centers of the input and output grids
+    return:
+        k: the N logarithmically spaced output frequencies
+        g: the transform, shape of f
+    """
+    f = np.asarray(f)
+    r = np.asarray(r, dtype=np.float64)
+    N = r.size
+    dlnr = np.log(r[-1] / r[0]) / (N - 1)
+    # the output grid has the same spacing, with r_c k_c = kr at the centers
+    lnrc = (np.log(r[0]) + np.log(r[-1])) / 2
+    k = np.exp(np.log(kr) - lnrc + (np.arange(N) - (N - 1) / 2) * dlnr)
+
+    shape = (N,) + (1,) * (f.ndim - 1)
+    # Fourier coefficients of the biased profile in rho
+    a = np.fft.fft(f * np.reshape(r ** (1 - q), shape), axis=0) / N
+    m = np.fft.fftfreq(N) * N
+    omega = 2 * np.pi * m / (N * dlnr)
+    # the product of the first samples of both grids, rho_0 + kappa_0
+    lnkr0 = np.log(r[0]) + np.log(k[0])
+    u = _mellin_bessel(order, 1 + q + 1j * omega) * np.exp(-1j * omega * lnkr0)
+    if N % 2 == 0:
+        # the Nyquist frequency has no sign, keep it real
+        u[N // 2] = np.real(u[N // 2])
+    g = np.fft.fft(a * np.reshape(u, shape), axis=0)
+    return k, g / np.reshape(k ** (1 + q), shape)
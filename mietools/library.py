@@ -0,0 +1,81 @@
+"""
+Library of precomputed basis of the scattering fields on disk
+
+The basis of a plane (see render.scattering_basis and render.interior_basis)
+only depends on the geometry: the resolution, the field of view, the
+padding, the position of the plane, the wavelength and the highest order.
+It is computed once, stored as .npy files in a directory and opened with
+np.load(mmap_mode='r') afterwards, so a render is a product of the mapped
+basis with the coefficients and no special function is evaluated again:
+
+    arrays = library.open_basis(directory, library.basis_name('scattered', ...), compute)
+    Es = (arrays['basis'] @ B)[arrays['inverse']]
+
+The internal field depends on the refractive index through j_l(knr), so
+an interior basis is named with n among its parameters.
+"""
+
+import hashlib
+import os
+
+import numpy as np
+
+
+def basis_name(kind, **params):
+    """
+    File name prefix of a basis, unique for its kind and parameters
+    param:
+        kind: kind of the basis, e.g. 'scattered' or 'interior'
+        params: the parameters the basis depends on, e.g. res, fov, padding,
+            plane, lambDa, numOrd, values are compared through their repr
+            after the conversion of numpy values to python ones
+    return:
+        name
+    """
+    items = []
+    for key in sorted(params):
+        value = params[key]
+        if isinstance(value, (np.ndarray, np.generic)):
+            value = value.tolist()
+        items.append(key + '=' + repr(value))
+    digest = hashlib.sha1(';'.join(items).encode()).hexdigest()
+    return kind + '_' + digest[:20]
+
+
+def basis_files(directory, name, keys):
+    """
+    Paths of the .npy files of a basis
+    param:
+        directory: directory of the library
+        name: name given by basis_name
+        keys: names of the arrays of the basis
+    return:
+        dictionary of the paths
+    """
+    return {key: os.path.join(directory, name + '.' + key + '.npy') for key in keys}
+
+
+def open_basis(directory, name, compute, keys=('basis', 'inverse')):
+    """
+    Open a basis of the library memory mapped, computing and storing it first
+    if it is not in the library
+    The arrays are written to temporary files and renamed afterwards, so a
+    reader running at the same time never maps a partially written basis.
+    param:
+        directory: directory of the library, created if it does not exist
+        name: name given by basis_name
+        compute: function without arguments returning a dictionary of the
+            arrays of the basis, called only when the basis is missing
+        keys: names of the arrays of the basis
+    return:
+        dictionary of read-only memory mapped arrays
+    """
+    paths = basis_files(directory, name, keys)
+    if not all(os.path.exists(path) for path in paths.values()):
+        os.makedirs(directory, exist_ok=True)
+        arrays = compute()
+        for key, path in paths.items():
+            temp = path[:-len('.npy')] + '.' + str(os.getpid()) + '.tmp.npy'
+            np.save(temp, np.asarray(arrays[key]))
+            os.replace(temp, path)
+    return {key: np.load(path, mmap_mode='r') for key, path in paths.items()}
@@ -0,0 +1,252 @@
+"""
+Angular spectrum propagation of the fields of a plane
+
+A field sampled on a plane is propagated along z by a phase shift of its
+2-D Fourier transform,
+
+    E(z) = ifft2(fft2(E) * exp(i kz z)),    kz = sqrt(k^2 - kx^2 - ky^2)
+
+kz only depends on the shape and the field of view of the plane and on
+k, so a Propagator computes it once and keeps it. A field is transformed
+once, and its propagation to a whole array of distances, e.g. the planes
+of a focal stack for digital refocusing, is a batched phase multiply and
+a batched inverse FFT:
+
+    propagator = propagation.Propagator(E.shape, fov, k)
+    stack = propagator.propagate(E, np.linspace(-5, 5, 100))
+
+get_propagator returns the same Propagator for the same parameters, so
+repeated propagations of fields of one plane share kz.
+
+A long focal stack does not have to be held in memory: stream yields the
+planes, or their intensity or magnitude, a batch at a time, and
+write_stack writes them straight into a memory mapped .npy volume:
+
+    for zs, planes in propagator.stream(E, z, output='intensity'):
+        ...
+    volume = propagator.write_stack('stack.npy', E, z, output='abs', dtype=np.float32)
+
+As in the scripts, kz is set to 0 where kx^2 + ky^2 > k^2, so the
+evanescent components are passed unchanged.
+"""
+
+import functools
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+from . import render
+
+# number of phase masks of single distances a Propagator keeps
+PHASES = 16
+# number of propagators kept by get_propagator
+PROPAGATORS = 8
+# quantities of the propagated fields a focal stack can hold
+OUTPUTS = {
+    'field': lambda E: E,
+    'intensity': lambda E: np.abs(E) ** 2,
+    'abs': np.abs,
+    'real': np.real,
+    'imag': np.imag,
+}
+
+
+def _output(output):
+    """
+    Function computing an output of OUTPUTS from the propagated fields
+    """
+    if output not in OUTPUTS:
+        raise ValueError("unknown output " + str(output) + ", use one of " + ", ".join(OUTPUTS))
+    return OUTPUTS[output]
+
+
+class Propagator:
+    """
+    Propagation of the fields of a plane of a given shape and field of view
+    """
+
+    def __init__(self, shape, fov, k):
+        """
+        param:
+            shape: (rows, columns) of the plane
+            fov: field of view, a scalar or (rows, columns)
+            k: wavenumber, 2 pi / lambDa
+        """
+        self.shape = tuple(int(s) for s in shape)
+        if len(self.shape) != 2:
+            raise ValueError("a Propagator needs the shape of a plane, got " + str(shape))
+        fov_y, fov_x = np.broadcast_to(np.asarray(fov, dtype=np.float64), (2,))
+        self.fov = (float(fov_y), float(fov_x))
+        self.k = float(k)
+
+        # spatial frequencies in the layout of np.fft.fft2, y along the rows
+        ky = 2 * np.pi * np.fft.fftfreq(self.shape[0], fov_y / self.shape[0])
+        kx = 2 * np.pi * np.fft.fftfreq(self.shape[1], fov_x / self.shape[1])
+        kxky = kx[None, :] ** 2 + ky[:, None] ** 2
+        self.mask = kxky > self.k ** 2
+        self.kz = np.sqrt(np.where(self.mask, self.k ** 2, self.k ** 2 - kxky))
+        self.kz[self.mask] = 0
+        self.mask.setflags(write=False)
+        self.kz.setflags(write=False)
+        self._phases = OrderedDict()
+
+    def phase(self, z):
+        """
+        Phase mask exp(i kz z) of the distances z
+        The masks of the last PHASES single distances are kept.
+        param:
+            z: distance, or array of distances
+        return:
+            array of shape z.shape + shape, read-only for a single distance
+        """
+        if np.ndim(z) > 0:
+            z = np.asarray(z, dtype=np.float64)
+            return np.exp(1j * self.kz * z[..., None, None])
+        key = float(z)
+        if key not in self._phases:
+            if len(self._phases) >= PHASES:
+                self._phases.popitem(last=False)
+            phase = np.exp(1j * self.kz * key)
+            phase.setflags(write=False)
+            self._phases[key] = phase
+        return self._phases[key]
+
+    def spectrum(self, E):
+        """
+        2-D Fourier transform of fields of the plane
+        param:
+            E: field, shape (..., rows, columns)
+        return:
+            its transform, same shape
+        """
+        E = np.asarray(E)
+        if E.shape[-2:] != self.shape:
+            raise ValueError("field has shape " + str(E.shape) + ", expected (..., " +
+                             str(self.shape[0]) + ", " + str(self.shape[1]) + ")")
+        return np.fft.fft2(E)
+
+    def batches(self, num_z, E_shape, max_memory=None):
+        """
+        Batches of distances propagated together under a memory budget
+        param:
+            num_z: number of distances
+            E_shape: shape of the propagated field
+            max_memory: memory budget of a batch in bytes, render.MAX_MEMORY if None
+        return:
+            list of slices of the distances
+        """
+        # the phase mask, the propagated spectrum, the propagated field and
+        # its output of a distance
+        return render.tile_rows(num_z, 4 * 16 * int(np.prod(E_shape)), max_memory)
+
+    def propagate_spectrum(self, E_FFT, z):
+        """
+        Fields at the distances z of a field given by its spectrum
+        param:
+            E_FFT: spectrum of the field from spectrum, shape (..., rows, columns)
+            z: distance, or array of distances
+        return:
+            the fields, shape z.shape + E_FFT.shape
+        """
+        if np.ndim(z) == 0:
+            return np.fft.ifft2(E_FFT * self.phase(z))
+        phase = self.phase(z)
+        # align the distances in front of the axes of the field
+        phase = np.reshape(phase, np.shape(z) + (1,) * (np.ndim(E_FFT) - 2) + self.shape)
+        return np.fft.ifft2(E_FFT * phase)
+
+    def stream(self, E, z, output='field', batch_size=None, max_memory=None):
+        """
+        Generator of the planes of a focal stack, a batch at a time
+        The field is transformed once, and only the planes of one batch
+        are alive at a time.
+        param:
+            E: field, shape (..., rows, columns)
+            z: array of distances
+            output: quantity of the planes, a key of OUTPUTS, e.g. 'field',
+                'intensity' or 'abs'
+            batch_size: number of planes of a batch, 1 for one plane at a
+                time, chosen from max_memory if None
+            max_memory: memory budget of a batch in bytes, render.MAX_MEMORY if None
+        return:
+            yields (zs, planes): the slice of the flattened distances of a
+                batch and its planes, shape (batch,) + E.shape
+        """
+        convert = _output(output)
+        E_FFT = self.spectrum(E)
+        z = np.ravel(np.asarray(z, dtype=np.float64))
+        if batch_size is None:
+            batches = self.batches(z.size, E_FFT.shape, max_memory)
+        else:
+            batches = render.tile_rows(z.size, 0, tile_size=max(1, int(batch_size)))
+        for zs in batches:
+            yield zs, convert(self.propagate_spectrum(E_FFT, z[zs]))
+
+    def propagate(self, E, z, max_memory=None):
+        """
+        Propagate a field to the distances z
+        The field is transformed once, the distances are propagated in
+        batches under the memory budget.
+        param:
+            E: field, shape (..., rows, columns)
+            z: distance, or array of distances
+            max_memory: memory budget of a batch in bytes, render.MAX_MEMORY if None
+        return:
+            the fields, shape z.shape + E.shape
+        """
+        if np.ndim(z) == 0:
+            return self.propagate_spectrum(self.spectrum(E), z)
+        out = np.empty((np.size(z),) + np.shape(E), dtype=np.complex128)
+        for zs, planes in self.stream(E, z, max_memory=max_memory):
+            out[zs] = planes
+        return np.reshape(out, np.shape(z) + np.shape(E))
+
+    def write_stack(self, path, E, z, output='intensity', dtype=None, batch_size=None, max_memory=None):
+        """
+        Write a focal stack to a memory mapped .npy volume
+        The planes are streamed into a temporary file that is renamed when
+        the stack is complete, so a reader never maps a partial volume.
+        param:
+            path: name of the .npy file
+            E, z, output, batch_size, max_memory: see stream
+            dtype: type of the volume, complex128 for 'field' and float64
+                otherwise if None, e.g. np.float32 halves the file, the
+                fields need a complex type
+        return:
+            the volume, a read-only memory mapped array of shape
+            (z.size,) + E.shape
+        """
+        if dtype is None:
+            dtype = np.complex128 if output == 'field' else np.float64
+        elif output == 'field' and not np.issubdtype(dtype, np.complexfloating):
+            raise ValueError("the fields need a complex dtype, got " + str(np.dtype(dtype)))
+        shape = (np.size(z),) + np.shape(E)
+        temp = path[:-len('.npy')] if path.endswith('.npy') else path
+        temp = temp + '.' + str(os.getpid()) + '.tmp.npy'
+        volume = np.lib.format.open_memmap(temp, mode='w+', dtype=dtype, shape=shape)
+        try:
+            for zs, planes in self.stream(E, z, output, batch_size, max_memory):
+                volume[zs] = planes
+            volume.flush()
+        except BaseException:
+            del volume
+            os.remove(temp)
+            raise
+        del volume
+        os.replace(temp, path)
+        return np.load(path, mmap_mode='r')
+
+    __call__ = propagate
+
+
+@functools.lru_cache(maxsize=PROPAGATORS)
+def get_propagator(shape, fov, k):
+    """
+    The shared Propagator of the given parameters, see Propagator
+    param:
+        shape: (rows, columns) of the plane, a tuple
+        fov: field of view, a scalar or a tuple (rows, columns)
+        k: wavenumber
+    """
+    return Propagator(shape, fov, k)
@@ -0,0 +1,807 @@
+"""
+Plane wave accumulation for the focused beam Mie scattering simulation
+
+A focused beam is simulated as a sum of sampled plane waves. For every
+plane wave k_j the scattered and internal fields are
+
+    Es_j = sum_l B_l * h_l(kr) * P_l(cos(theta_j))
+    Ei_j = sum_l A_l * j_l(knr) * P_l(cos(theta_j))
+
+where theta_j is the angle between k_j and the r vector. The radial terms
+and the coefficients do not depend on the plane wave, so the sum over
+plane waves only has to be taken over the Legendre polynomials:
+
+    S_l = sum_j phase_j * P_l(cos(theta_j))
+
+after which both fields are a single reduction along the order axis.
+
+That reduction is taken by hankel_sum and bessel_sum, which run the
+recurrences of the radial functions and of the Legendre polynomials
+together with the sum, so no array with an order axis is built for them.
+truncated_bessel_sum additionally picks the number of orders of every
+pixel from its own argument, since j_l(z) vanishes quickly above |z|.
+When many spheres share a plane, scattering_basis and interior_basis build
+the terms once and the fields of all of them are a single matrix product
+instead.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import scipy.special
+
+from . import special
+
+# default memory budget of the working arrays of one batch, in bytes
+MAX_MEMORY = 2 ** 28
+# largest default batch of adaptive_sum, the error is checked after each batch
+ADAPTIVE_BATCH = 256
+# default tolerance of the order truncation of truncated_bessel_sum
+ORDER_TOL = 1e-12
+
+
+def batch_size_for(num_pixels, max_memory=MAX_MEMORY, num_arrays=3):
+    """
+    Number of plane waves evaluated together under a memory budget
+    param:
+        num_pixels: number of pixels being evaluated
+        max_memory: memory budget of the working arrays in bytes
+        num_arrays: number of float64 (num_pixels, batch) working arrays,
+            three for the Legendre recurrence: P_(l-1), P_l and P_(l+1)
+    return:
+        batch size, at least one plane wave
+    """
+    return max(1, int(max_memory // (num_arrays * 8 * num_pixels)))
+
+
+def tile_rows(num_rows, row_bytes, max_memory=None, tile_size=None, workers=1):
+    """
+    Row tiles of a grid that is evaluated one tile at a time
+    param:
+        num_rows: number of rows of the grid
+        row_bytes: memory of the working arrays of one row in bytes
+        max_memory: memory budget of the working arrays of all the tiles
+            evaluated at the same time, MAX_MEMORY if None
+        tile_size: number of rows of a tile, overrides max_memory
+        workers: number of tiles evaluated at the same time
+    return:
+        list of slices covering the rows in order
+    """
+    if tile_size is None:
+        if max_memory is None:
+            max_memory = MAX_MEMORY
+        tile_size = max(1, int(max_memory // (max(1, workers) * max(1, row_bytes))))
+    return [slice(start, min(start + tile_size, num_rows)) for start in range(0, num_rows, tile_size)]
+
+
+def map_tiles(func, tiles, workers=1):
+    """
+    Evaluate a grid tile by tile and stack the tiles along the first axis
+    With more than one worker the tiles run on a thread pool, numpy
+    releases the GIL inside its array operations so they run concurrently.
+    param:
+        func: function of a slice of rows returning the values of those rows
+        tiles: slices from tile_rows
+        workers: number of threads
+    return:
+        the values of the whole grid
+    """
+    if workers is None or workers <= 1 or len(tiles) == 1:
+        parts = [func(rows) for rows in tiles]
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            parts = list(pool.map(func, tiles))
+    return np.concatenate(parts, axis=0)
+
+
+def unique_pixels(*keys, decimals=None):
+    """
+    Pixels sharing the same values of all the keys, for fields that only
+    depend on a few per-pixel quantities, e.g. on (kr, cos_theta) for a
+    sphere on the axis of the illumination. The values are compared bit by
+    bit, so a field evaluated on the unique pixels and scattered back is
+    identical to the one evaluated on every pixel.
+    param:
+        keys: real arrays of the same shape, e.g. kr and cos_theta
+        decimals: if given, the keys are rounded to this many decimals
+            first, which also merges values that only differ by rounding
+    return:
+        index: flat index of one pixel of every unique combination
+        inverse: for every pixel, the position of its combination in index,
+            values computed on index are scattered back with values[inverse]
+    """
+    flat = np.stack([np.ravel(key) for key in keys], axis=-1).astype(np.float64)
+    if decimals is not None:
+        # + 0.0 turns -0.0 into 0.0
+        flat = np.round(flat, decimals) + 0.0
+    # sort the bit patterns of the keys, so nan compares equal to nan
+    bits = np.ascontiguousarray(flat).view(np.uint64)
+    order = np.lexsort(bits.T[::-1])
+    bits = bits[order]
+    # the first pixel of every run of equal keys
+    first = np.ones(bits.shape[0], dtype=bool)
+    first[1:] = np.any(bits[1:] != bits[:-1], axis=1)
+    index = order[first]
+    inverse = np.empty(bits.shape[0], dtype=np.intp)
+    inverse[order] = np.cumsum(first) - 1
+    return index, np.reshape(inverse, np.shape(keys[0]))
+
+
+def on_axis(c, kNorm):
+    """
+    Whether the sphere at c lies on the optical axis along kNorm, the case
+    in which the focused field only depends on (kr, cos_theta)
+    """
+    kNorm = np.asarray(kNorm, dtype=np.float64)
+    kNorm = kNorm / np.linalg.norm(kNorm)
+    c = np.asarray(c, dtype=np.float64)
+    z0 = np.dot(c, kNorm)
+    return np.linalg.norm(c - z0 * kNorm) < 1e-12 * max(1, abs(z0))
+
+
+def _grid_symmetry(u, v):
+    """
+    Mirror symmetry of the grid meshgrid(u, v) around u = 0 and v = 0,
+    see mirror_pixels. np.linspace does not place mirrored points exactly,
+    so the coordinates are compared to within a few units in the last place.
+    """
+    u = np.asarray(u, dtype=np.float64)
+    v = np.asarray(v, dtype=np.float64)
+    def same(a, b):
+        scale = max(1, np.max(np.abs(a)), np.max(np.abs(b)))
+        return a.shape == b.shape and np.allclose(a, b, rtol=0, atol=8 * np.finfo(float).eps * scale)
+    if not same(u, -u[::-1]):
+        return 1
+    if not same(v, -v[::-1]):
+        return 2
+    if same(u, v):
+        return 8
+    return 4
+
+
+def plane_symmetry(u, v, symmetry=None, symmetric=True, max_symmetry=8):
+    """
+    Mirror symmetry used to evaluate a field on the plane meshgrid(u, v)
+    param:
+        u, v: column and row coordinates of the plane relative to the axis
+            the field is symmetric around
+        symmetry: None to use all the symmetry the grid and the field share,
+            or 1, 2, 4 or 8 (see mirror_pixels) to ask for one
+        symmetric: whether the field is symmetric around the axis, e.g. not
+            for Monte Carlo sampled plane waves
+        max_symmetry: largest symmetry of the field on this plane, e.g. 2 for
+            a plane that contains the k vector
+    return:
+        symmetry for mirror_pixels
+    """
+    grid = min(_grid_symmetry(u, v), max_symmetry)
+    if symmetry is None:
+        return grid if symmetric else 1
+    if symmetry not in (1, 2, 4, 8):
+        raise ValueError("unknown symmetry " + str(symmetry) + ", use 1, 2, 4 or 8")
+    if symmetry > grid:
+        raise ValueError("the plane only has a symmetry of order " + str(grid) + ", not " + str(symmetry))
+    return symmetry
+
+
+def mirror_pixels(num_rows, num_cols, symmetry):
+    """
+    Pixels of one symmetric part of a grid and the lookup of every pixel
+    param:
+        num_rows, num_cols: shape of the grid
+        symmetry: 1 for none, 2 for a mirror of the columns, 4 for mirrors of
+            the columns and of the rows, 8 for both mirrors and the transpose
+    return:
+        index: flat index of the pixels evaluated
+        inverse: for every pixel, the position of its mirror image in index,
+            as returned by unique_pixels
+    """
+    if symmetry not in (1, 2, 4, 8):
+        raise ValueError("unknown symmetry " + str(symmetry) + ", use 1, 2, 4 or 8")
+    if symmetry == 8 and num_rows != num_cols:
+        raise ValueError("the transpose needs a square grid")
+    i, j = np.meshgrid(np.arange(num_rows), np.arange(num_cols), indexing='ij')
+    if symmetry >= 2:
+        j = np.minimum(j, num_cols - 1 - j)
+    if symmetry >= 4:
+        i = np.minimum(i, num_rows - 1 - i)
+    if symmetry == 8:
+        i, j = np.minimum(i, j), np.maximum(i, j)
+    index, inverse = np.unique(i * num_cols + j, return_inverse=True)
+    return index, np.reshape(inverse, (num_rows, num_cols))
+
+
+def angular_sum(rNorm, k_j, phase, numOrd, batch_size=None, max_memory=MAX_MEMORY):
+    """
+    Phase weighted sum of the Legendre polynomials of all sampled plane waves
+    param:
+        rNorm: normalized r vectors, shape (..., 3)
+        k_j: sampled k vectors, shape (3, numSample)
+        phase: phase shift of each plane wave, shape (numSample,)
+        numOrd: the highest order of the Legendre polynomials
+        batch_size: number of plane waves evaluated together, if None it is
+            derived from max_memory
+        max_memory: memory budget of one batch in bytes
+    return:
+        S: sum_j phase_j * P_l(rNorm . k_j), shape (..., numOrd+1)
+    """
+    shape = rNorm.shape[:-1]
+    r = np.reshape(rNorm, (-1, 3))
+    k_j = np.asarray(k_j, dtype=np.float64)
+    phase = np.asarray(phase, dtype=np.complex128)
+    numSample = k_j.shape[1]
+
+    if batch_size is None:
+        batch_size = batch_size_for(r.shape[0], max_memory)
+
+    # keep the real and imaginary parts of the sum separately so the
+    # contraction over the plane waves stays a real matrix product
+    S = np.zeros((r.shape[0], numOrd+1, 2))
+
+    for start in range(0, numSample, batch_size):
+        end = min(start + batch_size, numSample)
+        # real and imaginary part of the phase as two columns
+        w = np.stack((phase[start:end].real, phase[start:end].imag), axis=1)
+        # cos_theta between every r vector and every plane wave in the batch
+        x = r @ k_j[:, start:end]
+
+        # order 0 and 1 of the Legendre polynomials
+        S[:, 0, :] += np.sum(w, axis=0)
+        if numOrd == 0:
+            continue
+        S[:, 1, :] += x @ w
+
+        # the upward recurrence, reduced over the batch at each order
+        p_prev = np.ones(x.shape)
+        p = x
+        for j in range(1, numOrd):
+            p_next = ((2*j+1)/(j+1)) * x * p - (j/(j+1)) * p_prev
+            S[:, j+1, :] += p_next @ w
+            p_prev, p = p, p_next
+
+    return np.reshape(S[..., 0] + 1j * S[..., 1], shape + (numOrd+1,))
+
+
+def _angular_terms(numOrd, cos_theta, angular):
+    """
+    Angular term of every order, in increasing order, either the Legendre
+    polynomials of cos_theta from the upward recurrence or the slices of a
+    precomputed sum such as the one of angular_sum
+    """
+    if (cos_theta is None) == (angular is None):
+        raise ValueError("give either cos_theta or angular")
+    if angular is not None:
+        for l in range(numOrd+1):
+            yield angular[..., l]
+        return
+    p_prev = np.ones(np.shape(cos_theta))
+    yield p_prev
+    if numOrd == 0:
+        return
+    p = np.asarray(cos_theta, dtype=np.float64)
+    yield p
+    for l in range(1, numOrd):
+        p_prev, p = p, ((2*l+1)/(l+1)) * cos_theta * p - (l/(l+1)) * p_prev
+        yield p
+
+
+def hankel_sum(kr, coeff, cos_theta=None, angular=None):
+    """
+    Sum over the orders of coeff_l * h_l(kr) * P_l(cos_theta), or of
+    coeff_l * h_l(kr) * angular[..., l] when the angular terms are given,
+    keeping only a few arrays of the shape of kr alive
+    h_l comes from the upward recurrence
+        h_(l+1) = (2l + 1) / kr * h_l - h_(l-1)
+    which is stable for the hankel function, since it is dominated by the
+    growing second kind part wherever the first kind part decays
+    param:
+        kr: radial arguments
+        coeff: coefficients of the orders 0..numOrd, e.g. (2l + 1) i^l B_l
+        cos_theta: cosine of the angle to the k vector, shape of kr
+        angular: angular terms, shape kr.shape + (numOrd+1,)
+    return:
+        the sum, shape of kr
+    """
+    kr = np.asarray(kr)
+    coeff = np.asarray(coeff)
+    numOrd = coeff.shape[-1] - 1
+
+    E = np.zeros(kr.shape, dtype=np.complex128)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        # h_0 and h_1 in closed form
+        e = np.exp(1j * kr)
+        h_prev = None
+        h = -1j * e / kr
+        for l, q in enumerate(_angular_terms(numOrd, cos_theta, angular)):
+            if l == 1:
+                h_prev, h = h, -(kr + 1j) * e / kr ** 2
+            elif l > 1:
+                h_prev, h = h, (2*l - 1) / kr * h - h_prev
+            E += coeff[l] * h * q
+    return E
+
+
+def scattering_basis(kr, cos_theta, numOrd):
+    """
+    Basis of the scattered field of a plane wave, which does not depend on
+    the sphere
+        H[..., l] = (2l + 1) * i^l * h_l(kr) * P_l(cos_theta)
+    The field of a sphere with the coefficients B_l is H @ B, so the fields
+    of M spheres sharing numOrd are a single product H @ B with B of shape
+    (numOrd+1, M).
+    param:
+        kr: radial arguments
+        cos_theta: cosine of the angle to the k vector, shape of kr
+        numOrd: the highest order
+    return:
+        H, shape kr.shape + (numOrd+1,)
+    """
+    H = special.sph_hn(numOrd, kr)
+    for l, p in enumerate(_angular_terms(numOrd, cos_theta, None)):
+        H[..., l] *= (2*l + 1) * (1j ** l) * p
+    return H
+
+
+def interior_basis(z, cos_theta, numOrd):
+    """
+    Basis of the internal field of a plane wave, the counterpart of
+    scattering_basis with the coefficients A_l
+        J[..., l] = (2l + 1) * i^l * j_l(z) * P_l(cos_theta)
+    param:
+        z: arguments, e.g. k * n * r inside the sphere
+        cos_theta: cosine of the angle to the k vector, shape of z
+        numOrd: the highest order
+    return:
+        J, shape z.shape + (numOrd+1,)
+    """
+    J = special.sph_jn(numOrd, z).astype(np.complex128)
+    for l, p in enumerate(_angular_terms(numOrd, cos_theta, None)):
+        J[..., l] *= (2*l + 1) * (1j ** l) * p
+    return J
+
+
+def bessel_sum(z, coeff, cos_theta=None, angular=None, orders=None):
+    """
+    Sum over the orders of coeff_l * j_l(z) * P_l(cos_theta), or of
+    coeff_l * j_l(z) * angular[..., l] when the angular terms are given,
+    keeping only a few arrays of the shape of z alive
+    j_l comes from the downward (Miller) recurrence, which is only known up
+    to a common factor until order 0 is reached. The sum is linear in j_l,
+    so it is accumulated downward with the unnormalized values and scaled
+    once at the end. The Legendre polynomials are summed downward with the
+    Clenshaw recurrence
+        b_l = a_l + (2l + 1) / (l + 1) * x * b_(l+1) - (l + 1) / (l + 2) * b_(l+2)
+    whose b_0 is the sum of a_l * P_l(x).
+    With orders given, the pixels are sorted by their highest order and
+    every step of the recurrences only updates the pixels that have
+    reached their own starting order, so each pixel costs its own orders.
+    param:
+        z: arguments, real or complex, e.g. k * n * r inside the sphere
+        coeff: coefficients of the orders 0..numOrd, e.g. (2l + 1) i^l A_l
+        cos_theta: cosine of the angle to the k vector, shape of z
+        angular: angular terms, shape z.shape + (numOrd+1,)
+        orders: optional highest order of every pixel, shape of z, see
+            truncation_orders, numOrd for every pixel if None
+    return:
+        the sum, shape of z
+    """
+    if (cos_theta is None) == (angular is None):
+        raise ValueError("give either cos_theta or angular")
+    shape = np.shape(z)
+    coeff = np.asarray(coeff)
+    numOrd = coeff.shape[-1] - 1
+    z = np.ravel(z)
+    if cos_theta is not None:
+        cos_theta = np.ravel(cos_theta)
+    else:
+        angular = np.reshape(angular, (z.size, numOrd+1))
+    angular_in = angular
+
+    # j_l(z) -> delta_l0 for small z, where the recurrence would overflow
+    small = np.abs(z) < 1e-100
+    z = np.where(small, 1, z)
+
+    absz = np.abs(z)
+    if orders is None:
+        orders = np.full(z.size, numOrd)
+        start = np.full(z.size, int(max(numOrd, np.max(absz, initial=0)) + 16 + 4 * np.max(absz, initial=0) ** (1/3)))
+        sort = None
+    else:
+        orders = np.minimum(np.ravel(orders), numOrd)
+        # pixels sorted by decreasing order, a pixel never starts after the
+        # pixels before it, so the active pixels of every step are a prefix
+        sort = np.argsort(-orders, kind='stable')
+        z, absz, orders = z[sort], absz[sort], orders[sort]
+        if cos_theta is not None:
+            cos_theta = cos_theta[sort]
+        else:
+            angular = angular[sort]
+        start = np.maximum.accumulate((np.maximum(orders, absz) + 16 + 4 * absz ** (1/3)).astype(np.int64))
+    # number of pixels in the recurrence of j_l and in the sum at every order
+    levels = np.arange(start[0] + 1 if z.size else 0)
+    num_rec = np.searchsorted(-start, -levels, side='right')
+    num_sum = np.searchsorted(-orders, -levels, side='right')
+
+    # unnormalized j_(l+1) and j_l, starting from j_(start+1) = 0
+    j_next = np.zeros(z.shape, dtype=np.result_type(z.dtype, np.float64))
+    j = np.ones(z.shape, dtype=j_next.dtype)
+    # running sum, or b_(l+1) and b_(l+2) of the Clenshaw recurrence
+    b = np.zeros(z.shape, dtype=np.complex128)
+    b_next = np.zeros(z.shape, dtype=np.complex128)
+
+    for l in levels[::-1]:
+        n = num_sum[l]
+        if n == z.size:
+            # every pixel is active, the arrays are swapped instead of copied
+            if angular is not None:
+                b += coeff[l] * j * angular[:, l]
+            else:
+                b, b_next = coeff[l] * j + ((2*l+1)/(l+1)) * cos_theta * b - ((l+1)/(l+2)) * b_next, b
+        elif n:
+            if angular is not None:
+                b[:n] += coeff[l] * j[:n] * angular[:n, l]
+            else:
+                b_l = coeff[l] * j[:n] + ((2*l+1)/(l+1)) * cos_theta[:n] * b[:n] - ((l+1)/(l+2)) * b_next[:n]
+                b_next[:n] = b[:n]
+                b[:n] = b_l
+        if l == 0:
+            break
+        n = num_rec[l]
+        if n == z.size:
+            j_next, j = j, (2*l + 1) / z * j - j_next
+        else:
+            j_l = (2*l + 1) / z[:n] * j[:n] - j_next[:n]
+            j_next[:n] = j[:n]
+            j[:n] = j_l
+        # rescale everything by the same factor before it can overflow
+        big = np.abs(j[:n]) > 1e100
+        if np.any(big):
+            scale = np.where(big, 1e-100, 1)
+            j[:n] *= scale
+            j_next[:n] *= scale
+            b[:n] *= scale
+            b_next[:n] *= scale
+
+    # normalize on the larger of j_0 and j_1, as special.sph_jn does
+    sin_z, cos_z = np.sin(z), np.cos(z)
+    j0 = sin_z / z
+    j1 = sin_z / z ** 2 - cos_z / z
+    use_j1 = (np.abs(j1) > np.abs(j0)) & (np.abs(z) > 1)
+    E = b * np.where(use_j1, j1 / j_next, j0 / j)
+
+    if sort is not None:
+        E[sort] = E.copy()
+    if np.any(small):
+        E[small] = coeff[0] * (1 if angular is None else angular_in[small, 0])
+    return np.reshape(E, shape)
+
+
+def truncation_orders(z, tol=ORDER_TOL):
+    """
+    Number of orders after which j_l(z) stays below tol, from the excess
+    bandwidth formula
+        L = |z| + 1.8 * log10(1/tol)^(2/3) * |z|^(1/3)
+    with at least log10(1/tol) orders for small |z|, where j_l(z) falls
+    off like z^l / (2l + 1)!!
+    param:
+        z: arguments, real or complex
+        tol: size of the first neglected term relative to the coefficients
+    return:
+        highest order of every pixel, integer array of the shape of z
+    """
+    digits = np.log10(1 / tol)
+    absz = np.abs(np.asarray(z))
+    L = absz + 1.8 * digits ** (2/3) * absz ** (1/3)
+    return np.ceil(np.maximum(L, digits)).astype(np.int64) + 2
+
+
+def truncated_bessel_sum(z, coeff, cos_theta=None, angular=None, tol=ORDER_TOL):
+    """
+    bessel_sum with the number of orders of every pixel picked from its own
+    argument by truncation_orders, so for a field of many orders on a small
+    plane most of the work of the fixed number of orders is skipped
+    param:
+        z, coeff, cos_theta, angular: see bessel_sum
+        tol: size of the first neglected term relative to the coefficients,
+            None to sum all the orders of coeff
+    return:
+        the sum, shape of z
+    """
+    orders = None if tol is None else truncation_orders(z, tol)
+    return bessel_sum(z, coeff, cos_theta=cos_theta, angular=angular, orders=orders)
+
+
+def new_state(num_pixels):
+    """
+    Empty running statistics of adaptive_sum
+    param:
+        num_pixels: number of pixels being evaluated
+    return:
+        state, a dictionary of
+            mean: running mean of the plane wave fields, shape (num_pixels,)
+            M2: running sum of squared deviations, shape (num_pixels,)
+            count: number of plane waves summed
+            k_j: all the k vectors summed, shape (3, count)
+    """
+    return {'mean': np.zeros(num_pixels, dtype=np.complex128),
+            'M2': np.zeros(num_pixels),
+            'count': 0,
+            'k_j': np.zeros((3, 0))}
+
+
+def save_state(path, state):
+    """
+    Save the running statistics of adaptive_sum to an .npz file, so a
+    render can be refined later or resumed after its job is stopped
+    param:
+        path: file name
+        state: the state returned by adaptive_sum, any extra entry (e.g. the
+            state of the random number generator as a string) is kept too
+    """
+    np.savez(path, **state)
+
+
+def load_state(path):
+    """
+    Load the running statistics saved by save_state
+    param:
+        path: file name
+    return:
+        state dictionary for adaptive_sum
+    """
+    with np.load(path) as data:
+        state = {key: data[key] for key in data.files}
+    for key in state:
+        # strings are stored as 0-d arrays
+        if state[key].dtype.kind == 'U':
+            state[key] = str(state[key])
+    state['count'] = int(state['count'])
+    return state
+
+
+def adaptive_sum(rNorm, terms, numOrd, sampler, c, magk, scale, tol,
+                 norm='l2', batch_size=None, max_samples=100000, max_memory=MAX_MEMORY, state=None):
+    """
+    Monte Carlo sum of plane waves that stops once the estimated error is
+    below a tolerance, instead of after a fixed number of samples
+    Every plane wave contributes the field
+        f_j = phase_j * sum_l terms_l * P_l(rNorm . k_j)
+    and the estimate is scale * mean_j(f_j). The per-pixel variance of f_j is
+    tracked with a running (Welford) update over the batches, which gives
+    the standard error scale * sqrt(var / N) of every pixel.
+    Passing the state of a previous call continues that sum, so a coarse
+    render can be refined with more plane waves without starting over.
+    param:
+        rNorm: normalized r vectors, shape (..., 3)
+        terms: per-order field terms without the Legendre polynomials,
+            e.g. h_l(kr) * B_l, shape (..., numOrd+1)
+        numOrd: the highest order of the Legendre polynomials
+        sampler: function returning a (3, num) array of num new k vectors
+        c: position of the sphere relative to the focal point
+        magk: magnitude of the k vector
+        scale: factor applied to the sample mean, e.g. subA
+        tol: tolerance of the relative error estimate
+        norm: 'l2' compares the norms of the error and of the field,
+              'max' compares their largest pixels
+        batch_size: number of plane waves sampled at a time, if None it is
+            derived from max_memory and kept at most ADAPTIVE_BATCH so the
+            stopping point is not too coarse
+        max_samples: upper limit of the total number of plane waves,
+            including the ones already in state
+        max_memory: memory budget of one batch in bytes
+        state: running statistics from a previous call or load_state,
+            if None the sum starts from zero
+    return:
+        E: the estimated field, shape (...)
+        err: the relative error estimate reached
+        state: the running statistics, state['k_j'] holds every k vector used
+    """
+    if norm not in ('l2', 'max'):
+        raise ValueError("unknown norm '" + str(norm) + "', use 'l2' or 'max'")
+
+    shape = rNorm.shape[:-1]
+    r = np.reshape(rNorm, (-1, 3))
+    T = np.reshape(terms, (-1, numOrd+1))
+    c = np.asarray(c, dtype=np.float64)
+
+    if batch_size is None:
+        # the recurrence plus the complex per-sample field
+        batch_size = min(ADAPTIVE_BATCH, batch_size_for(r.shape[0], max_memory, num_arrays=6))
+
+    if state is None:
+        state = new_state(r.shape[0])
+    elif np.size(state['mean']) != r.shape[0]:
+        raise ValueError("the state was accumulated over " + str(np.size(state['mean'])) +
+                         " pixels, but " + str(r.shape[0]) + " pixels are evaluated")
+
+    # running mean and sum of squared deviations of every pixel
+    mean = np.array(state['mean'], dtype=np.complex128).ravel()
+    M2 = np.array(state['M2'], dtype=np.float64).ravel()
+    count = int(state['count'])
+    k_all = [np.asarray(state['k_j'], dtype=np.float64)]
+
+    def relative_error():
+        if count < 2:
+            return np.inf
+        # standard error of every pixel relative to the field
+        std_err = scale * np.sqrt(M2 / (count - 1) / count)
+        E_abs = np.abs(scale * mean)
+        if norm == 'l2':
+            return np.linalg.norm(std_err) / max(np.linalg.norm(E_abs), np.finfo(float).tiny)
+        return np.max(std_err) / max(np.max(E_abs), np.finfo(float).tiny)
+
+    err = relative_error()
+    while err > tol and count < max_samples:
+        k_j = np.asarray(sampler(min(batch_size, max_samples - count)), dtype=np.float64)
+        k_all.append(k_j)
+        phase = np.exp(1j * magk * np.dot(c, k_j))
+
+        # field of every plane wave in the batch
+        x = r @ k_j
+        f = T[:, 0:1] * np.ones(x.shape)
+        if numOrd > 0:
+            f = f + T[:, 1:2] * x
+        p_prev = np.ones(x.shape)
+        p = x
+        for j in range(1, numOrd):
+            p_next = ((2*j+1)/(j+1)) * x * p - (j/(j+1)) * p_prev
+            f += T[:, j+1:j+2] * p_next
+            p_prev, p = p, p_next
+        f *= phase
+
+        # merge the batch statistics into the running ones
+        num = f.shape[1]
+        batch_mean = np.mean(f, axis=1)
+        batch_M2 = np.sum(np.abs(f - batch_mean[:, None]) ** 2, axis=1)
+        delta = batch_mean - mean
+        total = count + num
+        mean += delta * (num / total)
+        M2 += batch_M2 + np.abs(delta) ** 2 * (count * num / total)
+        count = total
+
+        err = relative_error()
+
+    state = dict(state)
+    state.update({'mean': mean, 'M2': M2, 'count': count, 'k_j': np.concatenate(k_all, axis=1)})
+    return np.reshape(scale * mean, shape), err, state
+
+
+def _schmidt_legendre(m, numOrd, x):
+    """
+    Schmidt semi-normalized associated Legendre functions of a fixed order m
+        Q_l^m(x) = sqrt((l-m)!/(l+m)!) * P_l^m(x), l = m..numOrd
+    so that the addition theorem reads
+        P_l(cos(gamma)) = sum_m (2 - delta_m0) Q_l^m(x1) Q_l^m(x2) cos(m * dphi)
+    param:
+        m: order of the functions
+        numOrd: the highest degree
+        x: array of cosines
+    return:
+        generator of (l, Q_l^m(x)), the Condon-Shortley phase is dropped
+        since it cancels in the addition theorem
+    """
+    # Q_m^m = sqrt((2m)!) / (2^m m!) * sin^m
+    q = np.ones(np.shape(x))
+    if m > 0:
+        s = np.sqrt(np.clip(1 - x ** 2, 0, None))
+        q = q * np.prod(np.sqrt((2*np.arange(1, m+1) - 1) / (2*np.arange(1, m+1)))) * s ** m
+    yield m, q
+    if m == numOrd:
+        return
+    q_prev, q = q, np.sqrt(2*m+1) * x * q
+    yield m+1, q
+    for l in range(m+2, numOrd+1):
+        q_next = ((2*l-1) * x * q - np.sqrt((l-1) ** 2 - m ** 2) * q_prev) / np.sqrt(l ** 2 - m ** 2)
+        q_prev, q = q, q_next
+        yield l, q
+
+
+def condenser_weights(numOrd, alpha1, alpha2):
+    """
+    Integral of the Legendre polynomials over the condenser cone,
+    the same per-order weights calFocusedField uses for the focused beam
+        int_{cos(alpha2)}^{cos(alpha1)} P_l(u) du
+            = (P_(l+1) - P_(l-1))|_(cos(alpha2))^(cos(alpha1)) / (2l + 1)
+    param:
+        numOrd: the highest order
+        alpha1, alpha2: inner and outer angle of the condenser
+    return:
+        weights of order 0..numOrd
+    """
+    l = np.arange(0, numOrd+2)
+    pl_alpha1 = scipy.special.eval_legendre(l, np.cos(alpha1))
+    pl_alpha2 = scipy.special.eval_legendre(l, np.cos(alpha2))
+    diff = pl_alpha1 - pl_alpha2
+    # P_(-1) = P_0, so order 0 only keeps the P_1 term
+    lower = np.concatenate(([diff[0]], diff[:numOrd]))
+    return (diff[1:] - lower) / (2*l[:-1] + 1)
+
+
+def condenser_sum(rNorm, kNorm, c, magk, numOrd, alpha1, alpha2):
+    """
+    Analytic counterpart of angular_sum for a condenser with a uniform
+    illumination over the cone alpha1 <= beta <= alpha2 around kNorm
+        S_l = int dOmega exp(i k k.c) * P_l(k . rNorm)
+    Integrating the azimuth with the addition theorem leaves a 1-D integral
+    over the polar angle for each (l, m) pair. For a sphere on the optical
+    axis only m = 0 survives and S_l reduces to
+        2 * pi * P_l(cos(theta)) * int P_l(u) exp(i k z u) du
+    which for z = 0 is 2 * pi * P_l(cos(theta)) * condenser_weights.
+    A lateral offset of the sphere adds the m > 0 terms through
+    J_m(k rho sin(beta)), which is the phase correction of the off-axis case.
+    param:
+        rNorm: normalized r vectors, shape (..., 3)
+        kNorm: normalized direction of the center plane wave
+        c: position of the sphere relative to the focal point
+        magk: magnitude of the k vector
+        numOrd: the highest order of the Legendre polynomials
+        alpha1, alpha2: inner and outer angle of the condenser
+    return:
+        S: shape (..., numOrd+1), the same quantity as
+           angular_sum(...) * subA / numSample with E0 = 1
+    """
+    kNorm = np.asarray(kNorm, dtype=np.float64)
+    kNorm = kNorm / np.linalg.norm(kNorm)
+    c = np.asarray(c, dtype=np.float64)
+
+    # axial and lateral offset of the sphere
+    z0 = np.dot(c, kNorm)
+    c_lat = c - z0 * kNorm
+    rho = np.linalg.norm(c_lat)
+
+    # cos_theta of every pixel around the optical axis
+    cos_theta = np.dot(rNorm, kNorm)
+
+    if on_axis(c, kNorm):
+        if z0 == 0:
+            T = condenser_weights(numOrd, alpha1, alpha2)
+        else:
+            T = _cone_integrals(0, numOrd, alpha1, alpha2, magk, z0, 0)[:, 0]
+        S = np.zeros(cos_theta.shape + (numOrd+1,), dtype=np.complex128)
+        for l, q in _schmidt_legendre(0, numOrd, cos_theta):
+            S[..., l] = 2 * np.pi * T[l] * q
+        return S
+
+    # transverse frame around the optical axis, with the sphere on e1
+    e1 = c_lat / rho
+    e2 = np.cross(kNorm, e1)
+    # azimuth of every pixel relative to the sphere
+    dphi = np.arctan2(np.dot(rNorm, e2), np.dot(rNorm, e1))
+
+    T = _cone_integrals(numOrd, numOrd, alpha1, alpha2, magk, z0, rho)
+    S = np.zeros(cos_theta.shape + (numOrd+1,), dtype=np.complex128)
+    for m in range(numOrd+1):
+        # the Bessel term vanishes quickly once m exceeds k * rho
+        if not np.any(T[m:, m]):
+            break
+        prefix = 2 * np.pi * (1 if m == 0 else 2) * np.cos(m * dphi)
+        for l, q in _schmidt_legendre(m, numOrd, cos_theta):
+            S[..., l] += (prefix * T[l, m]) * q
+    return S
+
+
+def _cone_integrals(mMax, numOrd, alpha1, alpha2, magk, z0, rho):
+    """
+    Polar integrals of the condenser cone for the analytic sum
+        T_lm = i^m int Q_l^m(cos(beta)) J_m(k rho sin(beta))
+                   exp(i k z0 cos(beta)) sin(beta) dbeta
+    evaluated by Gauss-Legendre quadrature in beta, where the integrand
+    is smooth even at beta = 0
+    return:
+        T: shape (numOrd+1, mMax+1)
+    """
+    # the integrand is a band limited function of beta
+    numNode = 2 * numOrd + int(np.ceil(2 * magk * (abs(z0) + rho))) + 16
+    nodes, weights = np.polynomial.legendre.leggauss(numNode)
+    beta = 0.5 * (alpha2 - alpha1) * nodes + 0.5 * (alpha2 + alpha1)
+    weights = 0.5 * (alpha2 - alpha1) * weights * np.sin(beta)
+    phase = np.exp(1j * magk * z0 * np.cos(beta))
+
+    T = np.zeros((numOrd+1, mMax+1), dtype=np.complex128)
+    for m in range(mMax+1):
+        kernel = weights * phase * (1j ** m) * scipy.special.jv(m, magk * rho * np.sin(beta))
+        if m > 0 and np.max(np.abs(kernel)) < 1e-16 * np.max(np.abs(weights)):
+            break
+        for l, q in _schmidt_legendre(m, numOrd, np.cos(beta)):
+            T[l, m] = np.sum(kernel * q)
+    return T
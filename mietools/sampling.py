@@ -0,0 +1,160 @@
+"""
+Sampling of plane wave directions for the focused beam simulation
+
+The focused beam of a condenser is a sum of plane waves whose directions
+fill a cone around the center plane wave kd. The cone is given by the
+inner and outer numerical aperture of the condenser.
+
+Besides plain Monte Carlo sampling, cone_quadrature provides deterministic
+point sets over the cone together with their quadrature weights:
+    'random':    uniform Monte Carlo sampling, error O(1/sqrt(N))
+    'sobol':     scrambled Sobol sequence
+    'halton':    scrambled Halton sequence
+    'fibonacci': spherical Fibonacci lattice
+    'gauss':     Gauss-Legendre nodes in cos(beta) times uniform azimuth
+"""
+
+import numpy as np
+
+
+def cone_angles(NA_in, NA_out, n=1.0):
+    """
+    Inner and outer angle of the condenser cone
+    param:
+        NA_in, NA_out: inner and outer numerical aperture
+        n: refractive index of the medium the cone is sampled in
+    return:
+        alpha1, alpha2 in radians
+    """
+    return np.arcsin(NA_in / n), np.arcsin(NA_out / n)
+
+
+def rotation_to(kd):
+    """
+    Rotation matrix that maps the +Z axis onto the direction kd
+    param:
+        kd: direction vector, does not have to be normalized
+    return:
+        3 x 3 rotation matrix
+    """
+    kd = np.asarray(kd, dtype=np.float64)
+    kd = kd / np.linalg.norm(kd)
+    z = np.array([0.0, 0.0, 1.0])
+
+    # cosine and sine of the rotation angle, the axis is z x kd
+    cos_a = np.dot(z, kd)
+    axis = np.cross(z, kd)
+    sin_a = np.linalg.norm(axis)
+
+    if sin_a < 1e-12:
+        # kd is along +Z or -Z, the latter is a half turn around X
+        return np.eye(3) if cos_a > 0 else np.diag([1.0, -1.0, -1.0])
+
+    # Rodrigues' rotation formula
+    axis /= sin_a
+    K = np.array([[0, -axis[2], axis[1]],
+                  [axis[2], 0, -axis[0]],
+                  [-axis[1], axis[0], 0]])
+    return np.eye(3) + sin_a * K + (1 - cos_a) * (K @ K)
+
+
+def sample_kvectors(kd, NA_in, NA_out, numSample, seed=None, n=1.0):
+    """
+    Monte Carlo sampling of plane wave directions inside the condenser cone
+    The Z coordinate is sampled uniformly between the cosines of the cone
+    angles so the directions are uniform over the solid angle, sampling the
+    polar angle instead would make them denser towards the center.
+    param:
+        kd: direction of the center plane wave
+        NA_in, NA_out: inner and outer numerical aperture of the condenser
+        numSample: number of plane waves
+        seed: seed or numpy.random.Generator of the random numbers
+        n: refractive index of the medium the cone is sampled in
+    return:
+        k_j: normalized k vectors, float64 array of shape (3, numSample)
+    """
+    rng = np.random.default_rng(seed)
+    alpha1, alpha2 = cone_angles(NA_in, NA_out, n)
+
+    # uniform in azimuth and in cos(polar angle)
+    phi = rng.random(numSample) * 2 * np.pi
+    cos_beta = np.cos(alpha1) - rng.random(numSample) * (np.cos(alpha1) - np.cos(alpha2))
+    sin_beta = np.sqrt(1 - cos_beta ** 2)
+
+    # directions around +Z, rotated to kd all at once
+    k_j = np.stack((sin_beta * np.cos(phi), sin_beta * np.sin(phi), cos_beta))
+    return rotation_to(kd) @ k_j
+
+
+# sampling schemes understood by cone_quadrature
+SCHEMES = ('random', 'sobol', 'halton', 'fibonacci', 'gauss')
+
+
+def cone_quadrature(kd, NA_in, NA_out, numSample, scheme='random', seed=None, n=1.0):
+    """
+    Plane wave directions and quadrature weights over the condenser cone
+    The weights sum up to the solid angle of the cone, so sum_j w_j f(k_j)
+    approximates the integral of f over the cone. The Monte Carlo weights
+    subA / numSample of the scripts sum up to subA instead, so a focused
+    beam is sum_j w_j * subA / sum(w_j) * planewave(k_j).
+    param:
+        kd: direction of the center plane wave
+        NA_in, NA_out: inner and outer numerical aperture of the condenser
+        numSample: number of plane waves, for 'gauss' it is rounded down to
+            a product of the polar and azimuthal node numbers
+        scheme: one of SCHEMES
+        seed: seed or numpy.random.Generator, used by 'random' and to
+            scramble 'sobol' and 'halton'
+        n: refractive index of the medium the cone is sampled in
+    return:
+        k_j: normalized k vectors, float64 array of shape (3, N)
+        w_j: quadrature weights, float64 array of shape (N,)
+    """
+    alpha1, alpha2 = cone_angles(NA_in, NA_out, n)
+    cos1, cos2 = np.cos(alpha1), np.cos(alpha2)
+    # solid angle of the cone
+    omega = 2 * np.pi * (cos1 - cos2)
+
+    if scheme == 'random':
+        k_j = sample_kvectors(kd, NA_in, NA_out, numSample, seed, n)
+        return k_j, np.full(numSample, omega / numSample)
+
+    if scheme in ('sobol', 'halton'):
+        # low discrepancy points on the unit square
+        from scipy.stats import qmc
+        rng = np.random.default_rng(seed)
+        if scheme == 'sobol':
+            engine = qmc.Sobol(d=2, scramble=True, seed=rng)
+        else:
+            engine = qmc.Halton(d=2, scramble=True, seed=rng)
+        uv = engine.random(numSample)
+        phi = uv[:, 0] * 2 * np.pi
+        cos_beta = cos1 - uv[:, 1] * (cos1 - cos2)
+        w_j = np.full(numSample, omega / numSample)
+
+    elif scheme == 'fibonacci':
+        # equal area rings in cos(beta), rotated by the golden angle
+        i = np.arange(numSample)
+        golden = np.pi * (3 - np.sqrt(5))
+        phi = np.mod(i * golden, 2 * np.pi)
+        cos_beta = cos1 - (i + 0.5) / numSample * (cos1 - cos2)
+        w_j = np.full(numSample, omega / numSample)
+
+    elif scheme == 'gauss':
+        # the azimuth is periodic, so the trapezoidal rule is spectrally
+        # accurate and about twice as many nodes are spent on it
+        numPolar = max(1, int(np.sqrt(numSample / 2)))
+        numAzimuth = max(1, numSample // numPolar)
+        nodes, weights = np.polynomial.legendre.leggauss(numPolar)
+        cos_beta = 0.5 * (cos1 - cos2) * nodes + 0.5 * (cos1 + cos2)
+        phi = np.arange(numAzimuth) * 2 * np.pi / numAzimuth
+        cos_beta, phi = np.meshgrid(cos_beta, phi, indexing='ij')
+        w_j = np.repeat(0.5 * (cos1 - cos2) * weights * 2 * np.pi / numAzimuth, numAzimuth)
+        cos_beta, phi = cos_beta.ravel(), phi.ravel()
+
+    else:
+        raise ValueError("unknown sampling scheme '" + str(scheme) + "', use one of " + str(SCHEMES))
+
+    sin_beta = np.sqrt(1 - cos_beta ** 2)
+    k_j = np.stack((sin_beta * np.cos(phi), sin_beta * np.sin(phi), cos_beta))
+    return rotation_to(kd) @ k_j, w_j
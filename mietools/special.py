@@ -0,0 +1,237 @@
+"""
+Spherical Bessel and Hankel functions of all orders 0..numOrd
+
+Every function evaluates all the orders of an array argument in one pass
+of a three-term recurrence instead of one scipy.special call per order:
+
+    j_l: downward (Miller) recurrence of the ratios j_l / j_(l-1), started
+         above both numOrd and |x|, which is stable for every order
+    y_l: upward recurrence, which is stable for the second kind
+
+The derivatives come from the same values,
+    f_0' = -f_1,    f_l' = f_(l-1) - (l+1) / x * f_l
+so no additional evaluation is needed. The results are written into
+buffers supplied by the caller when they are given, with the order along
+the last axis, the same layout as sphbesselj and sphhankel in the scripts.
+
+sph_jn_logderiv gives j_l' / j_l without forming either of them, for the
+Mie coefficients of large or absorbing spheres.
+"""
+
+import numpy as np
+
+
+def _output(out, shape, dtype):
+    """
+    Check a caller supplied buffer or allocate a new one
+    """
+    if out is None:
+        return np.empty(shape, dtype=dtype)
+    if out.shape != shape:
+        raise ValueError("output buffer has shape " + str(out.shape) + ", expected " + str(shape))
+    return out
+
+
+def _jn_fill(j, x):
+    """
+    Fill j[..., l] with j_l(x) for all the orders along the last axis
+    """
+    numOrd = j.shape[-1] - 1
+    dtype = np.result_type(x.dtype, np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # ratios r_l = j_l / j_(l-1) from the downward recurrence
+        #   r_l = x / (2l + 1 - x * r_(l+1))
+        # started high enough above numOrd and |x| that r_start = 0 is exact
+        absx = np.max(np.abs(x)) if x.size else 0
+        start = int(max(numOrd, absx) + 16 + 4 * absx ** (1/3))
+        r = np.zeros(x.shape, dtype=dtype)
+        for l in range(start, 0, -1):
+            r = x / (2*l + 1 - x * r)
+            if l <= numOrd:
+                j[..., l] = r
+
+        # anchor the ratios on the larger one of j_0 and j_1, so the result
+        # stays accurate close to the zeros of sin(x), j_0 has no zeros
+        # for |x| < 1 where the closed form of j_1 cancels
+        sin_x, cos_x = np.sin(x), np.cos(x)
+        j0 = sin_x / x
+        j1 = sin_x / x ** 2 - cos_x / x
+        use_j1 = (np.abs(j1) > np.abs(j0)) & (np.abs(x) > 1)
+        j[..., 0] = np.where(use_j1, j1 / r, j0)
+        if numOrd >= 1:
+            j[..., 1] = np.where(use_j1, j1, j0 * r)
+        for l in range(2, numOrd+1):
+            j[..., l] *= j[..., l-1]
+
+    # the limit at x = 0
+    zero = (x == 0)
+    if np.any(zero):
+        j[zero, 0] = 1
+        j[zero, 1:] = 0
+    return j
+
+
+def _yn_fill(y, x):
+    """
+    Fill y[..., l] with y_l(x) for all the orders along the last axis
+    """
+    numOrd = y.shape[-1] - 1
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        sin_x, cos_x = np.sin(x), np.cos(x)
+        y[..., 0] = -cos_x / x
+        if numOrd >= 1:
+            y[..., 1] = -cos_x / x ** 2 - sin_x / x
+        for l in range(1, numOrd):
+            y[..., l+1] = (2*l + 1) / x * y[..., l] - y[..., l-1]
+    return y
+
+
+def _evaluate(fill, numOrd, x, derivative, out, out_p, dtype):
+    """
+    Values and optionally derivatives of all the orders,
+        f_0' = -f_1,    f_l' = f_(l-1) - (l+1) / x * f_l
+    """
+    x = np.asarray(x)
+    dtype = np.result_type(x.dtype, dtype)
+    shape = x.shape + (numOrd+1,)
+    f = _output(out, shape, dtype)
+    if not derivative:
+        return fill(f, x)
+
+    fp = _output(out_p, shape, dtype)
+    if numOrd == 0:
+        # the derivative of order 0 needs order 1
+        f1 = fill(np.empty(x.shape + (2,), dtype=dtype), x)
+        f[..., 0] = f1[..., 0]
+        fp[..., 0] = -f1[..., 1]
+        return f, fp
+
+    fill(f, x)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        l = np.arange(1, numOrd+1)
+        fp[..., 0] = -f[..., 1]
+        fp[..., 1:] = f[..., :-1] - (l + 1) * f[..., 1:] / x[..., None]
+    return f, fp
+
+
+def sph_jn(numOrd, x, derivative=False, out=None, out_p=None):
+    """
+    Spherical Bessel functions of the first kind j_l(x), l = 0..numOrd
+    param:
+        numOrd: the highest order
+        x: scalar or array, real or complex
+        derivative: also return the derivatives j_l'(x)
+        out, out_p: optional buffers of shape x.shape + (numOrd+1,)
+    return:
+        j, and j' if derivative is True
+    """
+    res = _evaluate(_jn_fill, numOrd, x, derivative, out, out_p, np.float64)
+    x = np.asarray(x)
+    if derivative and numOrd >= 1 and np.any(x == 0):
+        # j_1'(0) = 1/3, every other derivative is zero at x = 0
+        zero = (x == 0)
+        res[1][zero, :] = 0
+        res[1][zero, 1] = 1/3
+    return res
+
+
+def sph_yn(numOrd, x, derivative=False, out=None, out_p=None):
+    """
+    Spherical Bessel functions of the second kind y_l(x), l = 0..numOrd
+    param:
+        numOrd: the highest order
+        x: scalar or array, real or complex
+        derivative: also return the derivatives y_l'(x)
+        out, out_p: optional buffers of shape x.shape + (numOrd+1,)
+    return:
+        y, and y' if derivative is True
+    """
+    return _evaluate(_yn_fill, numOrd, x, derivative, out, out_p, np.float64)
+
+
+def _hn_fill(h, x):
+    """
+    Fill h[..., l] with h_l(x) = j_l(x) + i y_l(x)
+    """
+    _jn_fill(h, x)
+    y = _yn_fill(np.empty(h.shape, dtype=np.result_type(x.dtype, np.float64)), x)
+    if np.iscomplexobj(y):
+        h += 1j * y
+    else:
+        # assign the imaginary part directly, 1j * inf would give nan
+        h.imag = y
+    return h
+
+
+def _ratio_lentz(numOrd, z, tol=1e-16, max_terms=None):
+    """
+    Ratio j_(numOrd+1)(z) / j_numOrd(z) from the continued fraction
+        j_l / j_(l-1) = 1 / ((2l + 1) / z - j_(l+1) / j_l)
+    evaluated with the modified Lentz method, which needs no starting
+    order and never forms j_l itself
+    """
+    tiny = 1e-300
+    if max_terms is None:
+        # the fraction converges once the orders pass |z|
+        max_terms = int(np.max(np.abs(z), initial=0)) + 1000
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        # f = b_0 - 1 / (b_1 - 1 / (b_2 - ...)),  b_j = (2(numOrd+1+j) + 1) / z
+        f = (2*numOrd + 3) / z
+        f = np.where(f == 0, tiny, f)
+        C = f
+        D = np.zeros(z.shape, dtype=f.dtype)
+        done = np.zeros(z.shape, dtype=bool)
+        for j in range(1, max_terms):
+            b = (2*(numOrd + 1 + j) + 1) / z
+            D = b - D
+            D = np.where(D == 0, tiny, D)
+            C = b - 1 / C
+            C = np.where(C == 0, tiny, C)
+            D = 1 / D
+            delta = C * D
+            f = np.where(done, f, f * delta)
+            done |= np.abs(delta - 1) < tol
+            if np.all(done):
+                break
+        return 1 / f
+
+
+def sph_jn_logderiv(numOrd, z, out=None):
+    """
+    Logarithmic derivatives d_l(z) = j_l'(z) / j_l(z), l = 0..numOrd
+    The highest order comes from the continued fraction of j_(l+1) / j_l
+    (Lentz), the others from the downward recurrence
+        d_(l-1) = (l - 1) / z - 1 / (d_l + (l + 1) / z)
+    which is stable. Unlike the ratio of j_l' and j_l, neither of which
+    is formed, it does not overflow for large imaginary parts of z or
+    underflow for orders far above |z|, so it keeps the Mie coefficients
+    of large and absorbing spheres accurate.
+    param:
+        numOrd: the highest order
+        z: scalar or array, real or complex, nonzero
+        out: optional buffer of shape z.shape + (numOrd+1,)
+    return:
+        d, shape z.shape + (numOrd+1,)
+    """
+    z = np.asarray(z)
+    dtype = np.result_type(z.dtype, np.float64)
+    d = _output(out, z.shape + (numOrd+1,), dtype)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        d[..., numOrd] = numOrd / z - _ratio_lentz(numOrd, z)
+        for l in range(numOrd, 0, -1):
+            d[..., l-1] = (l - 1) / z - 1 / (d[..., l] + (l + 1) / z)
+    return d
+
+
+def sph_hn(numOrd, x, derivative=False, out=None, out_p=None):
+    """
+    Spherical Hankel functions of the first kind h_l(x) = j_l(x) + i y_l(x)
+    param:
+        numOrd: the highest order
+        x: scalar or array, real or complex
+        derivative: also return the derivatives h_l'(x)
+        out, out_p: optional complex buffers of shape x.shape + (numOrd+1,)
+    return:
+        h, and h' if derivative is True
+    """
+    return _evaluate(_hn_fill, numOrd, x, derivative, out, out_p, np.complex128)